@@ -0,0 +1,269 @@
+"""
+Local stand-ins for the services the benchmarks talk to, so sync and LLM round trips are
+measured over real HTTP without touching AWS or OpenAI:
+
+- FakeS3Server: an in-memory S3 endpoint with the calls mug's syncs use (Put/Get/Head/
+  DeleteObject, ranged and conditional GETs, multipart uploads, ListObjectsV2). Point boto3
+  at it with AWS_ENDPOINT_URL.
+- FakeOpenAIServer: a chat completions endpoint that streams a fixed number of tokens with
+  a configurable time to first token and gap between tokens. Point the LLM backend at it
+  with OPENAI_BASE_URL.
+
+Both serve from a background thread on 127.0.0.1 and an ephemeral port.
+"""
+import json
+import time
+import uuid
+import hashlib
+import threading
+from urllib.parse import urlparse, parse_qs, unquote
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+S3_NAMESPACE = "http://s3.amazonaws.com/doc/2006-03-01/"
+
+class BackgroundServer:
+    """
+    Runs a ThreadingHTTPServer in a daemon thread; use as a context manager.
+    """
+    handler_class = None
+
+    def __init__(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler_class)
+        self.server.daemon_threads = True
+        self.server.state = self
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+def decode_aws_chunked(data):
+    """
+    Strips the aws-chunked framing (and trailing checksum headers) botocore adds to uploads.
+    """
+    body = bytearray()
+    position = 0
+    while True:
+        line_end = data.index(b"\r\n", position)
+        size = int(data[position:line_end].split(b";")[0], 16)
+        position = line_end + 2
+        if size == 0:
+            return bytes(body)
+        body += data[position:position + size]
+        position += size + 2
+
+class FakeS3Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def objects(self):
+        return self.server.state.objects
+
+    def parse(self):
+        url = urlparse(self.path)
+        parts = unquote(url.path).lstrip("/").split("/", 1)
+        bucket = parts[0]
+        key = parts[1] if len(parts) > 1 else ""
+        return bucket, key, {name: values[0] for name, values in parse_qs(url.query, keep_blank_values=True).items()}
+
+    def read_body(self):
+        if "chunked" in self.headers.get("Transfer-Encoding", ""):
+            data = bytearray()
+            while True:
+                size = int(self.rfile.readline().split(b";")[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                data += self.rfile.read(size)
+                self.rfile.readline()
+            data = bytes(data)
+        else:
+            data = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if "aws-chunked" in self.headers.get("Content-Encoding", "") or self.headers.get("x-amz-decoded-content-length"):
+            data = decode_aws_chunked(data)
+        return data
+
+    def reply(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def error(self, status, code):
+        body = f"<?xml version=\"1.0\"?><Error><Code>{code}</Code><Message>{code}</Message></Error>".encode()
+        self.reply(status, body, {"Content-Type": "application/xml"})
+
+    def xml(self, body):
+        self.reply(200, f"<?xml version=\"1.0\"?>{body}".encode(), {"Content-Type": "application/xml"})
+
+    def do_PUT(self):
+        bucket, key, query = self.parse()
+        data = self.read_body()
+        if not key:
+            self.reply(200)
+            return
+        if "partNumber" in query:
+            upload = self.server.state.uploads[query["uploadId"]]
+            upload[int(query["partNumber"])] = data
+            self.reply(200, headers={"ETag": f"\"{hashlib.md5(data).hexdigest()}\""})
+            return
+        stored = self.objects.get((bucket, key))
+        if self.headers.get("If-None-Match") == "*" and stored is not None:
+            self.error(412, "PreconditionFailed")
+            return
+        if self.headers.get("If-Match") and (stored is None or stored[1] != self.headers["If-Match"]):
+            self.error(412, "PreconditionFailed")
+            return
+        etag = self.server.state.store(bucket, key, data)
+        self.reply(200, headers={"ETag": etag})
+
+    def do_POST(self):
+        bucket, key, query = self.parse()
+        self.read_body()
+        if "uploads" in query:
+            upload_id = uuid.uuid4().hex
+            self.server.state.uploads[upload_id] = {}
+            self.xml(f"<InitiateMultipartUploadResult xmlns=\"{S3_NAMESPACE}\"><Bucket>{escape(bucket)}</Bucket>"
+                     f"<Key>{escape(key)}</Key><UploadId>{upload_id}</UploadId></InitiateMultipartUploadResult>")
+        elif "uploadId" in query:
+            parts = self.server.state.uploads.pop(query["uploadId"])
+            etag = self.server.state.store(bucket, key, b"".join(parts[number] for number in sorted(parts)))
+            self.xml(f"<CompleteMultipartUploadResult xmlns=\"{S3_NAMESPACE}\"><Bucket>{escape(bucket)}</Bucket>"
+                     f"<Key>{escape(key)}</Key><ETag>{escape(etag)}</ETag></CompleteMultipartUploadResult>")
+        else:
+            self.error(400, "InvalidRequest")
+
+    def do_GET(self):
+        bucket, key, query = self.parse()
+        if not key:
+            self.list_objects(bucket, query)
+            return
+        stored = self.objects.get((bucket, key))
+        if stored is None:
+            self.error(404, "NoSuchKey")
+            return
+        data, etag = stored
+        if self.headers.get("If-None-Match") == etag:
+            self.reply(304, headers={"ETag": etag})
+            return
+        if self.headers.get("If-Match") and self.headers["If-Match"] != etag:
+            self.error(412, "PreconditionFailed")
+            return
+        headers = {"ETag": etag, "Content-Type": "application/octet-stream", "Accept-Ranges": "bytes"}
+        byte_range = self.headers.get("Range")
+        if byte_range:
+            first, _, last = byte_range[len("bytes="):].partition("-")
+            first = int(first)
+            last = min(int(last) if last else len(data) - 1, len(data) - 1)
+            if first >= len(data):
+                self.error(416, "InvalidRange")
+                return
+            headers["Content-Range"] = f"bytes {first}-{last}/{len(data)}"
+            self.reply(206, data[first:last + 1], headers)
+            return
+        self.reply(200, data, headers)
+
+    def do_HEAD(self):
+        bucket, key, _ = self.parse()
+        stored = self.objects.get((bucket, key))
+        if key and stored is None:
+            self.reply(404)
+            return
+        if not key:
+            self.reply(200)
+            return
+        data, etag = stored
+        if self.headers.get("If-None-Match") == etag:
+            self.reply(304, headers={"ETag": etag})
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_DELETE(self):
+        bucket, key, _ = self.parse()
+        self.objects.pop((bucket, key), None)
+        self.reply(204)
+
+    def list_objects(self, bucket, query):
+        prefix = query.get("prefix", "")
+        delimiter = query.get("delimiter")
+        start_after = query.get("start-after") or query.get("continuation-token") or ""
+        max_keys = int(query.get("max-keys", 1000))
+        keys = sorted(key for (name, key) in self.objects if name == bucket and key.startswith(prefix) and key > start_after)
+        if delimiter:
+            keys = [key for key in keys if delimiter not in key[len(prefix):]]
+        page, rest = keys[:max_keys], keys[max_keys:]
+        contents = "".join(f"<Contents><Key>{escape(key)}</Key><Size>{len(self.objects[(bucket, key)][0])}</Size>"
+                           f"<ETag>{escape(self.objects[(bucket, key)][1])}</ETag></Contents>" for key in page)
+        truncated = "true" if rest else "false"
+        token = f"<NextContinuationToken>{escape(page[-1])}</NextContinuationToken>" if rest else ""
+        self.xml(f"<ListBucketResult xmlns=\"{S3_NAMESPACE}\"><Name>{escape(bucket)}</Name><Prefix>{escape(prefix)}</Prefix>"
+                 f"<KeyCount>{len(page)}</KeyCount><MaxKeys>{max_keys}</MaxKeys><IsTruncated>{truncated}</IsTruncated>"
+                 f"{token}{contents}</ListBucketResult>")
+
+class FakeS3Server(BackgroundServer):
+    handler_class = FakeS3Handler
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = {}
+        super().__init__()
+
+    def store(self, bucket, key, data):
+        etag = f"\"{hashlib.md5(data).hexdigest()}\""
+        self.objects[(bucket, key)] = (data, etag)
+        return etag
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        state = self.server.state
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        time.sleep(state.first_token_delay)
+        for number in range(state.tokens):
+            if number:
+                time.sleep(state.token_gap)
+            event = {"choices": [{"index": 0, "delta": {"content": f"token{number} "}}]}
+            self.write_chunk(f"data: {json.dumps(event)}\n\n".encode())
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+class FakeOpenAIServer(BackgroundServer):
+    handler_class = FakeOpenAIHandler
+
+    def __init__(self, tokens=200, first_token_delay=0.05, token_gap=0.002):
+        self.tokens = tokens
+        self.first_token_delay = first_token_delay
+        self.token_gap = token_gap
+        super().__init__()
@@ -0,0 +1,94 @@
+"""
+Synthetic session generator: writes a session log that looks like one recorded by the hook,
+with a configurable number of commands, output sizes and hosts, in either log format.
+The same seed always produces the same log, so runs on different versions are comparable.
+
+Usage: python benchmarks/sessions.py <log> [--commands N] [--output-bytes N] [--hosts N] [--format text|structured] [--seed N]
+"""
+import os
+import sys
+import random
+import argparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from mug_core.session_log import LOG_FORMAT_STRUCTURED, LOG_FORMAT_TEXT, append_record, format_record, make_record
+
+COMMANDS = [
+    ["ls", "-la"],
+    ["git", "status"],
+    ["make", "test"],
+    ["python3", "train.py", "--epochs", "3"],
+    ["kubectl", "get", "pods"],
+    ["grep", "-rn", "TODO", "src"],
+    ["pip", "install", "-r", "requirements.txt"],
+    ["docker", "build", "-t", "app", "."],
+]
+WORDS = ("error warning info debug request response timeout retry connection file module "
+         "build test passed failed pod node epoch loss accuracy step cache memory").split()
+
+def make_output(rng, size):
+    """
+    Returns roughly `size` bytes of log-like output lines.
+    """
+    lines = []
+    total = 0
+    while total < size:
+        line = f"[{rng.randint(0, 99999):05d}] " + " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+        lines.append(line)
+        total += len(line) + 1
+    return "\n".join(lines) + "\n" if lines else ""
+
+def generate_session(log_path, commands=200, output_bytes=2048, hosts=2, log_format=LOG_FORMAT_TEXT, seed=0):
+    """
+    Writes a synthetic session log.
+
+    Args:
+        log_path (str): The file to write; it is replaced.
+        commands (int): Number of commands.
+        output_bytes (int): Mean output size per command; sizes vary from a tenth to twice that.
+        hosts (int): Number of hosts the commands alternate between, in runs.
+        log_format (str): "text" or "structured".
+        seed (int): Random seed.
+
+    Returns:
+        int: The size of the log in bytes.
+    """
+    rng = random.Random(seed)
+    host_names = [f"host-{number}" for number in range(max(hosts, 1))]
+    host = host_names[0]
+    with open(log_path, 'w') as log_file:
+        if log_format != LOG_FORMAT_STRUCTURED:
+            log_file.write("This is a session log.\n")
+    previous_host = None
+    start = 1_700_000_000.0
+    for number in range(commands):
+        if rng.random() < 0.1:
+            host = rng.choice(host_names)
+        size = int(output_bytes * rng.uniform(0.1, 2.0))
+        status = 0 if rng.random() < 0.85 else rng.choice([1, 2, 127])
+        record = make_record(rng.choice(COMMANDS), make_output(rng, size), status,
+                             start + number * 5, rng.uniform(0.01, 3.0), host=host, user="bench")
+        if log_format == LOG_FORMAT_STRUCTURED:
+            append_record(log_path, record)
+        else:
+            with open(log_path, 'a') as log_file:
+                log_file.write(format_record(record, previous_host))
+            previous_host = host
+    return os.path.getsize(log_path)
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic mug session log.")
+    parser.add_argument("log", help="The file to write.")
+    parser.add_argument("--commands", type=int, default=200)
+    parser.add_argument("--output-bytes", type=int, default=2048)
+    parser.add_argument("--hosts", type=int, default=2)
+    parser.add_argument("--format", choices=[LOG_FORMAT_TEXT, LOG_FORMAT_STRUCTURED], default=LOG_FORMAT_TEXT)
+    parser.add_argument("--seed", type=int, default=0)
+    options = parser.parse_args()
+    size = generate_session(options.log, options.commands, options.output_bytes, options.hosts, options.format, options.seed)
+    print(f"Wrote {options.commands} commands ({size} bytes) to {options.log}")
+
+if __name__ == "__main__":
+    main()
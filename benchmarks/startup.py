@@ -0,0 +1,95 @@
+"""
+Startup benchmark: measures how long the entry points the shell hook runs take to import,
+using `python -X importtime`, and fails if `import mug_core` goes over budget or if any of
+them pulls in one of the heavy SDKs.
+
+Usage: python benchmarks/startup.py [--runs N] [--budget-ms MS] [--json]
+"""
+import os
+import re
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# (statement, top-level module whose cumulative import time is reported)
+TARGETS = [
+    ("import mug_core", "mug_core"),
+    ("import mug_core.main", "mug_core.main"),
+    ("import mug_core.session_log", "mug_core.session_log"),
+    ("import mug_core.api", "mug_core.api"),
+    ("import mug_core.chatgpt", "mug_core.chatgpt"),
+]
+# None of these may be imported by any target: the SDKs are imported by the functions that
+# talk to S3 or the LLM, so local questions and hook calls never pay for them.
+HEAVY_MODULES = ["boto3", "botocore", "openai", "tiktoken", "httpx"]
+DEFAULT_RUNS = 15
+DEFAULT_BUDGET_MS = 50.0
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$')
+
+def measure(statement, runs):
+    """
+    Runs `statement` in fresh interpreters and returns the per-run cumulative import times
+    (in ms) of every module, keyed by module name. Raises RuntimeError if the import fails,
+    e.g. because it needs an SDK that is not installed.
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.getenv("PYTHONPATH")])))
+    samples = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", statement],
+                                env=env, capture_output=True, text=True)
+        if result.returncode != 0:
+            raise RuntimeError(result.stderr.strip().splitlines()[-1])
+        modules = {}
+        for line in result.stderr.splitlines():
+            match = IMPORTTIME_LINE.match(line)
+            if match:
+                modules[match.group(4)] = int(match.group(2)) / 1000.0
+        samples.append(modules)
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure mug_core import time.")
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="Interpreter starts per target.")
+    parser.add_argument("--budget-ms", type=float, default=DEFAULT_BUDGET_MS, help="Budget for `import mug_core`.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    options = parser.parse_args()
+
+    results = []
+    failures = []
+    for statement, module in TARGETS:
+        try:
+            samples = measure(statement, options.runs)
+        except RuntimeError as e:
+            failures.append(f"`{statement}` fails: {e}")
+            continue
+        times = [sample.get(module, 0.0) for sample in samples]
+        heavy = sorted({name for sample in samples for name in sample if name.split(".")[0] in HEAVY_MODULES})
+        results.append({
+            "statement": statement,
+            "median_ms": statistics.median(times),
+            "max_ms": max(times),
+            "heavy_imports": sorted({name.split(".")[0] for name in heavy}),
+        })
+
+    top = results[0] if results and results[0]["statement"] == TARGETS[0][0] else None
+    if top and top["median_ms"] > options.budget_ms:
+        failures.append(f"`{top['statement']}` took {top['median_ms']:.1f} ms, over the {options.budget_ms:.0f} ms budget")
+    for result in results:
+        if result["heavy_imports"]:
+            failures.append(f"`{result['statement']}` imports {', '.join(result['heavy_imports'])}")
+
+    if options.json:
+        print(json.dumps({"runs": options.runs, "budget_ms": options.budget_ms, "results": results, "failures": failures}, indent=2))
+    else:
+        for result in results:
+            heavy = ", ".join(result["heavy_imports"]) or "-"
+            print(f"{result['statement']:<32} median {result['median_ms']:7.1f} ms  max {result['max_ms']:7.1f} ms  heavy: {heavy}")
+        for failure in failures:
+            print(f"FAIL: {failure}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
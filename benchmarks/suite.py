@@ -0,0 +1,345 @@
+"""
+Benchmark suite for the hot paths of a session, against synthetic sessions and local
+stand-ins for S3 and OpenAI (see sessions.py and fake_servers.py):
+
+- hook:    per-command overhead of the processes the shell hook starts around a command
+- context: build time and peak memory of the recent-log, retrieval and load_session_log contexts
+- sync:    full upload/download throughput and the cost of one incremental push
+- llm:     round trip to a streaming chat completions server, minus the server's own delays
+
+Everything runs under a temporary HOME, so ~/.mug is never touched. Results can be written
+as JSON and compared with an earlier run to spot regressions between versions.
+
+Usage: python benchmarks/suite.py [--only hook,context,sync,llm] [--commands N] [--output-bytes N]
+           [--hosts N] [--runs N] [--sync-mb 1,16] [--s3-endpoint URL] [--json] [--output FILE] [--compare FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import importlib.util
+import statistics
+import subprocess
+import tracemalloc
+from contextlib import redirect_stdout
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARKS_DIR)
+BENCHMARK_NAMES = ["hook", "context", "sync", "llm"]
+QUESTION = "why did the build fail"
+BUCKET = "mug-bench"
+# A result counts as a regression when its median is this much slower than the baseline's.
+REGRESSION_THRESHOLD = 0.10
+
+def timings(samples):
+    """
+    Summarizes durations in seconds as milliseconds.
+    """
+    ordered = sorted(samples)
+    return {
+        "median_ms": statistics.median(ordered) * 1000,
+        "p95_ms": ordered[min(int(len(ordered) * 0.95), len(ordered) - 1)] * 1000,
+        "min_ms": ordered[0] * 1000,
+        "runs": len(ordered),
+    }
+
+def measure(function, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    return samples
+
+def measure_memory(function):
+    """
+    Returns the peak Python heap allocation of one call, in MB.
+    """
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+    finally:
+        tracemalloc.stop()
+
+def run_process(argv, env, runs):
+    return measure(lambda: subprocess.run(argv, env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                          stderr=subprocess.DEVNULL, check=False), runs)
+
+def bench_hook(options, workdir):
+    """
+    Times the processes the hook runs for one command, minus the command itself.
+    The full zsh hook is timed too when zsh and the mug_core script are installed.
+    """
+    from sessions import generate_session
+    from fake_servers import FakeS3Server
+
+    log_dir = os.path.join(workdir, ".mug")
+    text_log = os.path.join(log_dir, "session_log_1.txt")
+    structured_log = os.path.join(log_dir, "session_log_2.txt")
+    generate_session(text_log, options.commands, options.output_bytes, options.hosts, "text")
+    generate_session(structured_log, options.commands, options.output_bytes, options.hosts, "structured")
+    output_file = os.path.join(workdir, "output.txt")
+    with open(output_file, 'w') as file:
+        file.write("hello\n")
+
+    results = {}
+    with FakeS3Server() as s3:
+        env = dict(os.environ, AWS_ENDPOINT_URL=options.s3_endpoint or s3.url)
+        baseline = run_process(["true"], env, options.runs)
+        cases = {
+            "capture": [sys.executable, "-m", "mug_core.main", "capture", "--log", text_log, "--", "true"],
+            "record": [sys.executable, "-m", "mug_core.main", "record", "--log", structured_log,
+                       "--output-file", output_file, "--status", "0", "--start", "1", "--end", "2", "--", "echo", "hello"],
+            "enqueue_upload": [sys.executable, "-c",
+                               f"import mug_core; mug_core.enqueue_upload('{BUCKET}', '{text_log}', 'bench.txt', 'full')"],
+        }
+        zsh = shutil.which("zsh")
+        if zsh and shutil.which("mug_core"):
+            from mug_core import get_command_hook_path
+            with open(os.path.join(log_dir, "config.json"), 'w') as config_file:
+                json.dump({"SESSION_LOG_NAME": "session_log_1.txt", "NO_AWS": "true"}, config_file)
+            cases["zsh_hook"] = [zsh, "-c", f"source {get_command_hook_path()}; execute_with_redirection true"]
+        else:
+            results["zsh_hook"] = {"skipped": "zsh or the mug_core script is not installed"}
+
+        for name, argv in cases.items():
+            run_process(argv, env, 1)
+            samples = run_process(argv, env, options.runs)
+            results[name] = timings(samples)
+            results[name]["overhead_ms"] = (statistics.median(samples) - statistics.median(baseline)) * 1000
+        # Let the uploaders started by enqueue_upload finish before the stand-in goes away.
+        subprocess.run([sys.executable, "-m", "mug_core.main", "upload", "flush"], env=env,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return results
+
+def bench_context(options, workdir):
+    """
+    Times context building over a text and a structured session, cold (first call, which
+    builds the offset and retrieval indexes) and warm, with the peak memory of a warm call.
+    """
+    from sessions import generate_session
+    from mug_core import api
+    from mug_core.context import build_context
+    from mug_core.retrieval import build_retrieval_context
+
+    results = {}
+    for log_format, number in (("text", 11), ("structured", 12)):
+        log_path = os.path.join(workdir, ".mug", f"session_log_{number}.txt")
+        size = generate_session(log_path, options.commands, options.output_bytes, options.hosts, log_format)
+        with open(api.CONFIG_PATH, 'w') as config_file:
+            json.dump({"SESSION_LOG_NAME": os.path.basename(log_path), "NO_AWS": "true"}, config_file)
+
+        cases = {
+            "recent": lambda: build_context(log_path),
+            "retrieval": lambda: build_retrieval_context(log_path, QUESTION),
+            "load_session_log": lambda: api.load_session_log(question=QUESTION),
+        }
+        format_results = {"log_bytes": size}
+        for name, function in cases.items():
+            cold = measure(function, 1)[0]
+            format_results[name] = timings(measure(function, options.runs))
+            format_results[name]["cold_ms"] = cold * 1000
+            format_results[name]["peak_mb"] = measure_memory(function)
+        results[log_format] = format_results
+    return results
+
+def bench_sync(options, workdir):
+    """
+    Measures full-mode upload and download throughput for logs of each --sync-mb size,
+    and the time to push one new command in incremental mode.
+    """
+    from sessions import generate_session
+    from fake_servers import FakeS3Server
+    from mug_core import aws_s3
+    from mug_core.session_log import format_record, make_record
+
+    results = {}
+    with FakeS3Server() as s3:
+        os.environ["AWS_ENDPOINT_URL"] = options.s3_endpoint or s3.url
+        aws_s3._s3_client = None
+        client = aws_s3.get_s3_client()
+        try:
+            client.create_bucket(Bucket=BUCKET)
+        except Exception:
+            pass
+
+        for megabytes in options.sync_mb:
+            commands = max(int(megabytes * 1024 * 1024 / max(options.output_bytes, 1)), 1)
+            log_path = os.path.join(workdir, ".mug", f"sync_{megabytes}.txt")
+            size = generate_session(log_path, commands, options.output_bytes, options.hosts, "text")
+            key = f"bench/sync_{megabytes}.txt"
+            upload = measure(lambda: aws_s3.sync_local_to_s3(BUCKET, log_path, key), options.runs)
+            download = measure(lambda: aws_s3.sync_s3_to_local(BUCKET, key, f"{log_path}.copy"), options.runs)
+            results[f"{megabytes}mb"] = {
+                "bytes": size,
+                "upload": dict(timings(upload), mb_per_s=size / statistics.median(upload) / (1024 * 1024)),
+                "download": dict(timings(download), mb_per_s=size / statistics.median(download) / (1024 * 1024)),
+            }
+
+        log_path = os.path.join(workdir, ".mug", "sync_incremental.txt")
+        generate_session(log_path, options.commands, options.output_bytes, options.hosts, "text")
+        key = "bench/sync_incremental.txt"
+        aws_s3.sync_local_to_s3_incremental(BUCKET, log_path, key)
+
+        def push_one_command():
+            with open(log_path, 'a') as log_file:
+                log_file.write(format_record(make_record(["echo", "hello"], "hello\n", 0, host=None)))
+            aws_s3.sync_local_to_s3_incremental(BUCKET, log_path, key)
+        results["incremental_push"] = timings(measure(push_one_command, options.runs))
+    return results
+
+def bench_llm(options, workdir):
+    """
+    Asks questions through ask_chatgpt against a fake streaming server. `overhead_ms` is the
+    round trip minus the delays the server adds itself.
+    """
+    if importlib.util.find_spec("httpx") is None:
+        return {"skipped": "httpx is not installed"}
+    from fake_servers import FakeOpenAIServer
+    from mug_core import llm_backends
+    from mug_core.chatgpt import ask_chatgpt
+
+    tokens, first_token_delay, token_gap = 200, 0.05, 0.002
+    with FakeOpenAIServer(tokens, first_token_delay, token_gap) as server:
+        os.environ.update(LLM_BACKEND="openai", OPENAI_BASE_URL=f"{server.url}/v1", OPENAI_API_KEY="bench")
+        os.environ.pop("LLM_HEDGE_BACKEND", None)
+        llm_backends._backends.clear()
+        context = "Input:\n- make test\n\nOutput:\nFAILED tests/test_app.py::test_login\n" * 50
+        first_tokens = []
+        totals = []
+        for _ in range(options.runs + 1):
+            started = time.perf_counter()
+            first = []
+            ask_chatgpt(QUESTION, context, on_token=lambda text: first or first.append(time.perf_counter() - started))
+            first_tokens.append(first[0] if first else float("nan"))
+            totals.append(time.perf_counter() - started)
+        # The first request also opens the connection; report it separately.
+        server_time = first_token_delay + token_gap * (tokens - 1)
+        return {
+            "first_request_ms": totals[0] * 1000,
+            "time_to_first_token": timings(first_tokens[1:]),
+            "total": timings(totals[1:]),
+            "overhead_ms": (statistics.median(totals[1:]) - server_time) * 1000,
+        }
+
+BENCHMARKS = {
+    "hook": bench_hook,
+    "context": bench_context,
+    "sync": bench_sync,
+    "llm": bench_llm,
+}
+
+def flatten(results, prefix=""):
+    """
+    Yields (path, value) for every median in a result tree, e.g. ("context.text.recent", 12.3).
+    """
+    for name, value in results.items():
+        path = f"{prefix}.{name}" if prefix else name
+        if isinstance(value, dict):
+            if "median_ms" in value:
+                yield path, value["median_ms"]
+            yield from flatten({key: item for key, item in value.items() if isinstance(item, dict)}, path)
+
+def find_notes(results, prefix=""):
+    """
+    Yields (path, note) for every benchmark that was skipped or failed.
+    """
+    for name, value in results.items():
+        path = f"{prefix}.{name}" if prefix else name
+        if isinstance(value, dict):
+            for key in ("skipped", "error"):
+                if key in value:
+                    yield path, f"{key}: {value[key]}"
+            yield from find_notes(value, path)
+
+def compare(results, baseline):
+    """
+    Returns one line per benchmark present in both runs, marking regressions.
+    """
+    previous = dict(flatten(baseline.get("results", {})))
+    lines = []
+    for path, median in flatten(results):
+        if path not in previous or not previous[path]:
+            continue
+        change = (median - previous[path]) / previous[path]
+        flag = "  REGRESSION" if change > REGRESSION_THRESHOLD else ""
+        lines.append(f"{path:<48} {previous[path]:9.2f} -> {median:9.2f} ms ({change:+.0%}){flag}")
+    return lines
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the mug hot paths.")
+    parser.add_argument("--only", default=",".join(BENCHMARK_NAMES), help="Comma-separated benchmarks to run.")
+    parser.add_argument("--commands", type=int, default=500, help="Commands in each synthetic session.")
+    parser.add_argument("--output-bytes", type=int, default=2048, help="Mean output size per command.")
+    parser.add_argument("--hosts", type=int, default=3, help="Hosts in each synthetic session.")
+    parser.add_argument("--runs", type=int, default=10, help="Repetitions per measurement.")
+    parser.add_argument("--sync-mb", default="1,16", help="Comma-separated log sizes for the sync benchmark.")
+    parser.add_argument("--s3-endpoint", help="A MinIO or other S3-compatible endpoint to use instead of the stand-in.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    parser.add_argument("--output", help="Also write the JSON results to this file.")
+    parser.add_argument("--compare", help="A JSON results file of an earlier run to compare with.")
+    options = parser.parse_args()
+    options.sync_mb = [float(size) if "." in size else int(size) for size in options.sync_mb.split(",")]
+    names = [name.strip() for name in options.only.split(",") if name.strip()]
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark '{name}'; choose from {', '.join(BENCHMARK_NAMES)}")
+
+    workdir = tempfile.mkdtemp(prefix="mug-bench-")
+    # Before mug_core is imported: its paths under ~/.mug are resolved at import time.
+    os.environ.update(HOME=workdir, SUMMARIES="false", RESPONSE_CACHE="false", SYNC_MODE="full",
+                      AWS_ACCESS_KEY_ID=os.getenv("BENCH_AWS_ACCESS_KEY_ID", "bench"),
+                      AWS_SECRET_ACCESS_KEY=os.getenv("BENCH_AWS_SECRET_ACCESS_KEY", "bench"),
+                      AWS_DEFAULT_REGION=os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+                      MUG_AGENT_SOCKET=os.path.join(workdir, "no-agent.sock"),
+                      PYTHONPATH=os.pathsep.join(filter(None, [REPO_ROOT, os.getenv("PYTHONPATH")])))
+    os.makedirs(os.path.join(workdir, ".mug"))
+    sys.path[:0] = [REPO_ROOT, BENCHMARKS_DIR]
+    import mug_core
+
+    results = {}
+    try:
+        # The syncs report every transfer; keep that out of the results.
+        with open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+            for name in names:
+                try:
+                    results[name] = BENCHMARKS[name](options, workdir)
+                except Exception as e:
+                    results[name] = {"error": f"{type(e).__name__}: {e}"}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "version": mug_core.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "parameters": {"commands": options.commands, "output_bytes": options.output_bytes, "hosts": options.hosts,
+                       "runs": options.runs, "sync_mb": options.sync_mb},
+        "results": results,
+    }
+    if options.output:
+        with open(options.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if options.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for path, median in flatten(results):
+            print(f"{path:<48} {median:9.2f} ms")
+        for path, reason in find_notes(results):
+            print(f"{path}: {reason}")
+    if options.compare:
+        with open(options.compare, 'r') as baseline_file:
+            baseline = json.load(baseline_file)
+        print(f"\nCompared with {baseline.get('version')} ({options.compare}):")
+        for line in compare(results, baseline):
+            print(line)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,49 @@
-from .aws_s3 import sync_s3_to_local, sync_local_to_s3
+import os
+import importlib
+
+# Keep in step with the version in setup.py.
+__version__ = "0.1"
+
+# The public functions are imported on first use (PEP 562), so `import mug_core` stays cheap:
+# boto3 and openai each take hundreds of milliseconds to import, and the shell hook imports
+# this package for things like script paths that need neither.
+# benchmarks/startup.py checks that this stays under budget.
+_LAZY_ATTRIBUTES = {
+    "sync_s3_to_local": ".aws_s3",
+    "sync_local_to_s3": ".aws_s3",
+    "sync_session_from_s3": ".aws_s3",
+    "sync_session_to_s3": ".aws_s3",
+    "ask_chatgpt_batch": ".batch",
+    "enqueue_upload": ".upload_queue",
+    "get_storage_backend": ".storage",
+}
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
+
+def __getattr__(name):
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name], __name__), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
 
 def get_command_hook_path():
     """
     Returns the path to the command_hook.sh script.
     """
-    import pkg_resources
-    return pkg_resources.resource_filename('mug_core', 'scripts/command_hook.sh')
+    return os.path.join(SCRIPTS_DIR, "command_hook.sh")
 
 def get_command_unset_path():
     """
     Returns the path to the command_unset.sh script.
     """
-    import pkg_resources
-    return pkg_resources.resource_filename('mug_core', 'scripts/command_unset.sh')
+    return os.path.join(SCRIPTS_DIR, "command_unset.sh")
+
+def get_agent_client_path():
+    """
+    Returns the path to the agent_client.py script.
+    """
+    return os.path.join(SCRIPTS_DIR, "agent_client.py")
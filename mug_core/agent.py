@@ -0,0 +1,353 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import importlib
+import threading
+import contextlib
+import subprocess
+import socketserver
+
+from .paths import LOG_DIR
+
+AGENT_SOCKET = os.getenv("MUG_AGENT_SOCKET", os.path.join(LOG_DIR, "agent.sock"))
+AGENT_PID_FILE = os.path.join(LOG_DIR, "agent.pid")
+AGENT_LOG_FILE = os.path.join(LOG_DIR, "agent.log")
+AGENT_START_TIMEOUT = 10.0
+
+# The agent serves each connection in its own thread, so a streaming answer or a slow S3
+# sync never holds up another shell's hook. Requests that write a session log (or its
+# indexes) take that log's lock, so they still run one at a time per log.
+_log_locks = {}
+_log_locks_guard = threading.Lock()
+# The client a thread is serving, for output printed below the handlers (see ClientOutput).
+_client = threading.local()
+
+def get_log_lock(local_file):
+    with _log_locks_guard:
+        return _log_locks.setdefault(os.path.abspath(local_file), threading.Lock())
+
+def refresh_retrieval_index(local_file, out):
+    # Keeping the index current here means questions never wait on indexing.
+    from .retrieval import update_retrieval_index
+    try:
+        update_retrieval_index(local_file).close()
+    except Exception as e:
+        print(f"Error updating the retrieval index: {e}", file=out)
+
+def refresh_summaries(local_file):
+    from .summarize import start_background_summary
+    start_background_summary(local_file, in_thread=True)
+
+def handle_ping(request, out):
+    return f"mug agent {os.getpid()} is running."
+
+def handle_sync_from(request, out):
+    from .storage import S3Storage
+    with get_log_lock(request["local_file"]):
+        S3Storage(request["bucket"]).sync_from(request["local_file"], request["key"], request.get("mode"))
+        refresh_retrieval_index(request["local_file"], out)
+    refresh_summaries(request["local_file"])
+
+def handle_sync_to(request, out):
+    from .upload_queue import enqueue_upload
+    enqueue_upload(request["bucket"], request["local_file"], request["key"], request.get("mode"))
+
+def handle_log(request, out):
+    from .session_log import append_to_log
+    with get_log_lock(request["local_file"]):
+        append_to_log(request["local_file"], request["text"].encode())
+
+def handle_record(request, out):
+    from .dedup import dedupe_record
+    from .log_segments import maybe_rotate_session_log
+    from .session_log import append_record, make_record
+    argv = request.get("arg", [])
+    if not isinstance(argv, list):
+        argv = [argv]
+    with open(request["output_file"], 'r', errors='replace') as output_file:
+        output = output_file.read()
+    start = float(request["start"]) if request.get("start") else None
+    end = float(request["end"]) if request.get("end") else None
+    status = int(request["status"]) if request.get("status") else None
+    duration = end - start if start is not None and end is not None else None
+    from .speculate import maybe_start_analysis
+    with get_log_lock(request["local_file"]):
+        record = dedupe_record(request["local_file"], make_record(argv, output, status, start, duration))
+        append_record(request["local_file"], record)
+        maybe_rotate_session_log(request["local_file"])
+        maybe_start_analysis(request["local_file"], record)
+        refresh_retrieval_index(request["local_file"], out)
+    refresh_summaries(request["local_file"])
+
+def handle_ask(request, out):
+    from .api import load_session_log, load_session_log_file
+    from .chatgpt import print_chatgpt_response
+    from .speculate import find_prepared_analysis
+    local_file = load_session_log_file()
+    prepared = find_prepared_analysis(request["question"], local_file)
+    if prepared is not None:
+        out.write(f"ChatGPT response: {prepared}\n")
+        return
+    # The log lock covers building the context (which updates the retrieval index), not
+    # the answer: other shells keep recording while it streams.
+    with get_log_lock(local_file) if local_file else contextlib.nullcontext():
+        context = load_session_log(question=request["question"])
+    print_chatgpt_response(request["question"], context, out)
+
+HANDLERS = {
+    "ping": handle_ping,
+    "sync_from": handle_sync_from,
+    "sync_to": handle_sync_to,
+    "log": handle_log,
+    "record": handle_record,
+    "ask": handle_ask,
+}
+
+class StreamingWriter(io.TextIOBase):
+    """
+    The output of one request. Everything written is forwarded to the client right away,
+    as `{"chunk": ...}` lines, so streamed LLM responses show up as they arrive.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+
+    def write(self, text):
+        if text:
+            self.wfile.write((json.dumps({"chunk": text}) + "\n").encode())
+            self.wfile.flush()
+        return len(text)
+
+class ClientOutput(io.TextIOBase):
+    """
+    Installed once as sys.stdout and sys.stderr by serve(). Handlers write to the writer
+    they are given; this only routes what the code below them prints (an S3 sync's errors,
+    say) to the client whose request the printing thread serves, and everything else, like
+    background summaries, to the agent log.
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+
+    def write(self, text):
+        return (getattr(_client, "writer", None) or self.fallback).write(text)
+
+    def flush(self):
+        (getattr(_client, "writer", None) or self.fallback).flush()
+
+class AgentRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handles one request per connection: a single JSON line in, then an `{"accepted": true}`
+    line, any number of `{"chunk": ...}` lines with the handler's output, and a final
+    `{"ok": ...}` line.
+    """
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        writer = StreamingWriter(self.wfile)
+        try:
+            # A client that gave up waiting for this has closed the socket and run the
+            # request itself, so it must not be run here too.
+            self.wfile.write((json.dumps({"accepted": True}) + "\n").encode())
+            self.wfile.flush()
+        except BrokenPipeError:
+            return
+        ok = True
+        _client.writer = writer
+        try:
+            request = json.loads(line)
+            op = request.get("op")
+            if op == "shutdown":
+                writer.write("mug agent stopped.\n")
+                self.server.shutdown_requested = True
+            elif op in HANDLERS:
+                result = HANDLERS[op](request, writer)
+                if result:
+                    writer.write(f"{result}\n")
+            else:
+                ok = False
+                writer.write(f"Unknown agent operation: {op}\n")
+        except BrokenPipeError:
+            return
+        except Exception as e:
+            ok = False
+            writer.write(f"An error occurred in the mug agent: {e}\n")
+        finally:
+            _client.writer = None
+
+        try:
+            self.wfile.write((json.dumps({"ok": ok}) + "\n").encode())
+        except BrokenPipeError:
+            pass
+
+class AgentServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+    shutdown_requested = False
+    # The shutdown request is handled in its own thread, so the serve loop wakes up now
+    # and then to see it.
+    timeout = 0.5
+
+def serve(socket_path=AGENT_SOCKET):
+    """
+    Runs the agent in the foreground until a shutdown request arrives.
+    The S3 client and imported SDKs stay warm between requests.
+
+    Args:
+        socket_path (str): The Unix domain socket to listen on.
+
+    Returns:
+        None
+    """
+    # Pay for the SDK imports once, up front, instead of on the first hook call.
+    for module in ("api", "chatgpt"):
+        importlib.import_module(f".{module}", __package__)
+    from .aws_s3 import get_s3_client
+    try:
+        get_s3_client()
+    except Exception as e:
+        print(f"S3 client not available in mug agent: {e}")
+    from .llm_backends import get_backend
+    try:
+        get_backend()
+    except Exception as e:
+        print(f"LLM backend not available in mug agent: {e}")
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+
+    old_umask = os.umask(0o077)
+    try:
+        server = AgentServer(socket_path, AgentRequestHandler)
+    finally:
+        os.umask(old_umask)
+
+    with open(AGENT_PID_FILE, 'w') as pid_file:
+        pid_file.write(str(os.getpid()))
+    sys.stdout = ClientOutput(sys.stdout)
+    sys.stderr = ClientOutput(sys.stderr)
+
+    try:
+        while not server.shutdown_requested:
+            server.handle_request()
+    finally:
+        server.server_close()
+        for path in (socket_path, AGENT_PID_FILE):
+            if os.path.exists(path):
+                os.unlink(path)
+
+def send_request(request, socket_path=AGENT_SOCKET, timeout=None):
+    """
+    Sends a single request to a running agent.
+
+    Args:
+        request (dict): The request, with at least an "op" key.
+        socket_path (str): The agent's Unix domain socket.
+        timeout (float): Socket timeout in seconds, or None to wait forever.
+
+    Returns:
+        dict: The agent's response, with everything it printed collected under "output".
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        output = []
+        with sock.makefile('rb') as response_file:
+            for line in response_file:
+                message = json.loads(line)
+                if "chunk" in message:
+                    output.append(message["chunk"])
+                elif "accepted" not in message:
+                    return {"ok": message.get("ok", False), "output": "".join(output)}
+    raise ValueError("The mug agent closed the connection without a response.")
+
+def is_agent_running(socket_path=AGENT_SOCKET):
+    try:
+        return send_request({"op": "ping"}, socket_path, timeout=1.0)["ok"]
+    except (OSError, ValueError):
+        return False
+
+def start_agent(socket_path=AGENT_SOCKET):
+    """
+    Starts the agent as a detached background process unless one is already running.
+
+    Args:
+        socket_path (str): The Unix domain socket the agent should listen on.
+
+    Returns:
+        bool: True if an agent is running when this returns, False otherwise.
+    """
+    if is_agent_running(socket_path):
+        print("mug agent is already running.")
+        return True
+
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+
+    with open(AGENT_LOG_FILE, 'a') as agent_log:
+        subprocess.Popen(
+            [sys.executable, "-m", "mug_core.agent", "serve", socket_path],
+            stdin=subprocess.DEVNULL,
+            stdout=agent_log,
+            stderr=agent_log,
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + AGENT_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if is_agent_running(socket_path):
+            print(f"mug agent started on {socket_path}")
+            return True
+        time.sleep(0.05)
+
+    print(f"mug agent did not start. See {AGENT_LOG_FILE} for details.")
+    return False
+
+def stop_agent(socket_path=AGENT_SOCKET):
+    """
+    Asks a running agent to shut down.
+
+    Args:
+        socket_path (str): The agent's Unix domain socket.
+
+    Returns:
+        None
+    """
+    try:
+        response = send_request({"op": "shutdown"}, socket_path, timeout=5.0)
+        print(response["output"], end="")
+    except (OSError, ValueError):
+        print("mug agent is not running.")
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def agent_command(args):
+    """
+    Entry point for `mug_core agent <start|stop|status|serve>`.
+
+    Args:
+        args (list): The arguments after `agent`.
+
+    Returns:
+        None
+    """
+    action = args[0] if args else "status"
+    socket_path = args[1] if len(args) > 1 else AGENT_SOCKET
+    if action == "start":
+        start_agent(socket_path)
+    elif action == "stop":
+        stop_agent(socket_path)
+    elif action == "serve":
+        serve(socket_path)
+    elif action == "status":
+        if is_agent_running(socket_path):
+            print(send_request({"op": "ping"}, socket_path)["output"], end="")
+        else:
+            print("mug agent is not running.")
+    else:
+        print("Usage: mug_core agent [start | stop | status | serve]")
+
+if __name__ == "__main__":
+    agent_command(sys.argv[1:])
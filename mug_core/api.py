@@ -1,22 +1,76 @@
 import os
 import json
-from .chatgpt import set_openai_api_key, ask_chatgpt
-from .aws_s3 import get_aws_credentials, aws_menu, LOG_DIR
+import shlex
+from .chatgpt import set_openai_api_key
+from .paths import LOG_DIR
+from .context import build_context, count_tokens, get_context_token_budget
+from .retrieval import build_retrieval_context
+from .speculate import get_analysis_context
+from .storage import STORAGE_S3, STORAGE_SHARED, get_session_file, get_storage_name, storage_menu
+from .summarize import build_digest_context, start_background_summary
+from .tracing import span
 
 CONFIG_PATH = os.path.join(LOG_DIR, "config.json")
+MANIFEST_PATH = os.path.join(LOG_DIR, "session.env")
+
+# (mtime_ns, size) of config.json and its parsed contents.
+_config_cache = None
 
 def load_existing_config():
     """
     Loads the existing config file from ~/.mug/config.json if it exists.
+    The file is parsed once per process and read again only when its mtime or size changes.
 
     Returns:
         dict: The configuration dictionary if the file exists, otherwise None.
     """
-    if os.path.exists(CONFIG_PATH):
+    global _config_cache
+    try:
+        stat = os.stat(CONFIG_PATH)
+    except OSError:
+        return None
+    signature = (stat.st_mtime_ns, stat.st_size)
+    if _config_cache is None or _config_cache[0] != signature:
         with open(CONFIG_PATH, 'r') as config_file:
-            config = json.load(config_file)
-            return config
-    return None
+            _config_cache = (signature, json.load(config_file))
+    return dict(_config_cache[1])
+
+def write_session_manifest(config=None):
+    """
+    Compiles the config into ~/.mug/session.env, a file of shell assignments that
+    command_hook.sh sources instead of starting a python3 for every setting.
+
+    Args:
+        config (dict): The configuration. Defaults to the saved one.
+
+    Returns:
+        str: The path of the manifest.
+    """
+    from . import get_command_hook_path, get_command_unset_path
+    config = config if config is not None else load_existing_config() or {}
+    session_log_name = config.get("SESSION_LOG_NAME") or ""
+    values = {
+        "SESSION_FILE": get_session_file(config),
+        "STORAGE_BACKEND": get_storage_name(config),
+        "BUCKET_NAME": config.get("BUCKET_NAME") or "",
+        # Sessions created before the sessions/ prefix keep their top-level key.
+        "S3_KEY": config.get("S3_KEY") or session_log_name,
+        "NO_AWS": str(config.get("NO_AWS", False)),
+        "SYNC_MODE": config.get("SYNC_MODE") or "full",
+        "LOG_FORMAT": config.get("LOG_FORMAT") or "text",
+        "MUG_COMMAND_HOOK": get_command_hook_path(),
+        "MUG_COMMAND_UNSET": get_command_unset_path(),
+    }
+    lines = ["# Compiled from ~/.mug/config.json by mug_core. Do not edit; it is regenerated when the config changes."]
+    lines += [f"{key}={shlex.quote(value)}" for key, value in values.items()]
+
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    tmp_path = f"{MANIFEST_PATH}.tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        manifest_file.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, MANIFEST_PATH)
+    return MANIFEST_PATH
 
 def use_existing_config(config):
     """
@@ -45,8 +99,13 @@ def save_config():
         "AWS_ACCESS_KEY_ID": os.getenv("AWS_ACCESS_KEY_ID"),
         "AWS_SECRET_ACCESS_KEY": os.getenv("AWS_SECRET_ACCESS_KEY"),
         "SESSION_LOG_NAME": os.getenv("SESSION_LOG_NAME"),
+        "S3_KEY": os.getenv("S3_KEY"),
         "BUCKET_NAME": os.getenv("BUCKET_NAME"),
-        "NO_AWS": os.getenv("NO_AWS", "true")
+        "NO_AWS": os.getenv("NO_AWS", "true"),
+        "STORAGE_BACKEND": os.getenv("STORAGE_BACKEND"),
+        "SHARED_DIR": os.getenv("SHARED_DIR"),
+        "SYNC_MODE": os.getenv("SYNC_MODE", "full"),
+        "LOG_FORMAT": os.getenv("LOG_FORMAT", "text")
     }
 
     if not os.path.exists(LOG_DIR):
@@ -82,25 +141,43 @@ def load_session_log_file():
     try:
         config = load_existing_config()
         if config:
-            session_log_name = config.get("SESSION_LOG_NAME")
-            if session_log_name:
-                return os.path.join(LOG_DIR, session_log_name)
+            return get_session_file(config) or None
     except Exception as e:
         print(f"Error loading session log file from config: {e}")
     return None
 
-def load_session_log():
+def load_session_log(token_budget=None, question=None):
     """
-    Loads the content of the session log file.
+    Loads the part of the session log that fits in the token budget.
+    Without a question this is the most recent entries. With one, the entries most
+    relevant to it are added from the session's retrieval index.
+    Digests of older history come first when the session has any, and a prepared
+    analysis of the newest command, if it failed, comes last (see speculate.py).
+    Structured logs are rendered back to the `Input:` / `Output:` text form.
+
+    Args:
+        token_budget (int): Maximum tokens of log to return. Defaults to CONTEXT_TOKEN_BUDGET.
+        question (str): The question the context is for, if any.
 
     Returns:
-        str: The content of the session log file if it exists, otherwise an empty string.
+        str: The selected session log entries if the log exists, otherwise an empty string.
     """
     session_file = load_session_log_file()
     if session_file and os.path.exists(session_file):
         try:
-            with open(session_file, 'r') as log_file:
-                return log_file.read()
+            with span("context.load"):
+                digests = build_digest_context(session_file, token_budget)
+                analysis = get_analysis_context(question, session_file) if question else ""
+                budget = token_budget if token_budget is not None else get_context_token_budget()
+                budget -= count_tokens(digests) + count_tokens(analysis)
+                if question and os.getenv("RETRIEVAL", "true") == "true":
+                    context = build_retrieval_context(session_file, question, budget)
+                else:
+                    context = build_context(session_file, budget)
+            start_background_summary(session_file)
+            if digests and context:
+                return f"{digests}\nRecent session log:\n{context}{analysis}"
+            return (digests or context) + analysis
         except Exception as e:
             print(f"Error reading session log: {e}")
     return ""
@@ -108,6 +185,7 @@ def load_session_log():
 def is_valid_config(config):
     """
     Checks if the config contains valid values for required keys.
+    Which keys are required depends on the storage backend.
 
     Args:
         config (dict): The configuration dictionary.
@@ -115,13 +193,12 @@ def is_valid_config(config):
     Returns:
         bool: True if all required keys have non-empty values, False otherwise.
     """
-    required_keys = [
-        "OPENAI_API_KEY",
-        "AWS_ACCESS_KEY_ID",
-        "AWS_SECRET_ACCESS_KEY",
-        "SESSION_LOG_NAME",
-        "BUCKET_NAME"
-    ]
+    required_keys = ["OPENAI_API_KEY", "SESSION_LOG_NAME"]
+    storage = get_storage_name(config)
+    if storage == STORAGE_S3:
+        required_keys += ["AWS_ACCESS_KEY_ID", "AWS_SECRET_ACCESS_KEY", "BUCKET_NAME"]
+    elif storage == STORAGE_SHARED:
+        required_keys.append("SHARED_DIR")
     for key in required_keys:
         if not config.get(key):
             return False
@@ -145,6 +222,7 @@ def set_api_keys():
             use_existing = input("Would you like to use the existing configuration? (y/n): ").lower()
             if use_existing == 'y':
                 use_existing_config(existing_config)
+                write_session_manifest(existing_config)
                 print("Using existing configuration.")
                 return
         else:
@@ -153,11 +231,11 @@ def set_api_keys():
     # Step 1: Set OpenAI API Key
     set_openai_api_key()
 
-    # Step 2: AWS setup and log creation
-    if get_aws_credentials():
-        aws_menu()
+    # Step 2: Storage (S3, shared directory or local) and log creation
+    storage_menu()
 
     # Step 3: Save new configuration to JSON
     save_config()
+    write_session_manifest()
     print("New configuration has been saved, overwriting the existing config if it existed.")
 
@@ -1,12 +1,65 @@
 import os
 import re
 import json
-import boto3
+import time
+import fcntl
+import random
+import socket
+import getpass
 import configparser
-
-from botocore.exceptions import NoCredentialsError, PartialCredentialsError
-
-LOG_DIR = os.path.expanduser("~/.mug")
+import email.utils
+from contextlib import contextmanager
+
+from .log_segments import MANIFEST_NAME, SEGMENTS_SUFFIX, get_segments_dir, load_manifest, new_manifest, save_manifest
+from .paths import LOCAL_COUNTER_PATH, LOG_DIR
+from .tracing import span
+
+# "full" re-transfers the whole log on every sync, "incremental" only moves new entries.
+SYNC_MODE_FULL = "full"
+SYNC_MODE_INCREMENTAL = "incremental"
+# In incremental mode every participant appends by creating its own
+# `<s3_key>.entries/<ms timestamp>-<writer>-<seq>` object, which is never overwritten.
+# Readers merge the entries in key order. Entries older than ENTRY_GRACE_MS are folded
+# into the main log object once COMPACT_ENTRY_COUNT of them have piled up.
+# Entry timestamps are on S3's clock, not the writer's: each writer keeps the offset between
+# the two, from the Date header of S3's responses, so a host whose clock is off does not
+# write entries that readers and compaction take for older than they are.
+ENTRY_SUFFIX = ".entries/"
+COMPACTION_SUFFIX = ".compaction.json"
+COMPACT_ENTRY_COUNT = 64
+ENTRY_GRACE_MS = 5 * 60 * 1000
+
+# Session logs live under SESSIONS_PREFIX. New session numbers are handed out by a small
+# catalog object holding the next free number and the most recent sessions, updated with
+# conditional writes, so starting a session costs a GET and a PUT however many the bucket holds.
+SESSIONS_PREFIX = "sessions/"
+CATALOG_KEY = f"{SESSIONS_PREFIX}catalog.json"
+CATALOG_RECENT = 20
+CATALOG_MAX_ATTEMPTS = 8
+SESSION_LOG_PATTERN = re.compile(r'session_log_(\d+)\.txt$')
+# Uploads at least this large go in parts, UPLOAD_CONCURRENCY of them at a time.
+DEFAULT_MULTIPART_MB = 8
+DEFAULT_UPLOAD_CONCURRENCY = 8
+
+_s3_client = None
+
+def get_s3_client():
+    global _s3_client
+    if _s3_client is None:
+        # boto3 takes a quarter of a second to import; only pay for it when S3 is used.
+        import boto3
+        _s3_client = boto3.client('s3')
+    return _s3_client
+
+def get_transfer_config():
+    from boto3.s3.transfer import TransferConfig
+    try:
+        part_size = int(float(os.getenv("UPLOAD_MULTIPART_MB", DEFAULT_MULTIPART_MB)) * 1024 * 1024)
+        concurrency = max(int(os.getenv("UPLOAD_CONCURRENCY", DEFAULT_UPLOAD_CONCURRENCY)), 1)
+    except ValueError:
+        part_size, concurrency = DEFAULT_MULTIPART_MB * 1024 * 1024, DEFAULT_UPLOAD_CONCURRENCY
+    return TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size,
+                          max_concurrency=concurrency, use_threads=True)
 
 def ensure_log_directory():
     if not os.path.exists(LOG_DIR):
@@ -55,8 +108,9 @@ def set_aws_credentials():
     return True
 
 def list_s3_buckets():
+    from botocore.exceptions import NoCredentialsError, PartialCredentialsError
     try:
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
         response = s3_client.list_buckets()
         print("S3 Buckets:")
         for i, bucket in enumerate(response['Buckets']):
@@ -72,13 +126,16 @@ def list_s3_buckets():
 
 def list_bucket_contents(bucket_name):
     try:
-        s3_client = boto3.client('s3')
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        if 'Contents' in response:
-            print(f"Contents of bucket '{bucket_name}':")
-            for obj in response['Contents']:
+        s3_client = get_s3_client()
+        paginator = s3_client.get_paginator('list_objects_v2')
+        empty = True
+        for page in paginator.paginate(Bucket=bucket_name):
+            for obj in page.get('Contents', []):
+                if empty:
+                    print(f"Contents of bucket '{bucket_name}':")
+                    empty = False
                 print(f"  {obj['Key']}")
-        else:
+        if empty:
             print(f"The bucket '{bucket_name}' is empty.")
     except Exception as e:
         print(f"An error occurred: {e}")
@@ -166,69 +223,174 @@ def aws_menu():
 
 def create_bucket(bucket_name):
     try:
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
         s3_client.create_bucket(Bucket=bucket_name)
         print(f"Bucket '{bucket_name}' created successfully.")
     except Exception as e:
         print(f"An error occurred while creating the bucket: {e}")
 
-def get_next_log_number(bucket_name):
-    try:
-        s3_client = boto3.client('s3')
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        if 'Contents' in response:
-            log_numbers = []
-            for obj in response['Contents']:
-                match = re.match(r'session_log_(\d+)\.txt', obj['Key'])
+def get_session_key(log_number):
+    return f"{SESSIONS_PREFIX}session_log_{log_number}.txt"
+
+def iter_session_objects(bucket_name):
+    """
+    Yields (number, object) for every session log in the bucket, under SESSIONS_PREFIX and at
+    the top level where older versions kept them. Objects are list_objects_v2 entries, with
+    their Key and ETag. Listing is paginated and limited to those prefixes, with the entry and
+    segment objects of each log rolled up by the delimiter.
+    """
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in (f"{SESSIONS_PREFIX}session_log_", "session_log_"):
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+            for obj in page.get('Contents', []):
+                match = SESSION_LOG_PATTERN.match(obj['Key'].rsplit('/', 1)[-1])
                 if match:
-                    log_numbers.append(int(match.group(1)))
-            if log_numbers:
-                return max(log_numbers) + 1
-        return 1
-    except Exception as e:
-        print(f"An error occurred while determining the next log number: {e}")
-        return 1
+                    yield int(match.group(1)), obj
+
+def iter_session_logs(bucket_name):
+    """
+    Yields (s3_key, etag, has_entries) for every session log in the bucket, like
+    iter_session_objects, but also for the logs of incremental sessions that have pending
+    entries, which the delimiter rolls up into a `<s3_key>.entries/` common prefix. `etag`
+    is None for a session whose entries were never compacted into a log object.
+    """
+    s3_client = get_s3_client()
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for prefix in (f"{SESSIONS_PREFIX}session_log_", "session_log_"):
+        etags = {}
+        pending = set()
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter="/"):
+            for obj in page.get('Contents', []):
+                if SESSION_LOG_PATTERN.match(obj['Key'].rsplit('/', 1)[-1]):
+                    etags[obj['Key']] = obj['ETag']
+            for common in page.get('CommonPrefixes', []):
+                s3_key = common['Prefix'][:-len(ENTRY_SUFFIX)]
+                if common['Prefix'].endswith(ENTRY_SUFFIX) and SESSION_LOG_PATTERN.match(s3_key.rsplit('/', 1)[-1]):
+                    pending.add(s3_key)
+        for s3_key in sorted(set(etags) | pending):
+            yield s3_key, etags.get(s3_key), s3_key in pending
+
+def iter_session_numbers(bucket_name):
+    for number, _ in iter_session_objects(bucket_name):
+        yield number
+
+def read_catalog(bucket_name):
+    """
+    Returns (catalog, etag) for the bucket's session catalog, or (None, None) if it has none.
+    """
+    from botocore.exceptions import ClientError
+    try:
+        data, etag = read_object(bucket_name, CATALOG_KEY)
+        return json.loads(data), etag
+    except ClientError as e:
+        if is_missing(e):
+            return None, None
+        raise
+
+def seed_catalog(bucket_name):
+    """
+    Builds the first catalog of a bucket from one paginated listing of its session logs.
+    This is the only time sessions are listed; afterwards the catalog is the source of truth.
+    """
+    numbers = sorted(set(iter_session_numbers(bucket_name)))
+    return {"next": numbers[-1] + 1 if numbers else 1, "recent": numbers[-CATALOG_RECENT:]}
+
+def get_next_log_number(bucket_name):
+    """
+    Allocates a new session number from the bucket's catalog. The catalog is rewritten with a
+    conditional PUT on the ETag it was read with, so two users starting sessions at the same
+    time can never get the same number; the loser of a race re-reads and tries again.
+
+    Args:
+        bucket_name (str): The bucket holding the sessions.
+
+    Returns:
+        int: The allocated session number.
+    """
+    from botocore.exceptions import ClientError
+    s3_client = get_s3_client()
+    for attempt in range(CATALOG_MAX_ATTEMPTS):
+        catalog, etag = read_catalog(bucket_name)
+        if catalog is None:
+            catalog = seed_catalog(bucket_name)
+        log_number = catalog["next"]
+        updated = {"next": log_number + 1, "recent": (catalog.get("recent", []) + [log_number])[-CATALOG_RECENT:]}
+        condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+        try:
+            s3_client.put_object(Bucket=bucket_name, Key=CATALOG_KEY, Body=json.dumps(updated).encode(), **condition)
+            return log_number
+        except ClientError as e:
+            if not is_precondition_failed(e):
+                raise
+        time.sleep(random.uniform(0, 0.05 * 2 ** attempt))
+    raise RuntimeError("The session catalog kept changing. Try again later.")
 
 def list_session_logs(bucket_name):
+    """
+    Returns the most recently created session logs from the catalog, without listing the bucket.
+    """
     try:
-        s3_client = boto3.client('s3')
-        response = s3_client.list_objects_v2(Bucket=bucket_name)
-        session_logs = []
-        if 'Contents' in response:
-            for obj in response['Contents']:
-                if re.match(r'session_log_\d+\.txt', obj['Key']):
-                    session_logs.append(obj['Key'])
-        return session_logs
+        catalog, _ = read_catalog(bucket_name)
+        if catalog is None:
+            catalog = seed_catalog(bucket_name)
+        return [f"session_log_{number}.txt" for number in catalog.get("recent", [])]
     except Exception as e:
         print(f"An error occurred while listing session logs: {e}")
         return []
 
+def resolve_session_key(bucket_name, log_number):
+    """
+    Returns the S3 key of an existing session: under SESSIONS_PREFIX, or at the top level
+    for sessions created by older versions.
+    """
+    from botocore.exceptions import ClientError
+    s3_key = get_session_key(log_number)
+    legacy_key = f"session_log_{log_number}.txt"
+    s3_client = get_s3_client()
+    for key in (s3_key, legacy_key):
+        try:
+            s3_client.head_object(Bucket=bucket_name, Key=key)
+            return key
+        except ClientError as e:
+            if not is_missing(e):
+                raise
+    return s3_key
+
 def list_local_session_logs():
     ensure_log_directory()
     local_logs = []
     for file in os.listdir(LOG_DIR):
-        if re.match(r'session_log_\d+\.txt', file):
+        if SESSION_LOG_PATTERN.match(file):
             local_logs.append(file)
     return local_logs
 
 def get_next_log_number_local():
-    local_logs = list_local_session_logs()
-    if local_logs:
-        log_numbers = []
-        for log in local_logs:
-            match = re.match(r'session_log_(\d+)\.txt', log)
-            if match:
-                log_numbers.append(int(match.group(1)))
-        if log_numbers:
-            return max(log_numbers) + 1
-    return 1
+    """
+    Allocates a new local session number from ~/.mug/session_counter.json, under a file lock.
+    The log directory is scanned only to create the counter.
+    """
+    ensure_log_directory()
+    with open(f"{LOCAL_COUNTER_PATH}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            with open(LOCAL_COUNTER_PATH, 'r') as counter_file:
+                log_number = json.load(counter_file)["next"]
+        except (OSError, ValueError, KeyError):
+            numbers = [int(SESSION_LOG_PATTERN.match(log).group(1)) for log in list_local_session_logs()]
+            log_number = max(numbers) + 1 if numbers else 1
+        tmp_path = f"{LOCAL_COUNTER_PATH}.tmp"
+        with open(tmp_path, 'w') as counter_file:
+            json.dump({"next": log_number + 1}, counter_file)
+        os.replace(tmp_path, LOCAL_COUNTER_PATH)
+    return log_number
 
 def use_bucket(bucket_name):
     ensure_log_directory()
     session_logs = list_session_logs(bucket_name)
 
     if session_logs:
-        print(f"Session logs available: {', '.join(session_logs)}")
+        print(f"Recent session logs: {', '.join(session_logs)}")
         choice = input("You can continue with an existing log or create a new one. Enter the log number (`session_log_{number}.txt`) to continue or 'n' for a new log: ")
         if choice.lower() == 'n':
             log_number = get_next_log_number(bucket_name)
@@ -243,31 +405,39 @@ def use_bucket(bucket_name):
         print(f"No session logs found. `session_log_{log_number}.txt` has been created.")
 
     local_file = os.path.join(LOG_DIR, f"session_log_{log_number}.txt")
-    s3_key = f"session_log_{log_number}.txt"
+    continuing = choice.lower() != 'n' and choice.isdigit()
+    s3_key = resolve_session_key(bucket_name, log_number) if continuing else get_session_key(log_number)
 
-    os.environ["SESSION_LOG_NAME"] = s3_key
+    os.environ["SESSION_LOG_NAME"] = f"session_log_{log_number}.txt"
+    os.environ["S3_KEY"] = s3_key
 
-    if choice.lower() != 'n' and choice.isdigit():
-        sync_s3_to_local(bucket_name, s3_key, local_file)
+    if continuing:
+        sync_session_from_s3(bucket_name, s3_key, local_file)
     else:
         with open(local_file, 'w') as file:
-            file.write("This is a session log.\n")
-        sync_s3_to_local(bucket_name, s3_key, local_file)
+            # Structured logs start empty; their format is detected from the first record.
+            if os.getenv("LOG_FORMAT", "text") != "structured":
+                file.write("This is a session log.\n")
+        sync_session_from_s3(bucket_name, s3_key, local_file)
         print(f"Created local log file: {local_file}")
 
-    sync_local_to_s3(bucket_name, local_file, s3_key)
+    sync_session_to_s3(bucket_name, local_file, s3_key)
 
 def sync_local_to_s3(bucket_name, local_file, s3_key):
     try:
-        s3_client = boto3.client('s3')
-        s3_client.upload_file(local_file, bucket_name, s3_key)
+        s3_client = get_s3_client()
+        sync_segments_to_s3(bucket_name, local_file, s3_key)
+        s3_client.upload_file(local_file, bucket_name, s3_key, Config=get_transfer_config())
         print(f"Synced local file '{local_file}' to S3 bucket '{bucket_name}' as '{s3_key}'.")
+        return True
     except Exception as e:
         print(f"An error occurred while syncing local file to S3: {e}")
+        return False
 
 def sync_s3_to_local(bucket_name, s3_key, local_file):
     try:
-        s3_client = boto3.client('s3')
+        s3_client = get_s3_client()
+        sync_segments_from_s3(bucket_name, s3_key, local_file)
         s3_client.download_file(bucket_name, s3_key, local_file)
         print(f"Synced S3 file '{s3_key}' from bucket '{bucket_name}' to local file '{local_file}'.")
     except s3_client.exceptions.NoSuchKey:
@@ -275,6 +445,508 @@ def sync_s3_to_local(bucket_name, s3_key, local_file):
     except Exception as e:
         print(f"An error occurred while syncing S3 file to local: {e}")
 
+def download_session_log(bucket_name, s3_key, local_file, with_entries=False):
+    """
+    Downloads a session log with its closed segments, quietly and letting errors propagate.
+    Used for the copies of bucket sessions that `mug --search` indexes. With `with_entries`
+    the pending entries of an incremental session are merged in after the log object.
+    """
+    sync_segments_from_s3(bucket_name, s3_key, local_file)
+    if not with_entries:
+        get_s3_client().download_file(bucket_name, s3_key, local_file)
+        return
+    data, _, _ = read_session_timeline(bucket_name, s3_key)
+    with open(local_file, 'wb') as file:
+        file.write(data or b"")
+
+def get_remote_manifest_key(s3_key):
+    return f"{s3_key}{SEGMENTS_SUFFIX}/{MANIFEST_NAME}"
+
+def sync_segments_to_s3(bucket_name, local_file, s3_key):
+    """
+    Uploads the closed segments of a rotated log that are not in S3 yet, then the manifest
+    listing them. Segments never change once closed, so each is uploaded exactly once and a
+    full sync only re-sends the live file.
+    """
+    manifest = load_manifest(local_file)
+    uploaded = set(manifest["uploaded"])
+    pending = [segment for segment in manifest["segments"] if segment["name"] not in uploaded]
+    if not pending:
+        return
+    s3_client = get_s3_client()
+    for segment in pending:
+        segment_path = os.path.join(get_segments_dir(local_file), segment["name"])
+        s3_client.upload_file(segment_path, bucket_name, f"{s3_key}{SEGMENTS_SUFFIX}/{segment['name']}",
+                              Config=get_transfer_config())
+    remote = {"format": manifest["format"], "segments": manifest["segments"]}
+    response = s3_client.put_object(Bucket=bucket_name, Key=get_remote_manifest_key(s3_key),
+                                    Body=json.dumps(remote).encode())
+    manifest["uploaded"] = [segment["name"] for segment in manifest["segments"]]
+    manifest["etag"] = response.get('ETag')
+    save_manifest(local_file, manifest)
+
+def sync_segments_from_s3(bucket_name, s3_key, local_file):
+    """
+    Brings the closed segments in line with the remote manifest before the live file is
+    downloaded. The manifest is fetched with a conditional GET, so an unchanged one costs
+    a 304; only segments missing locally (or differing, by checksum) are downloaded.
+    """
+    from botocore.exceptions import ClientError
+    manifest = load_manifest(local_file)
+    params = {"IfNoneMatch": manifest["etag"]} if manifest["etag"] else {}
+    try:
+        data, etag = read_object(bucket_name, get_remote_manifest_key(s3_key), **params)
+    except ClientError as e:
+        if get_error_code(e) in ("304", "NotModified"):
+            return
+        if not is_missing(e):
+            raise
+        if manifest["segments"] and set(manifest["uploaded"]) >= {segment["name"] for segment in manifest["segments"]}:
+            # The remote log was never rotated, so its live object is the whole log.
+            save_manifest(local_file, new_manifest())
+        return
+
+    remote = json.loads(data)
+    local = {segment["name"]: segment["crc"] for segment in manifest["segments"]}
+    s3_client = get_s3_client()
+    directory = get_segments_dir(local_file)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for segment in remote["segments"]:
+        if local.get(segment["name"]) != segment["crc"]:
+            s3_client.download_file(bucket_name, f"{s3_key}{SEGMENTS_SUFFIX}/{segment['name']}",
+                                    os.path.join(directory, segment["name"]))
+    manifest.update(format=remote.get("format"), segments=remote["segments"],
+                    uploaded=[segment["name"] for segment in remote["segments"]], etag=etag)
+    save_manifest(local_file, manifest)
+
+def get_sync_mode():
+    mode = os.getenv("SYNC_MODE", SYNC_MODE_FULL)
+    if mode not in (SYNC_MODE_FULL, SYNC_MODE_INCREMENTAL):
+        print(f"Unknown SYNC_MODE '{mode}', falling back to '{SYNC_MODE_FULL}'.")
+        return SYNC_MODE_FULL
+    return mode
+
+@contextmanager
+def locked_session(local_file, blocking=True):
+    """
+    Serializes syncs of one session log between the shell and the background uploader.
+    Yields whether the lock was taken; without `blocking`, it is not waited for.
+    """
+    with open(f"{local_file}.sync.lock", 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        yield True
+
+def sync_session_to_s3(bucket_name, local_file, s3_key, mode=None):
+    """
+    Uploads the session log now. The hook goes through upload_queue.enqueue_upload instead,
+    so the shell does not wait for S3.
+
+    Returns:
+        bool: True if the upload succeeded.
+    """
+    with locked_session(local_file), span("s3.upload"):
+        if (mode or get_sync_mode()) == SYNC_MODE_INCREMENTAL:
+            return sync_local_to_s3_incremental(bucket_name, local_file, s3_key)
+        # The live file is kept small by the log writers, which rotate it between commands
+        # (see log_segments.maybe_rotate_session_log); the uploader never cuts it, since
+        # the next command may already be appending.
+        return sync_local_to_s3(bucket_name, local_file, s3_key)
+
+def sync_session_from_s3(bucket_name, s3_key, local_file, mode=None):
+    from .upload_queue import has_pending_upload
+    incremental = (mode or get_sync_mode()) == SYNC_MODE_INCREMENTAL
+    if not incremental and has_pending_upload(local_file):
+        # The local copy is ahead of S3 until the queued upload lands; downloading now
+        # would throw away the commands still waiting to be uploaded.
+        return
+    # An upload in progress holds the lock; this pull is skipped rather than waited for,
+    # and the next command pulls again.
+    with locked_session(local_file, blocking=False) as locked:
+        if not locked:
+            return
+        with span("s3.download"):
+            if incremental:
+                sync_s3_to_local_incremental(bucket_name, s3_key, local_file)
+            else:
+                sync_s3_to_local(bucket_name, s3_key, local_file)
+
+def get_sync_state_path(local_file):
+    return f"{local_file}.sync.json"
+
+def new_sync_state():
+    """
+    `offset` is how many bytes of the local file are already accounted for remotely,
+    `etag` is the main object's ETag at the last pull, `applied` holds the entry keys
+    newer than `watermark - ENTRY_GRACE_MS` that are already in the local file.
+    `clock_offset_ms` is how far S3's clock is ahead of this host's, once known.
+    """
+    return {"offset": 0, "etag": None, "watermark": 0, "applied": [], "seq": 0, "since_compaction": 0, "clock_offset_ms": None}
+
+def load_sync_state(local_file):
+    state_path = get_sync_state_path(local_file)
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r') as state_file:
+                state = json.load(state_file)
+            if "applied" in state:
+                return state
+        except (OSError, ValueError):
+            pass
+    return new_sync_state()
+
+def save_sync_state(local_file, state):
+    state_path = get_sync_state_path(local_file)
+    tmp_path = f"{state_path}.tmp"
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file)
+    os.replace(tmp_path, state_path)
+
+def get_writer_id():
+    writer = f"{socket.gethostname()}.{getpass.getuser()}"
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', writer)
+
+def get_entry_key(s3_key, timestamp_ms, writer, seq):
+    return f"{s3_key}{ENTRY_SUFFIX}{timestamp_ms:013d}-{writer}-{seq:08d}"
+
+def get_clock_offset_ms(response, sent_ms):
+    """
+    Returns how far S3's clock is ahead of this host's, from the Date header of a response
+    to a request sent at `sent_ms`, or None if the response carries no date.
+    """
+    date = response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('date')
+    if not date:
+        return None
+    try:
+        server_ms = email.utils.parsedate_to_datetime(date).timestamp() * 1000
+    except (TypeError, ValueError):
+        return None
+    # The header has a one second resolution; the request's midpoint is the best local match.
+    return int(server_ms + 500 - (sent_ms + time.time() * 1000) / 2)
+
+def get_s3_time_ms(bucket_name, state):
+    """
+    Returns the current time on S3's clock, learning the offset to it with one HEAD of the
+    bucket the first time. If that fails, this host's clock is used until a later response
+    carries S3's.
+    """
+    from botocore.exceptions import ClientError
+    if state.get("clock_offset_ms") is None:
+        sent_ms = time.time() * 1000
+        try:
+            state["clock_offset_ms"] = get_clock_offset_ms(get_s3_client().head_bucket(Bucket=bucket_name), sent_ms)
+        except ClientError:
+            pass
+    return int(time.time() * 1000) + (state.get("clock_offset_ms") or 0)
+
+def get_entry_timestamp(entry_key):
+    return int(entry_key.rsplit('/', 1)[1][:13])
+
+def list_entries(bucket_name, s3_key, after_ms=0):
+    """
+    Returns the keys of all entries of `s3_key` with a timestamp after `after_ms`, in timeline order.
+    """
+    s3_client = get_s3_client()
+    prefix = f"{s3_key}{ENTRY_SUFFIX}"
+    params = {"Bucket": bucket_name, "Prefix": prefix}
+    if after_ms > 0:
+        params["StartAfter"] = f"{prefix}{after_ms:013d}"
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(**params):
+        for obj in page.get('Contents', []):
+            if get_entry_timestamp(obj['Key']) > after_ms:
+                keys.append(obj['Key'])
+    return sorted(keys)
+
+def get_error_code(error):
+    return str(error.response.get("Error", {}).get("Code", ""))
+
+def is_missing(error):
+    return get_error_code(error) in ("NoSuchKey", "404", "NotFound")
+
+def is_precondition_failed(error):
+    return get_error_code(error) in ("PreconditionFailed", "412", "ConditionalRequestConflict", "409")
+
+def read_object(bucket_name, key, **params):
+    s3_client = get_s3_client()
+    response = s3_client.get_object(Bucket=bucket_name, Key=key, **params)
+    return response['Body'].read(), response.get('ETag')
+
+def read_session_timeline(bucket_name, s3_key):
+    """
+    Merges the main log object and all pending entries into one ordered timeline.
+
+    Returns (data, etag, entry_keys); `data` is None if the session does not exist yet.
+    """
+    from botocore.exceptions import ClientError
+    try:
+        data, etag = read_object(bucket_name, s3_key)
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+        data, etag = None, None
+
+    entry_keys = list_entries(bucket_name, s3_key)
+    chunks = [data] if data else []
+    for key in entry_keys:
+        chunks.append(read_object(bucket_name, key)[0])
+    if data is None and not entry_keys:
+        return None, None, []
+    return b"".join(chunks), etag, entry_keys
+
+def check_main_object(bucket_name, s3_key, etag):
+    """
+    Returns (changed, head) for the main log object using a conditional HEAD.
+    `head` is None when the object does not exist.
+    """
+    from botocore.exceptions import ClientError
+    s3_client = get_s3_client()
+    params = {"Bucket": bucket_name, "Key": s3_key}
+    if etag:
+        params["IfNoneMatch"] = etag
+    try:
+        return True, s3_client.head_object(**params)
+    except ClientError as e:
+        code = get_error_code(e)
+        if code in ("304", "NotModified"):
+            return False, None
+        if is_missing(e):
+            return etag is not None, None
+        raise
+
+def read_compaction_record(bucket_name, s3_key):
+    from botocore.exceptions import ClientError
+    try:
+        data, _ = read_object(bucket_name, f"{s3_key}{COMPACTION_SUFFIX}")
+        return json.loads(data)
+    except ClientError as e:
+        if is_missing(e):
+            return None
+        raise
+
+def read_folded_entries(bucket_name, s3_key, etag, folded):
+    """
+    Reads entries that were folded into the main object with ranged GETs,
+    coalescing entries that sit next to each other.
+    """
+    chunks = []
+    ranges = []
+    for key, start, length in folded:
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = start + length
+        else:
+            ranges.append([start, start + length])
+    for start, end in ranges:
+        data, _ = read_object(bucket_name, s3_key, Range=f"bytes={start}-{end - 1}", IfMatch=etag)
+        chunks.append(data)
+    return chunks
+
+def pull_entries(bucket_name, s3_key, local_file):
+    """
+    One incremental pull. Returns False if an entry vanished under a concurrent
+    compaction, in which case the caller simply pulls again.
+    """
+    from botocore.exceptions import ClientError
+    state = load_sync_state(local_file)
+    local_size = os.path.getsize(local_file) if os.path.exists(local_file) else 0
+    if local_size < state["offset"]:
+        # The local copy was truncated or replaced behind our back: rebuild it.
+        state = new_sync_state()
+    fresh = state["etag"] is None and state["watermark"] == 0
+
+    pending = b""
+    if local_size > state["offset"] and not fresh:
+        # Bytes written locally but not pushed yet stay after the remote ones.
+        with open(local_file, 'rb') as file:
+            file.seek(state["offset"])
+            pending = file.read()
+
+    applied = set(state["applied"])
+    chunks = []
+    rebuild = fresh
+    changed, head = check_main_object(bucket_name, s3_key, state["etag"])
+    if changed and not fresh:
+        compaction = read_compaction_record(bucket_name, s3_key) if head else None
+        if compaction and head and compaction["etag"] == head.get('ETag') and compaction["previous_etag"] == state["etag"]:
+            horizon = state["watermark"] - ENTRY_GRACE_MS
+            missing = [entry for entry in compaction["entries"]
+                       if entry[0] not in applied and get_entry_timestamp(entry[0]) > horizon]
+            try:
+                chunks.extend(read_folded_entries(bucket_name, s3_key, head['ETag'], missing))
+            except ClientError as e:
+                if is_precondition_failed(e):
+                    return False
+                raise
+            applied.update(entry[0] for entry in missing)
+            state["etag"] = head['ETag']
+            state["since_compaction"] = 0
+        else:
+            rebuild = True
+
+    if rebuild:
+        data, etag, entry_keys = read_session_timeline(bucket_name, s3_key)
+        if data is None:
+            # Nothing remote yet: the local file is the session log.
+            save_sync_state(local_file, state)
+            return True
+        with open(local_file, 'wb') as file:
+            file.write(data)
+            file.write(pending)
+        state = dict(new_sync_state(), seq=state["seq"], etag=etag, offset=len(data), clock_offset_ms=state.get("clock_offset_ms"))
+        applied = set(entry_keys)
+        print(f"Synced S3 file '{s3_key}' from bucket '{bucket_name}' to local file '{local_file}'.")
+    else:
+        for key in list_entries(bucket_name, s3_key, state["watermark"] - ENTRY_GRACE_MS):
+            if key in applied:
+                continue
+            try:
+                chunks.append(read_object(bucket_name, key)[0])
+            except ClientError as e:
+                if is_missing(e):
+                    return False
+                raise
+            applied.add(key)
+
+        if chunks:
+            with open(local_file, 'r+b' if os.path.exists(local_file) else 'wb') as file:
+                file.seek(state["offset"])
+                file.truncate()
+                for chunk in chunks:
+                    file.write(chunk)
+                file.write(pending)
+            new_bytes = sum(len(chunk) for chunk in chunks)
+            state["offset"] += new_bytes
+            state["since_compaction"] += len(chunks)
+            print(f"Synced {new_bytes} new bytes of '{s3_key}' from bucket '{bucket_name}' to local file '{local_file}'.")
+
+    record_applied(state, applied)
+    save_sync_state(local_file, state)
+    return True
+
+def record_applied(state, applied):
+    if applied:
+        state["watermark"] = max(state["watermark"], max(get_entry_timestamp(key) for key in applied))
+    horizon = state["watermark"] - ENTRY_GRACE_MS
+    state["applied"] = sorted(key for key in applied if get_entry_timestamp(key) > horizon)
+
+def sync_s3_to_local_incremental(bucket_name, s3_key, local_file):
+    try:
+        for attempt in range(3):
+            if pull_entries(bucket_name, s3_key, local_file):
+                return
+        print(f"The session log '{s3_key}' kept changing during the sync. Try again later.")
+    except Exception as e:
+        print(f"An error occurred while syncing S3 file to local: {e}")
+
+def sync_local_to_s3_incremental(bucket_name, local_file, s3_key):
+    from botocore.exceptions import ClientError
+    try:
+        state = load_sync_state(local_file)
+        local_size = os.path.getsize(local_file)
+        offset = state["offset"]
+        if local_size <= offset:
+            return True
+
+        with open(local_file, 'rb') as file:
+            file.seek(offset)
+            data = file.read(local_size - offset)
+
+        s3_client = get_s3_client()
+        writer = get_writer_id()
+        seq = state["seq"]
+        while True:
+            seq += 1
+            sent_ms = time.time() * 1000
+            entry_key = get_entry_key(s3_key, get_s3_time_ms(bucket_name, state), writer, seq)
+            try:
+                response = s3_client.put_object(Bucket=bucket_name, Key=entry_key, Body=data, IfNoneMatch="*")
+                break
+            except ClientError as e:
+                if not is_precondition_failed(e) or seq - state["seq"] >= 5:
+                    raise
+        clock_offset_ms = get_clock_offset_ms(response, sent_ms)
+        if clock_offset_ms is not None:
+            state["clock_offset_ms"] = clock_offset_ms
+        if get_entry_timestamp(entry_key) <= state["watermark"] - ENTRY_GRACE_MS:
+            print(f"Warning: '{entry_key}' is timestamped more than {ENTRY_GRACE_MS // 60000} minutes before entries "
+                  f"already synced, so other participants may miss it. Check this host's clock.")
+
+        state["seq"] = seq
+        state["offset"] = offset + len(data)
+        state["since_compaction"] += 1
+        record_applied(state, set(state["applied"]) | {entry_key})
+        print(f"Synced {len(data)} new bytes of '{local_file}' to S3 bucket '{bucket_name}' as '{entry_key}'.")
+
+        if state["since_compaction"] >= COMPACT_ENTRY_COUNT:
+            compact_session_log(bucket_name, s3_key, get_s3_time_ms(bucket_name, state))
+            state["since_compaction"] = 0
+        save_sync_state(local_file, state)
+        return True
+    except Exception as e:
+        print(f"An error occurred while syncing local file to S3: {e}")
+        return False
+
+def compact_session_log(bucket_name, s3_key, now_ms=None):
+    """
+    Folds entries older than ENTRY_GRACE_MS into the main log object.
+    The main object is replaced with a conditional write, so when several participants
+    compact at once exactly one succeeds and the others leave the entries alone.
+    The folded entry offsets are written to `<s3_key>.compaction.json` so readers that
+    had not seen some of them can fetch just those bytes with ranged reads.
+
+    Args:
+        bucket_name (str): The bucket.
+        s3_key (str): The session log's key.
+        now_ms (int): The current time on S3's clock. Defaults to this host's clock.
+
+    Returns:
+        bool: True if this call compacted the log.
+    """
+    from botocore.exceptions import ClientError
+    s3_client = get_s3_client()
+    cutoff = (now_ms if now_ms is not None else int(time.time() * 1000)) - ENTRY_GRACE_MS
+    foldable = [key for key in list_entries(bucket_name, s3_key) if get_entry_timestamp(key) <= cutoff]
+    if not foldable:
+        return False
+
+    try:
+        main, etag = read_object(bucket_name, s3_key)
+    except ClientError as e:
+        if not is_missing(e):
+            raise
+        main, etag = b"", None
+
+    folded = []
+    chunks = [main]
+    position = len(main)
+    for key in foldable:
+        data, _ = read_object(bucket_name, key)
+        folded.append([key, position, len(data)])
+        chunks.append(data)
+        position += len(data)
+
+    condition = {"IfMatch": etag} if etag else {"IfNoneMatch": "*"}
+    try:
+        response = s3_client.put_object(Bucket=bucket_name, Key=s3_key, Body=b"".join(chunks), **condition)
+    except ClientError as e:
+        if is_precondition_failed(e):
+            print(f"'{s3_key}' was compacted by another participant.")
+            return False
+        raise
+
+    record = {"etag": response.get('ETag'), "previous_etag": etag, "entries": folded}
+    s3_client.put_object(Bucket=bucket_name, Key=f"{s3_key}{COMPACTION_SUFFIX}", Body=json.dumps(record))
+    objects = [{"Key": key} for key, start, length in folded]
+    for i in range(0, len(objects), 1000):
+        s3_client.delete_objects(Bucket=bucket_name, Delete={"Objects": objects[i:i + 1000], "Quiet": True})
+    print(f"Compacted {len(folded)} entries into '{s3_key}'.")
+    return True
+
 if __name__ == "__main__":
     if get_aws_credentials():
         aws_menu()
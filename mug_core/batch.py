@@ -0,0 +1,168 @@
+import os
+import sys
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from .chatgpt import build_messages, record_llm_latency, route_request
+from .context import count_tokens
+from .llm_backends import LLMError, get_backend
+from .response_cache import get_cached_response, put_cached_response
+
+# Many questions at once over one LLM backend, whose HTTP connection pool is shared by every
+# request of the batch. Requests run on a thread pool of LLM_CONCURRENCY workers, which also
+# bounds how many are in flight.
+DEFAULT_CONCURRENCY = 8
+
+def get_concurrency():
+    try:
+        return max(int(os.getenv("LLM_CONCURRENCY", DEFAULT_CONCURRENCY)), 1)
+    except ValueError:
+        return DEFAULT_CONCURRENCY
+
+async def ask_chatgpt_async(backend, executor, question, context, model=None):
+    """
+    Asks one question over a shared backend without blocking the event loop. Answers go
+    through the response cache like those of ask_chatgpt.
+
+    Args:
+        backend (LLMBackend): The shared backend.
+        executor (Executor): Where the blocking request runs.
+        question (str): The question to ask.
+        context (str): The context to provide.
+        model (str): The model to use. Defaults to the one route_request picks.
+
+    Returns:
+        str: The response from the GPT model.
+    """
+    started = time.perf_counter()
+    messages = build_messages(question, context)
+    routed_model, max_tokens, prompt_tokens = route_request(messages)
+    model = model or routed_model
+    cached = get_cached_response(model, question, context)
+    if cached is not None:
+        elapsed = time.perf_counter() - started
+        record_llm_latency(model, elapsed, elapsed, len(cached), False, cached=True)
+        return cached
+
+    loop = asyncio.get_running_loop()
+    response = (await loop.run_in_executor(executor, backend.complete, messages, model, max_tokens)).strip()
+    elapsed = time.perf_counter() - started
+    # Not streamed to anyone, so the first token counts as arriving with the whole answer.
+    record_llm_latency(model, elapsed, elapsed, len(response), False, backend=backend.name,
+                       prompt_tokens=prompt_tokens, completion_tokens=count_tokens(response, model))
+    if response:
+        put_cached_response(model, question, context, response)
+    return response
+
+async def ask_many(items, concurrency=None, on_result=None):
+    """
+    Asks every (question, context) pair concurrently, at most `concurrency` at a time.
+    `on_result(position, question, response)` is called in input order, each as soon as
+    its answer and all those before it are in, so output can be printed while the rest run.
+    A failed question gets its error message as the response instead of stopping the batch.
+    Without a usable backend nothing is asked: its error is printed once and is the
+    response to every question.
+
+    Args:
+        items (list): (question, context) pairs.
+        concurrency (int): Maximum requests in flight. Defaults to LLM_CONCURRENCY.
+        on_result (callable): Called with each result, in order.
+
+    Returns:
+        list: The responses, in input order.
+    """
+    try:
+        backend = get_backend()
+    except LLMError as e:
+        print(e)
+        return [str(e)] * len(items)
+    with ThreadPoolExecutor(max_workers=concurrency or get_concurrency()) as executor:
+        async def ask(question, context):
+            try:
+                return await ask_chatgpt_async(backend, executor, question, context)
+            except Exception as e:
+                return f"An error occurred: {e}"
+
+        tasks = [asyncio.ensure_future(ask(question, context)) for question, context in items]
+        responses = []
+        try:
+            for position, task in enumerate(tasks):
+                responses.append(await task)
+                if on_result:
+                    on_result(position, items[position][0], responses[-1])
+        finally:
+            for task in tasks:
+                task.cancel()
+    return responses
+
+def ask_chatgpt_batch(questions, contexts=None, concurrency=None, on_result=None):
+    """
+    Synchronous entry point of ask_many for callers without an event loop.
+
+    Args:
+        questions (list): The questions.
+        contexts (list): One context per question. Defaults to the session log context of each.
+        concurrency (int): Maximum requests in flight. Defaults to LLM_CONCURRENCY.
+        on_result (callable): Called with (position, question, response), in order.
+
+    Returns:
+        list: The responses, in the order of `questions`.
+    """
+    if contexts is None:
+        from .api import load_session_log
+        contexts = [load_session_log(question=question) for question in questions]
+    return asyncio.run(ask_many(list(zip(questions, contexts)), concurrency, on_result))
+
+def read_batch_file(path):
+    """
+    Reads a batch file. Each non-empty line is either a plain question, asked against the
+    session log, or a JSON object {"question": ..., "context_file": ...} whose context is
+    the end of that file (e.g. a failure log) instead.
+
+    Returns:
+        list: (question, context) pairs.
+    """
+    from .api import load_session_log
+    from .context import build_context
+
+    items = []
+    with open(path, 'r') as batch_file:
+        for line in batch_file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                item = json.loads(line)
+                question = item["question"]
+                context_file = item.get("context_file")
+                context = build_context(context_file) if context_file else load_session_log(question=question)
+            else:
+                question = line
+                context = load_session_log(question=question)
+            items.append((question, context))
+    return items
+
+def print_batch_result(position, question, response):
+    print(f"[{position + 1}] {question}")
+    print(f"ChatGPT response: {response}\n")
+    sys.stdout.flush()
+
+def batch_command(args):
+    """
+    Entry point of `mug_core batch <file> [--concurrency N]`.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog="mug_core batch", description="Ask many questions concurrently.")
+    parser.add_argument("file", help="One question per line, or JSON lines with question and context_file.")
+    parser.add_argument("--concurrency", type=int, default=None, help="Maximum requests in flight.")
+    options = parser.parse_args(args)
+
+    try:
+        items = read_batch_file(options.file)
+        asyncio.run(ask_many(items, options.concurrency, print_batch_result))
+    except KeyboardInterrupt:
+        print("\n[cancelled]")
+    except Exception as e:
+        print(f"An error occurred while running the batch: {e}")
@@ -0,0 +1,216 @@
+import os
+import re
+import sys
+import pty
+import time
+import fcntl
+import select
+import signal
+import termios
+import argparse
+
+from .dedup import dedupe_record
+from .log_segments import is_shared_log, maybe_rotate_session_log
+from .speculate import maybe_start_analysis
+from .session_log import (LOG_FORMAT_STRUCTURED, append_record, append_to_log, detect_log_format, format_record,
+                          get_log_format, make_record)
+
+# Runs one command under a pseudo-terminal, so interactive and colour-aware tools behave as
+# they would without mug, while copying its output to the terminal as it arrives.
+# Only the first CAPTURE_HEAD_KB and the last CAPTURE_TAIL_KB of the output are kept for the
+# log, with a marker for what was left out, so a `cat` of a huge file costs the log nothing.
+DEFAULT_HEAD_KB = 64
+DEFAULT_TAIL_KB = 64
+READ_SIZE = 65536
+ELIDED_MARKER = "\n[... {} bytes of output omitted ...]\n"
+BINARY_MARKER = "[binary output, {} bytes omitted]\n"
+# Output whose first bytes hold a NUL, or more than this share of control bytes, is binary.
+BINARY_SNIFF_BYTES = 8192
+BINARY_CONTROL_SHARE = 0.3
+# CSI and OSC escape sequences, plus the lone escapes that select character sets and modes.
+ANSI_PATTERN = re.compile(rb'\x1b(?:\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(?:\x07|\x1b\\)|[()][0-9A-Za-z]|[=>78MNOc])')
+CONTROL_BYTES = bytes(set(range(32)) - {8, 9, 10, 12, 13, 27})
+
+def get_limit(name, default_kb):
+    try:
+        return max(int(os.getenv(name, default_kb)), 0) * 1024
+    except ValueError:
+        return default_kb * 1024
+
+class HeadTailBuffer:
+    """
+    Keeps the first `head` and the last `tail` bytes written to it, and counts the rest.
+    """
+    def __init__(self, head, tail):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data):
+        self.total += len(data)
+        if len(self.head) < self.head_limit:
+            room = self.head_limit - len(self.head)
+            self.head += data[:room]
+            data = data[room:]
+        if data and self.tail_limit:
+            self.tail += data
+            if len(self.tail) > 2 * self.tail_limit:
+                # Trim in large steps so the buffer is not copied on every write.
+                del self.tail[:len(self.tail) - self.tail_limit]
+
+    @property
+    def elided(self):
+        return self.total - len(self.head) - min(len(self.tail), self.tail_limit)
+
+    def is_binary(self):
+        sample = bytes(self.head[:BINARY_SNIFF_BYTES])
+        if b"\0" in sample:
+            return True
+        controls = len(sample) - len(sample.translate(None, CONTROL_BYTES))
+        return bool(sample) and controls / len(sample) > BINARY_CONTROL_SHARE
+
+    def render(self):
+        """
+        Returns the retained output as clean text: escape sequences stripped, carriage-return
+        redraws (progress bars) collapsed to their final state, and the marker in the middle.
+        """
+        if self.is_binary():
+            return BINARY_MARKER.format(self.total)
+        tail = bytes(self.tail[-self.tail_limit:]) if self.tail_limit else b""
+        if self.elided:
+            return clean_output(bytes(self.head)) + ELIDED_MARKER.format(self.elided) + clean_output(tail)
+        return clean_output(bytes(self.head) + tail)
+
+def clean_output(data):
+    text = ANSI_PATTERN.sub(b"", data).decode(errors='replace')
+    lines = text.replace("\r\n", "\n").split("\n")
+    return "\n".join(line.rsplit("\r", 1)[-1] for line in lines)
+
+def copy_window_size(source_fd, target_fd):
+    try:
+        size = fcntl.ioctl(source_fd, termios.TIOCGWINSZ, b"\0" * 8)
+        fcntl.ioctl(target_fd, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+
+def run_under_pty(argv, buffer):
+    """
+    Runs `argv` on a new pseudo-terminal, copying its output to stdout and into `buffer`,
+    and the user's keystrokes to it.
+
+    Returns:
+        int: The exit status, 128 + N when killed by signal N (as the shell reports it).
+    """
+    stdin_fd = sys.stdin.fileno()
+    stdout_fd = sys.stdout.fileno()
+    interactive = os.isatty(stdin_fd)
+
+    pid, master_fd = pty.fork()
+    if pid == 0:
+        try:
+            os.execvp(argv[0], argv)
+        except OSError as e:
+            os.write(2, f"mug: {argv[0]}: {e.strerror}\n".encode())
+        os._exit(127)
+
+    saved_attributes = None
+    previous_winch = None
+    if interactive:
+        copy_window_size(stdin_fd, master_fd)
+        previous_winch = signal.signal(signal.SIGWINCH, lambda signum, frame: copy_window_size(stdin_fd, master_fd))
+        saved_attributes = termios.tcgetattr(stdin_fd)
+        # Raw mode: every key, Ctrl-C included, goes to the command's terminal as is.
+        raw = termios.tcgetattr(stdin_fd)
+        raw[0] &= ~(termios.BRKINT | termios.ICRNL | termios.INPCK | termios.ISTRIP | termios.IXON)
+        raw[3] &= ~(termios.ECHO | termios.ICANON | termios.IEXTEN | termios.ISIG)
+        raw[6][termios.VMIN] = 1
+        raw[6][termios.VTIME] = 0
+        termios.tcsetattr(stdin_fd, termios.TCSANOW, raw)
+
+    readers = [master_fd, stdin_fd] if interactive else [master_fd]
+    try:
+        while True:
+            try:
+                ready, _, _ = select.select(readers, [], [])
+            except InterruptedError:
+                continue
+            if master_fd in ready:
+                try:
+                    data = os.read(master_fd, READ_SIZE)
+                except OSError:
+                    # EIO: the command exited and its terminal is gone.
+                    data = b""
+                if not data:
+                    break
+                os.write(stdout_fd, data)
+                buffer.write(data)
+            if stdin_fd in ready:
+                data = os.read(stdin_fd, READ_SIZE)
+                if data:
+                    os.write(master_fd, data)
+                else:
+                    readers.remove(stdin_fd)
+    finally:
+        if saved_attributes is not None:
+            termios.tcsetattr(stdin_fd, termios.TCSADRAIN, saved_attributes)
+        if previous_winch is not None:
+            signal.signal(signal.SIGWINCH, previous_winch)
+        os.close(master_fd)
+
+    _, wait_status = os.waitpid(pid, 0)
+    status = os.waitstatus_to_exitcode(wait_status)
+    return 128 - status if status < 0 else status
+
+def capture_command(argv, log_path, head=None, tail=None):
+    """
+    Runs a command under a pty and writes it, with its retained output, exit status and
+    wall time, to the session log in the log's format. The output is written to the log once.
+
+    Args:
+        argv (list): The command and its arguments.
+        log_path (str): The session log file.
+        head (int): Bytes kept from the start of the output. Defaults to CAPTURE_HEAD_KB.
+        tail (int): Bytes kept from the end of the output. Defaults to CAPTURE_TAIL_KB.
+
+    Returns:
+        int: The command's exit status.
+    """
+    buffer = HeadTailBuffer(head if head is not None else get_limit("CAPTURE_HEAD_KB", DEFAULT_HEAD_KB),
+                            tail if tail is not None else get_limit("CAPTURE_TAIL_KB", DEFAULT_TAIL_KB))
+    start = time.time()
+    started = time.perf_counter()
+    status = run_under_pty(argv, buffer)
+    record = make_record(argv, buffer.render(), status, start, time.perf_counter() - started)
+    record["output_bytes"] = buffer.total
+
+    has_content = os.path.exists(log_path) and os.path.getsize(log_path) > 0
+    log_format = detect_log_format(log_path) if has_content else get_log_format()
+    if has_content:
+        record = dedupe_record(log_path, record)
+    if log_format == LOG_FORMAT_STRUCTURED:
+        append_record(log_path, record)
+    elif is_shared_log(log_path):
+        # Other hosts append to a shared log too, so every entry names its host.
+        append_to_log(log_path, format_record(record).encode())
+    else:
+        # Host banners are written by the hook for text logs.
+        append_to_log(log_path, format_record(dict(record, host=None)).encode())
+    maybe_rotate_session_log(log_path)
+    maybe_start_analysis(log_path, record)
+    return status
+
+def capture_main(args):
+    """
+    Entry point of `mug_core capture --log <session log> -- <command...>`.
+    Exits with the command's exit status.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core capture")
+    parser.add_argument("--log", required=True, help="The session log file.")
+    parser.add_argument("argv", nargs=argparse.REMAINDER)
+    options = parser.parse_args(args)
+    argv = options.argv[1:] if options.argv[:1] == ["--"] else options.argv
+    if not argv:
+        parser.error("no command given")
+    sys.exit(capture_command(argv, options.log))
@@ -1,5 +1,31 @@
 import os
-import openai
+import sys
+import json
+import time
+
+from .paths import LOG_DIR
+from .context import count_tokens
+from .response_cache import get_cached_response, put_cached_response
+from .tracing import record_span
+from .usage import record_session_usage
+from .llm_backends import LLMError, get_backend
+
+DEFAULT_MAX_TOKENS = 1024
+# Each request goes to the first model of LLM_ROUTES ("model:max prompt tokens,...", the last
+# one without a limit) whose limit its packed prompt fits in. Short questions get a fast, cheap
+# model, and only a large context pays for a long-context one. OPENAI_MODEL pins a single model.
+DEFAULT_ROUTES = "gpt-4.1-nano:4000,gpt-4o-mini:100000,gpt-4.1-mini"
+# Chat formatting adds a few tokens per message, and a few more to prime the reply.
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_OVERHEAD_TOKENS = 3
+SYSTEM_PROMPT = "You help users understand what happened in a shared terminal session. Answer concisely."
+SUMMARY_PROMPT = (
+    "Summarize this part of a shared terminal session in a few short bullet points. "
+    "Keep commands, file names, hosts, errors and outcomes; drop routine output."
+)
+SUMMARY_MAX_TOKENS = 200
+LLM_ERROR_PREFIX = "An error occurred while asking the LLM: "
+LATENCY_LOG_PATH = os.path.join(LOG_DIR, "llm_latency.jsonl")
 
 def set_openai_api_key():
     """
@@ -47,6 +73,7 @@ def verify_api_key(api_key):
     Returns:
         bool: True if the API key is valid, False otherwise.
     """
+    import openai
     client = openai.OpenAI(api_key=api_key)
     try:
         client.models.list()
@@ -54,28 +81,253 @@ def verify_api_key(api_key):
     except openai.AuthenticationError:
         return False
 
-def ask_chatgpt(question, context):
+def parse_routes(value):
+    """
+    Parses a routing table into [(model, max prompt tokens or None), ...], or None if malformed.
+    """
+    routes = []
+    for item in value.split(","):
+        model, _, limit = item.strip().partition(":")
+        if not model:
+            continue
+        try:
+            routes.append((model, int(limit) if limit else None))
+        except ValueError:
+            return None
+    return routes or None
+
+def get_max_tokens():
+    try:
+        return max(int(os.getenv("OPENAI_MAX_TOKENS", DEFAULT_MAX_TOKENS)), 1)
+    except ValueError:
+        return DEFAULT_MAX_TOKENS
+
+def get_routes():
+    return parse_routes(os.getenv("LLM_ROUTES", DEFAULT_ROUTES)) or parse_routes(DEFAULT_ROUTES)
+
+def count_message_tokens(messages, model=None):
+    """
+    Counts the prompt tokens of a chat request.
+
+    Args:
+        messages (list): The chat messages.
+        model (str): The model whose tokenizer to use. Defaults to cl100k_base.
+
+    Returns:
+        int: The number of tokens.
+    """
+    return sum(count_tokens(message["content"], model) + MESSAGE_OVERHEAD_TOKENS for message in messages) + REPLY_OVERHEAD_TOKENS
+
+def estimate_message_tokens(messages, model=None):
+    """
+    count_message_tokens for routing, which must never keep a request from being sent:
+    if the tokenizer fails, the prompt is estimated at 4 characters per token.
+    """
+    try:
+        return count_message_tokens(messages, model)
+    except Exception:
+        return sum((len(message["content"]) + 3) // 4 + MESSAGE_OVERHEAD_TOKENS for message in messages) + REPLY_OVERHEAD_TOKENS
+
+def route_request(messages):
+    """
+    Picks the model and response budget for a request from the size of its prompt.
+
+    Args:
+        messages (list): The chat messages.
+
+    Returns:
+        tuple: (model, max_tokens, prompt_tokens).
+    """
+    max_tokens = get_max_tokens()
+    pinned = os.getenv("OPENAI_MODEL")
+    if pinned:
+        return pinned, max_tokens, estimate_message_tokens(messages, pinned)
+    prompt_tokens = estimate_message_tokens(messages)
+    routes = get_routes()
+    for model, limit in routes:
+        if limit is None or prompt_tokens <= limit:
+            return model, max_tokens, prompt_tokens
+    return routes[-1][0], max_tokens, prompt_tokens
+
+def build_messages(question, context):
+    return [
+        {"role": "system", "content": SYSTEM_PROMPT},
+        {"role": "user", "content": f"Context:\n{context}\n\nQuestion:\n{question}"},
+    ]
+
+def record_llm_latency(model, time_to_first_token, total, characters, cancelled, cached=False, backend=None,
+                       prompt_tokens=None, completion_tokens=None):
+    """
+    Appends one request's latency and token counts to ~/.mug/llm_latency.jsonl, adds them
+    to the session's totals (see usage.py), and records llm.* spans for `mug --stats`.
+
+    Args:
+        model (str): The model that answered.
+        time_to_first_token (float): Seconds until the first token arrived, or None if none did.
+        total (float): Seconds until the response finished or was cancelled.
+        characters (int): Length of the response text.
+        cancelled (bool): Whether the user cancelled the response.
+        cached (bool): Whether the response came from the response cache.
+        backend (str): The name of the backend that answered.
+        prompt_tokens (int): Tokens sent.
+        completion_tokens (int): Tokens received.
+
+    Returns:
+        None
+    """
+    record_session_usage(model, prompt_tokens, completion_tokens, total, cached=cached)
+    if cached:
+        record_span("llm.cached", total)
+    else:
+        record_span("llm.first_token", time_to_first_token)
+        record_span("llm.total", total)
+    entry = {
+        "ts": time.time(),
+        "model": model,
+        "ttft": time_to_first_token,
+        "total": total,
+        "chars": characters,
+        "cancelled": cancelled,
+        "cached": cached,
+        "backend": backend,
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+    }
+    try:
+        if not os.path.exists(LOG_DIR):
+            os.makedirs(LOG_DIR)
+        with open(LATENCY_LOG_PATH, 'a') as latency_log:
+            latency_log.write(json.dumps(entry) + "\n")
+    except OSError as e:
+        print(f"Error recording LLM latency: {e}")
+
+def ask_chatgpt(question, context, on_token=None):
     """
-    Sends a question to OpenAI's GPT model with provided context and returns the response.
+    Sends a question to the configured LLM backend (OpenAI's GPT model by default) with
+    provided context and returns the response. The response is streamed; every piece of text is passed to `on_token` as it arrives.
+    Ctrl-C stops the stream and returns what has arrived so far.
+    Answers are served from the response cache when the same question was already asked
+    with the same context. The model is picked by route_request.
 
     Args:
         question (str): The question to ask.
         context (str): The context to provide.
+        on_token (callable): Called with each piece of response text, if given.
 
     Returns:
         str: The response from the GPT model.
     """
-    openai.api_key = os.getenv("OPENAI_API_KEY")
-    if not openai.api_key:
-        return "OpenAI API Key not found. Please configure it using 'mug start'."
-
-    prompt = f"Context:\n{context}\n\nQuestion:\n{question}"
-    response = openai.Completion.create(
-        engine="davinci",
-        prompt=prompt,
-        max_tokens=150
-    )
-    return response.choices[0].text.strip()
+    started = time.perf_counter()
+    messages = build_messages(question, context)
+    model, max_tokens, prompt_tokens = route_request(messages)
+    cached = get_cached_response(model, question, context)
+    if cached is not None:
+        if on_token:
+            on_token(cached)
+        elapsed = time.perf_counter() - started
+        record_llm_latency(model, elapsed, elapsed, len(cached), False, cached=True)
+        return cached
+
+    try:
+        backend = get_backend()
+    except LLMError as e:
+        return str(e)
+
+    time_to_first_token = None
+    cancelled = False
+    failure = None
+    pieces = []
+    stream = backend.stream(messages, model, max_tokens)
+    try:
+        for text in stream:
+            if time_to_first_token is None:
+                time_to_first_token = time.perf_counter() - started
+            pieces.append(text)
+            if on_token:
+                on_token(text)
+    except (KeyboardInterrupt, BrokenPipeError):
+        cancelled = True
+    except LLMError as e:
+        failure = e
+    finally:
+        stream.close()
+        text = "".join(pieces)
+        record_llm_latency(model, time_to_first_token, time.perf_counter() - started, len(text), cancelled,
+                           backend=backend.name, prompt_tokens=prompt_tokens, completion_tokens=count_tokens(text, model))
+
+    response = text.strip()
+    if cancelled:
+        return response + "\n[cancelled]"
+    if failure is not None:
+        message = f"{LLM_ERROR_PREFIX}{failure}"
+        if not response:
+            return message
+        if on_token:
+            on_token(f"\n{message}")
+        return f"{response}\n{message}"
+    if response:
+        put_cached_response(model, question, context, response)
+    return response
+
+def summarize_text(text, log_path=None):
+    """
+    Asks the model for a short digest of a stretch of session log.
+    Its tokens count towards the session's totals.
+
+    Args:
+        text (str): The session log excerpt.
+        log_path (str): The session log the excerpt comes from.
+
+    Returns:
+        str: The digest, or None if no LLM backend is configured.
+    """
+    messages = [
+        {"role": "system", "content": SUMMARY_PROMPT},
+        {"role": "user", "content": text},
+    ]
+    model, _, prompt_tokens = route_request(messages)
+    started = time.perf_counter()
+    try:
+        backend = get_backend()
+    except LLMError as e:
+        print(f"{LLM_ERROR_PREFIX}{e}", file=sys.stderr)
+        return None
+    digest = backend.complete(messages, model, SUMMARY_MAX_TOKENS).strip()
+    record_session_usage(model, prompt_tokens, count_tokens(digest, model), time.perf_counter() - started, log_path=log_path)
+    return digest
+
+def print_chatgpt_response(question, context, out=None):
+    """
+    Asks ChatGPT and prints the response as it streams in.
+
+    Args:
+        question (str): The question to ask.
+        context (str): The context to provide.
+        out (file): Where to print it. Defaults to stdout.
+
+    Returns:
+        str: The response from the GPT model.
+    """
+    out = out or sys.stdout
+    print("ChatGPT response: ", end="", flush=True, file=out)
+    streamed = []
+
+    def on_token(text):
+        streamed.append(text)
+        out.write(text)
+        out.flush()
+
+    try:
+        response = ask_chatgpt(question, context, on_token)
+    except KeyboardInterrupt:
+        print("\n[cancelled]", file=out)
+        return ""
+    if not streamed:
+        print(response, end="", file=out)
+    elif response.endswith("[cancelled]"):
+        print("\n[cancelled]", end="", file=out)
+    print(file=out)
+    return response
 
 if __name__ == "__main__":
     set_openai_api_key()
@@ -0,0 +1,189 @@
+import os
+import shlex
+
+from .log_segments import iter_log_views
+from .session_log import (
+    LOG_FORMAT_STRUCTURED,
+    detect_log_format,
+    format_records,
+    format_record,
+    iter_records_reversed,
+)
+
+DEFAULT_CONTEXT_TOKEN_BUDGET = 6000
+DEFAULT_ENCODING = "cl100k_base"
+# No tokenizer produces more tokens than bytes, and typical logs run at about 4 bytes a token.
+# An entry more than this many bytes per budgeted token cannot fit and is only read in part.
+MAX_BYTES_PER_TOKEN = 16
+ENTRY_MARKER = b"\nInput:\n"
+ELISION_MARKER = "\n[... {} earlier bytes of output omitted ...]\n"
+
+_encodings = {}
+
+def get_context_token_budget():
+    try:
+        return int(os.getenv("CONTEXT_TOKEN_BUDGET", DEFAULT_CONTEXT_TOKEN_BUDGET))
+    except ValueError:
+        return DEFAULT_CONTEXT_TOKEN_BUDGET
+
+def get_encoding(model=None):
+    """
+    Returns a tiktoken encoding for `model`, or None if tiktoken is not installed or its
+    BPE file cannot be loaded (tiktoken downloads it on first use, which fails offline).
+    Either way the result is cached, so a failed load is not retried on every count.
+    """
+    key = model or DEFAULT_ENCODING
+    if key not in _encodings:
+        try:
+            import tiktoken
+        except ImportError:
+            _encodings[key] = None
+            return None
+        try:
+            try:
+                _encodings[key] = tiktoken.encoding_for_model(model) if model else tiktoken.get_encoding(DEFAULT_ENCODING)
+            except KeyError:
+                _encodings[key] = tiktoken.get_encoding(DEFAULT_ENCODING)
+        except Exception:
+            _encodings[key] = None
+    return _encodings[key]
+
+def count_tokens(text, model=None):
+    """
+    Counts the tokens in `text` with the model's tokenizer.
+    Falls back to a 4-characters-per-token estimate when tiktoken is unavailable.
+
+    Args:
+        text (str): The text to measure.
+        model (str): The model whose tokenizer to use. Defaults to cl100k_base.
+
+    Returns:
+        int: The number of tokens.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+def truncate_to_tokens(text, budget, model=None):
+    """
+    Keeps the end of `text` so that it fits in `budget` tokens.
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[-budget * 4:] if budget > 0 else ""
+    tokens = encoding.encode(text, disallowed_special=())
+    return encoding.decode(tokens[-budget:]) if budget > 0 else ""
+
+def truncate_entry(header, body, omitted, budget, model=None):
+    """
+    Fits one oversized entry into `budget` tokens: its header is kept and its output
+    is cut from the front, since the end of a failing command's output matters most.
+    """
+    marker = ELISION_MARKER.format(omitted)
+    remaining = budget - count_tokens(header + marker, model)
+    if remaining <= 0:
+        return truncate_to_tokens(header, budget, model)
+    tail = truncate_to_tokens(body, remaining, model)
+    return header + ELISION_MARKER.format(omitted + len(body.encode()) - len(tail.encode())) + tail
+
+def collect_text_entries(log_map, pieces, used, budget, model=None, collapser=None):
+    """
+    Adds the entries of one view of a text log to `pieces`, newest first, while they fit.
+    With a `collapser`, repeated outputs are collapsed before they are measured.
+
+    Returns:
+        tuple: The tokens used so far, and whether the budget is full.
+    """
+    end = len(log_map)
+    while end > 0:
+        marker = log_map.rfind(ENTRY_MARKER, 0, end)
+        start = marker + 1 if marker != -1 else 0
+        size = end - start
+
+        if size <= budget * MAX_BYTES_PER_TOKEN:
+            entry = log_map[start:end].decode(errors='replace')
+            if collapser is not None:
+                entry = collapser.collapse_entry(entry)
+            tokens = count_tokens(entry, model)
+            if used + tokens <= budget:
+                pieces.append(entry)
+                used += tokens
+                end = start
+                continue
+
+        if not pieces:
+            # The newest entry alone is over budget: keep its head and the tail of its output.
+            header_end = log_map.find(b"\nOutput:\n", start, end)
+            header_end = header_end + len(b"\nOutput:\n") if header_end != -1 else min(start + 1024, end)
+            header = log_map[start:header_end].decode(errors='replace')
+            tail_start = max(header_end, end - budget * MAX_BYTES_PER_TOKEN)
+            body = log_map[tail_start:end].decode(errors='replace')
+            pieces.append(truncate_entry(header, body, tail_start - header_end, budget - used, model))
+        return used, True
+    return used, False
+
+def get_collapser(log_path):
+    # Logs written with OUTPUT_DEDUP=false can still hold references, so this is always on.
+    from .dedup import OutputCollapser
+    return OutputCollapser(log_path)
+
+def build_text_context(log_path, budget, model=None):
+    # Rotated logs are read from the live file back into the closed segments, and only as
+    # far as the budget reaches, so old segments are normally never decompressed.
+    pieces = []
+    used = 0
+    collapser = get_collapser(log_path)
+    views = iter_log_views(log_path, reverse=True)
+    try:
+        for offset, log_map, closed in views:
+            used, full = collect_text_entries(log_map, pieces, used, budget, model, collapser)
+            if full:
+                break
+    finally:
+        views.close()
+    return "".join(reversed(pieces))
+
+def build_structured_context(log_path, budget, model=None):
+    records = []
+    used = 0
+    collapser = get_collapser(log_path)
+    for record in iter_records_reversed(log_path):
+        collapsed = collapser.collapse_output(shlex.join(record["argv"]), record.get("output") or "")
+        if collapsed is not None:
+            record = dict(record, output=collapsed)
+        tokens = count_tokens(format_record(record), model)
+        if used + tokens > budget:
+            if not records:
+                header = format_record(dict(record, output=""))
+                output = record.get("output") or ""
+                return truncate_entry(header.rstrip("\n") + "\n", output, 0, budget, model)
+            break
+        records.append(record)
+        used += tokens
+    records.reverse()
+    return format_records(records)
+
+def build_context(log_path, token_budget=None, model=None):
+    """
+    Builds the prompt context from the end of a session log. The log is read backwards,
+    whole command entries at a time, until the token budget is full, so memory use does
+    not depend on the size of the log and entries are never cut in the middle.
+    An output repeated in the context is kept in full only at its newest place.
+
+    Args:
+        log_path (str): The session log file.
+        token_budget (int): Maximum tokens of context. Defaults to CONTEXT_TOKEN_BUDGET.
+        model (str): The model whose tokenizer to count with.
+
+    Returns:
+        str: The most recent entries that fit, oldest first.
+    """
+    if not os.path.exists(log_path):
+        return ""
+    budget = token_budget if token_budget is not None else get_context_token_budget()
+    if budget <= 0:
+        return ""
+    if detect_log_format(log_path) == LOG_FORMAT_STRUCTURED:
+        return build_structured_context(log_path, budget, model)
+    return build_text_context(log_path, budget, model)
@@ -0,0 +1,215 @@
+import os
+import re
+import json
+import hashlib
+
+from .log_segments import get_log_size, open_session_log
+from .session_log import LOG_FORMAT_STRUCTURED, detect_log_format, parse_text_log
+
+# Content-addressed outputs. Status commands (`nvidia-smi`, `git status`, `kubectl get pods`)
+# are run over and over with the same output. When a command prints exactly what an earlier
+# command of the session printed, the log writer stores a one-line reference instead:
+#   [same output as command #12, sha256:3f2a9c1e5b7d0a4c]
+# so the log, its uploads and the prompts built from it do not carry the output again.
+# Commands are numbered from 1 in log order. The digests of earlier outputs, with where each
+# first appeared, are kept next to the log in `<log>.outputs.json` and updated incrementally
+# from the log itself, so commands written by other hosts count too.
+# OUTPUT_DEDUP=false turns it off; outputs under OUTPUT_DEDUP_MIN_BYTES are always written.
+OUTPUTS_SUFFIX = ".outputs.json"
+DEFAULT_MIN_BYTES = 256
+DIGEST_CHARS = 16
+REFERENCE_TEXT = "[same output as command #{}, sha256:{}]\n"
+REFERENCE_PATTERN = re.compile(r'^\[same output as command #(\d+), sha256:([0-9a-f]+)\]\n?$')
+COLLAPSED_TEXT = "[same output as the later `{}` below]\n"
+OUTPUT_MARKER = "\nOutput:\n"
+COMMAND_PATTERN = re.compile(r'^Input:\n- (.*)$', re.MULTILINE)
+# The blank line the hook writes after every output, and the host banner that may follow it.
+TRAILER_PATTERN = re.compile(r'\n(?:-+ host: [^\n]* -+\n)?\Z')
+
+def dedup_enabled():
+    return os.getenv("OUTPUT_DEDUP", "true") != "false"
+
+def get_min_bytes():
+    try:
+        return int(os.getenv("OUTPUT_DEDUP_MIN_BYTES", DEFAULT_MIN_BYTES))
+    except ValueError:
+        return DEFAULT_MIN_BYTES
+
+def get_outputs_path(log_path):
+    return f"{log_path}{OUTPUTS_SUFFIX}"
+
+def normalize_output(output):
+    # As the output reads back from the log, which ends every output with a newline.
+    return output if output.endswith("\n") or not output else output + "\n"
+
+def output_digest(output):
+    return hashlib.sha256(output.encode(errors='replace')).hexdigest()[:DIGEST_CHARS]
+
+def parse_reference(output):
+    """
+    Returns (command number, digest) if `output` is a reference to an earlier output, else None.
+    """
+    match = REFERENCE_PATTERN.match(output)
+    return (int(match.group(1)), match.group(2)) if match else None
+
+def entry_record(text):
+    """
+    Parses one entry, as the text log holds it or as format_record renders it.
+    Returns None for text that holds no command, like the log's first line.
+    """
+    return next(parse_text_log(text.splitlines(True)), None)
+
+def new_outputs_index(log_format):
+    return {"format": log_format, "position": 0, "check": 0, "count": 0, "outputs": {}}
+
+def load_outputs_index(log_path, log_format):
+    from .retrieval import position_check
+    path = get_outputs_path(log_path)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r') as index_file:
+                index = json.load(index_file)
+            if index.get("format") == log_format and index["check"] == position_check(log_path, log_format, index["position"]):
+                return index
+        except (OSError, ValueError, KeyError):
+            pass
+    return new_outputs_index(log_format)
+
+def save_outputs_index(log_path, index):
+    path = get_outputs_path(log_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as index_file:
+        json.dump(index, index_file)
+    os.replace(tmp_path, path)
+
+def add_entry(index, locator, text, min_bytes):
+    record = entry_record(text)
+    if record is None:
+        return
+    index["count"] += 1
+    output = record["output"]
+    if len(output) >= min_bytes and parse_reference(output) is None:
+        index["outputs"].setdefault(output_digest(output), [index["count"], locator[0], locator[1]])
+
+def update_outputs_index(log_path):
+    """
+    Adds the commands appended since the last update to the session's output digests.
+    Unlike the retrieval index it also takes the last entry of a text log: every writer
+    appends whole entries, and a repeat of the command just run is the usual case.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        dict: The up-to-date index.
+    """
+    from .retrieval import iter_new_entries, position_check
+    log_format = detect_log_format(log_path)
+    index = load_outputs_index(log_path, log_format)
+    if not os.path.exists(log_path):
+        return index
+
+    min_bytes = get_min_bytes()
+    position = index["position"]
+    for locator, text, position in iter_new_entries(log_path, log_format, position):
+        add_entry(index, locator, text, min_bytes)
+    size = get_log_size(log_path)
+    if log_format != LOG_FORMAT_STRUCTURED and size > position:
+        with open_session_log(log_path) as log_file:
+            log_file.seek(position)
+            add_entry(index, [position, size], log_file.read(size - position).decode(errors='replace'), min_bytes)
+        position = size
+
+    if position != index["position"]:
+        index["position"] = position
+        index["check"] = position_check(log_path, log_format, position)
+        save_outputs_index(log_path, index)
+    return index
+
+def dedupe_record(log_path, record):
+    """
+    Replaces the record's output with a reference when an earlier command of the session
+    printed the same. Deduplication never gets in the way of logging: on a read or write
+    error of the index, the output is logged as it is.
+
+    Args:
+        log_path (str): The session log file the record is about to be appended to.
+        record (dict): The record, as built by make_record.
+
+    Returns:
+        dict: The record to append.
+    """
+    if not dedup_enabled() or not os.path.exists(log_path):
+        return record
+    output = normalize_output(record.get("output") or "")
+    if len(output) < get_min_bytes():
+        return record
+    try:
+        earlier = update_outputs_index(log_path)["outputs"].get(output_digest(output))
+    except (OSError, ValueError):
+        return record
+    if earlier is None:
+        return record
+    return dict(record, output=REFERENCE_TEXT.format(earlier[0], output_digest(output)), same_output_as=earlier[0])
+
+class OutputCollapser:
+    """
+    Collapses repeated outputs while a prompt context is built from the newest entry back.
+    Each distinct output is kept in full once, at its newest place in the context; older
+    copies read "[same output as the later `cmd` below]". A reference whose output is not
+    in the context yet is replaced by that output, read from where it first appeared.
+    """
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.min_bytes = get_min_bytes()
+        self.seen = {}
+        self.index = None
+
+    def resolve(self, digest):
+        from .retrieval import read_locator
+        if self.index is None:
+            try:
+                self.index = update_outputs_index(self.log_path)
+            except (OSError, ValueError):
+                self.index = new_outputs_index(None)
+        earlier = self.index["outputs"].get(digest)
+        if earlier is None:
+            return None
+        record = entry_record(read_locator(self.log_path, self.index["format"], earlier[1], earlier[2]))
+        return record["output"] if record else None
+
+    def collapse_output(self, command, output):
+        """
+        Returns what to show instead of the output of `command`, which is older than every
+        entry seen so far, or None to show it as it is.
+        """
+        output = normalize_output(output)
+        reference = parse_reference(output)
+        if reference:
+            digest = reference[1]
+        elif len(output) >= self.min_bytes:
+            digest = output_digest(output)
+        else:
+            return None
+        if digest in self.seen:
+            return COLLAPSED_TEXT.format(self.seen[digest])
+        self.seen[digest] = command
+        return self.resolve(digest) if reference else None
+
+    def collapse_entry(self, entry):
+        """
+        collapse_output for one entry of a text log, in its `Input:` / `Output:` form.
+        """
+        marker = entry.find(OUTPUT_MARKER)
+        if marker == -1:
+            return entry
+        body_start = marker + len(OUTPUT_MARKER)
+        trailer = TRAILER_PATTERN.search(entry, body_start)
+        body_end = trailer.start() if trailer else len(entry)
+        command = COMMAND_PATTERN.search(entry, 0, marker)
+        command = command.group(1) if command else "command"
+        output = entry[body_start:body_end]
+        collapsed = self.collapse_output(command, output)
+        if collapsed is None:
+            return entry
+        return entry[:body_start] + collapsed + entry[body_end:]
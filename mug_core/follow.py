@@ -0,0 +1,358 @@
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import fcntl
+import argparse
+from contextlib import redirect_stdout
+
+from .log_segments import SEGMENTS_SUFFIX, TEXT_ENTRY_MARKER, decompress, get_log_size, iter_log_views, open_session_log
+from .paths import LOG_DIR
+from .session_log import LOG_FORMAT_STRUCTURED, append_to_log, detect_log_format, format_record
+
+# `mug --follow` prints the commands of a session as they land.
+# - Local and shared-directory logs are tailed by their size. Nothing else is needed: a shared
+#   directory is written in place by every host, and change notifications (inotify) do not see
+#   writes made by other NFS or Lustre clients, so the size is polled.
+# - Bucket sessions are mirrored into ~/.mug/follow/<bucket>/<key>, which is then tailed like a
+#   local log. The mirror is only ever appended to. Each poll is one conditional ranged GET of
+#   the live object from the mirrored length on (a 304 while nothing changed), so only new bytes
+#   are transferred. One follower per host, holding `<mirror>.lock`, polls the bucket; the others
+#   tail its mirror. Incremental-sync sessions are mirrored with the incremental pull.
+# Polls back off from the minimum interval, doubling while nothing changes up to the maximum,
+# and go back to the minimum as soon as something does.
+FOLLOW_DIR = os.path.join(LOG_DIR, "follow")
+LOCAL_INTERVALS = (0.25, 2.0)
+S3_INTERVALS = (1.0, 15.0)
+DEFAULT_ENTRIES = 3
+CHECK_BYTES = 64
+REWRITTEN_NOTE = "[... the session log was rewritten; following from its end ...]\n"
+
+def get_intervals(defaults):
+    """
+    Returns (minimum, maximum) seconds between polls. FOLLOW_INTERVAL and FOLLOW_MAX_INTERVAL override them.
+    """
+    try:
+        minimum = float(os.getenv("FOLLOW_INTERVAL", defaults[0]))
+        maximum = float(os.getenv("FOLLOW_MAX_INTERVAL", defaults[1]))
+    except ValueError:
+        return defaults
+    return max(minimum, 0.05), max(minimum, maximum, 0.05)
+
+def next_interval(interval, changed, intervals):
+    minimum, maximum = intervals
+    return minimum if changed else min(interval * 2, maximum)
+
+def find_recent_start(log_path, log_format, entries):
+    """
+    Returns the offset where the last `entries` commands of the log start.
+    The log is searched backwards, so old segments are normally never decompressed.
+    """
+    structured = log_format == LOG_FORMAT_STRUCTURED
+    marker = b"\n" if structured else TEXT_ENTRY_MARKER
+    views = iter_log_views(log_path, reverse=True)
+    try:
+        for offset, data, closed in views:
+            # A structured log ends with the newline of its last record.
+            end = len(data) - 1 if structured else len(data)
+            while entries > 0:
+                found = data.rfind(marker, 0, max(end, 0))
+                if found == -1:
+                    break
+                entries -= 1
+                if entries == 0:
+                    return offset + found + 1
+                end = found
+            # Every view starts with a whole entry.
+            entries -= 1
+            if entries <= 0:
+                return offset
+    finally:
+        views.close()
+    return 0
+
+class LogTail:
+    """
+    Prints what is appended to a session log after `position`, whole lines at a time.
+    Structured records are printed in the `Input:` / `Output:` form.
+    """
+    def __init__(self, log_path, position, out=None):
+        self.log_path = log_path
+        self.position = position
+        self.out = out or sys.stdout
+        self.format = None
+        self.previous_host = None
+        self.check = self.read_check()
+
+    def read_check(self):
+        if self.position == 0 or not os.path.exists(self.log_path):
+            return 0
+        with open_session_log(self.log_path) as log_file:
+            log_file.seek(max(self.position - CHECK_BYTES, 0))
+            return zlib.crc32(log_file.read(min(self.position, CHECK_BYTES)))
+
+    def poll(self):
+        """
+        Prints the lines completed since the last poll. Returns whether there were any.
+        """
+        if not os.path.exists(self.log_path):
+            return False
+        size = get_log_size(self.log_path)
+        if size < self.position or self.read_check() != self.check:
+            self.out.write(REWRITTEN_NOTE)
+            self.position = size
+            self.check = self.read_check()
+            return True
+        if size == self.position:
+            return False
+        with open_session_log(self.log_path) as log_file:
+            log_file.seek(self.position)
+            data = log_file.read(size - self.position)
+        end = data.rfind(b"\n") + 1
+        if end == 0:
+            return False
+        if self.format is None:
+            self.format = detect_log_format(self.log_path)
+        self.write(data[:end].decode(errors='replace'))
+        self.position += end
+        self.check = self.read_check()
+        return True
+
+    def write(self, text):
+        if self.format != LOG_FORMAT_STRUCTURED:
+            self.out.write(text)
+        else:
+            for line in text.splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "argv" in record:
+                    self.out.write(format_record(record, self.previous_host))
+                    self.previous_host = record.get("host")
+        self.out.flush()
+
+def get_mirror_path(bucket_name, s3_key):
+    return os.path.join(FOLLOW_DIR, bucket_name, s3_key)
+
+class S3Mirror:
+    """
+    An append-only local copy of a bucket session, brought up to date by `update`.
+    `<mirror>.follow.json` records the live object's ETag, the remote manifest's ETag, where
+    the live object starts in the log (the closed segments before it) and which log offset the
+    mirror starts at: a fresh mirror skips the segments and starts at the live object.
+    """
+    def __init__(self, bucket_name, s3_key, mode=None):
+        self.bucket_name = bucket_name
+        self.s3_key = s3_key
+        self.mode = mode
+        self.path = get_mirror_path(bucket_name, s3_key)
+        self.state_path = f"{self.path}.follow.json"
+        self.lock_file = None
+        directory = os.path.dirname(self.path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if not os.path.exists(self.path):
+            open(self.path, 'ab').close()
+        self.state = self.load_state()
+
+    def load_state(self):
+        try:
+            with open(self.state_path, 'r') as state_file:
+                state = json.load(state_file)
+            if "start" in state:
+                return state
+        except (OSError, ValueError):
+            pass
+        return {"etag": None, "manifest_etag": None, "base": 0, "segments": [], "start": None}
+
+    def save_state(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, 'w') as state_file:
+            json.dump(self.state, state_file)
+        os.replace(tmp_path, self.state_path)
+
+    def lead(self):
+        """
+        Tries to become the follower on this host that polls the bucket. Returns whether it is.
+        """
+        if self.lock_file is None:
+            lock_file = open(f"{self.path}.lock", 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                return False
+            self.lock_file = lock_file
+            # The previous leader may have written since this process read the state.
+            self.state = self.load_state()
+        return True
+
+    def update(self):
+        """
+        Appends what the bucket session gained since the last update. Returns whether it changed.
+        """
+        from .aws_s3 import SYNC_MODE_INCREMENTAL, get_sync_mode
+        if (self.mode or get_sync_mode()) == SYNC_MODE_INCREMENTAL:
+            from .aws_s3 import sync_s3_to_local_incremental
+            size = os.path.getsize(self.path)
+            with redirect_stdout(io.StringIO()):
+                sync_s3_to_local_incremental(self.bucket_name, self.s3_key, self.path)
+            return os.path.getsize(self.path) != size
+
+        if self.state["start"] is None:
+            self.refresh_manifest()
+            self.state["start"] = self.state["base"]
+        logical = self.state["start"] + os.path.getsize(self.path)
+        if logical < self.state["base"]:
+            # The live object was rotated into segments before its end was mirrored.
+            self.append(self.read_segments(logical))
+            return True
+        return self.update_live(logical - self.state["base"])
+
+    def update_live(self, offset):
+        from botocore.exceptions import ClientError
+        from .aws_s3 import get_error_code, get_s3_client, is_missing
+        s3_client = get_s3_client()
+        params = {"IfNoneMatch": self.state["etag"]} if self.state["etag"] else {}
+        if offset > 0:
+            params["Range"] = f"bytes={offset}-"
+        try:
+            response = s3_client.get_object(Bucket=self.bucket_name, Key=self.s3_key, **params)
+        except ClientError as e:
+            code = get_error_code(e)
+            if code in ("304", "NotModified") or is_missing(e):
+                return False
+            if code not in ("416", "InvalidRange"):
+                raise
+            # The live object no longer reaches the mirrored length: it was rotated, or
+            # re-uploaded with nothing new.
+            if not self.refresh_manifest():
+                self.state["etag"] = s3_client.head_object(Bucket=self.bucket_name, Key=self.s3_key).get('ETag')
+                self.save_state()
+            return True
+        data = response['Body'].read()
+        # Segments and their manifest are uploaded before the live object, so a rotation that
+        # this response reflects shows in the manifest now. The bytes are then from a different
+        # live object, and are fetched again from the new base.
+        if self.refresh_manifest():
+            return True
+        self.append(data)
+        self.state["etag"] = response.get('ETag')
+        self.save_state()
+        return bool(data)
+
+    def refresh_manifest(self):
+        """
+        Reads the remote segment manifest with a conditional GET. Returns whether the live
+        object's start moved.
+        """
+        from botocore.exceptions import ClientError
+        from .aws_s3 import get_error_code, get_remote_manifest_key, is_missing, read_object
+        params = {"IfNoneMatch": self.state["manifest_etag"]} if self.state["manifest_etag"] else {}
+        try:
+            data, etag = read_object(self.bucket_name, get_remote_manifest_key(self.s3_key), **params)
+            segments = json.loads(data)["segments"]
+        except ClientError as e:
+            if get_error_code(e) in ("304", "NotModified"):
+                return False
+            if not is_missing(e):
+                raise
+            etag, segments = None, []
+        base = sum(segment["size"] for segment in segments)
+        moved = base != self.state["base"]
+        self.state.update(manifest_etag=etag, segments=segments, base=base)
+        if moved:
+            self.state["etag"] = None
+        self.save_state()
+        return moved
+
+    def read_segments(self, logical):
+        from .aws_s3 import read_object
+        start = 0
+        chunks = []
+        for segment in self.state["segments"]:
+            end = start + segment["size"]
+            if end > logical:
+                data, _ = read_object(self.bucket_name, f"{self.s3_key}{SEGMENTS_SUFFIX}/{segment['name']}")
+                chunks.append(decompress(data, segment["name"])[max(logical - start, 0):])
+            start = end
+        return b"".join(chunks)
+
+    def append(self, data):
+        if data:
+            append_to_log(self.path, data)
+
+def follow_session(log_path, mirror=None, entries=DEFAULT_ENTRIES, from_start=False):
+    """
+    Prints the last `entries` commands of a session, then its new commands as they land,
+    until interrupted.
+
+    Args:
+        log_path (str): The local session log to tail (the mirror, for a bucket session).
+        mirror (S3Mirror): Keeps `log_path` up to date with a bucket session, if any.
+        entries (int): How many earlier commands to print first.
+        from_start (bool): Print the whole session first instead.
+
+    Returns:
+        None
+    """
+    if mirror is not None and mirror.lead():
+        mirror.update()
+    position = 0
+    if not from_start and os.path.exists(log_path):
+        position = find_recent_start(log_path, detect_log_format(log_path), entries)
+    tail = LogTail(log_path, position)
+    tail.poll()
+    interval = 0
+    while True:
+        leading = mirror is not None and mirror.lead()
+        intervals = get_intervals(S3_INTERVALS if leading else LOCAL_INTERVALS)
+        changed = False
+        if leading:
+            try:
+                changed = mirror.update()
+            except Exception as e:
+                print(f"An error occurred while polling the bucket: {e}", file=sys.stderr)
+        changed = tail.poll() or changed
+        interval = next_interval(interval or intervals[0], changed, intervals)
+        time.sleep(interval)
+
+def follow_command(args):
+    """
+    Entry point of `mug_core follow`, run by `mug --follow`: prints the current session's
+    new commands, from every participant, as they land.
+    """
+    from .api import load_existing_config
+    from .storage import S3Storage, get_storage_backend
+    parser = argparse.ArgumentParser(prog="mug_core follow", description="Follow a session as commands land.")
+    parser.add_argument("session", nargs="?", type=int, default=None, help="The session number. Defaults to the current session.")
+    parser.add_argument("--entries", "-n", type=int, default=DEFAULT_ENTRIES, help="How many earlier commands to print first.")
+    parser.add_argument("--from-start", action="store_true", help="Print the whole session first.")
+    options = parser.parse_args(args)
+
+    config = load_existing_config() or {}
+    storage = get_storage_backend(config)
+    log_name = f"session_log_{options.session}.txt" if options.session is not None else config.get("SESSION_LOG_NAME")
+    if not log_name:
+        print("No session log found.")
+        return
+    mirror = None
+    if isinstance(storage, S3Storage):
+        from .aws_s3 import resolve_session_key
+        s3_key = resolve_session_key(storage.bucket_name, options.session) if options.session is not None else config.get("S3_KEY") or log_name
+        mirror = S3Mirror(storage.bucket_name, s3_key, config.get("SYNC_MODE"))
+        log_path = mirror.path
+        print(f"Following s3://{storage.bucket_name}/{s3_key} (Ctrl-C to stop)", file=sys.stderr)
+    else:
+        log_path = storage.get_session_path(log_name)
+        if not os.path.exists(log_path):
+            print(f"No session log at {log_path}.")
+            return
+        print(f"Following {log_path} (Ctrl-C to stop)", file=sys.stderr)
+    try:
+        follow_session(log_path, mirror, options.entries, options.from_start)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,341 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+from collections import deque
+
+# Chat completion backends. Each backend keeps one HTTP client for the life of the process,
+# so the agent and batch runs reuse connections. Every request has a deadline (LLM_TIMEOUT),
+# and 429s, 5xx responses and connection errors are retried with jittered exponential backoff.
+#
+# LLM_BACKEND picks the backend: "openai" (default), "local" for an OpenAI-compatible server
+# such as vLLM, llama.cpp or Ollama at LLM_LOCAL_URL, or "stub" for tests.
+# With LLM_HEDGE_BACKEND set, a request that has not produced its first token within the
+# LLM_HEDGE_PERCENTILE latency of the primary backend is also sent to that backend, and
+# whichever answers first wins.
+DEFAULT_BACKEND = "openai"
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+DEFAULT_LOCAL_BASE_URL = "http://localhost:8000/v1"
+DEFAULT_DEADLINE = 60.0
+DEFAULT_MAX_RETRIES = 4
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 8.0
+MAX_KEEPALIVE_CONNECTIONS = 16
+DEFAULT_HEDGE_PERCENTILE = 95
+# Below this many latency samples the percentile means little; hedge after a fixed delay instead.
+HEDGE_MIN_SAMPLES = 20
+HEDGE_DEFAULT_DELAY = 2.0
+HEDGE_WINDOW = 200
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+class LLMError(Exception):
+    """
+    A backend failed to answer, after any retries.
+    """
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+def get_deadline_seconds():
+    try:
+        return float(os.getenv("LLM_TIMEOUT", DEFAULT_DEADLINE))
+    except ValueError:
+        return DEFAULT_DEADLINE
+
+def get_max_retries():
+    try:
+        return int(os.getenv("LLM_MAX_RETRIES", DEFAULT_MAX_RETRIES))
+    except ValueError:
+        return DEFAULT_MAX_RETRIES
+
+def is_retryable(status):
+    return status == 429 or status >= 500
+
+def backoff_delay(attempt):
+    # Full jitter, so clients throttled together do not retry together.
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def parse_retry_after(value):
+    try:
+        return min(max(float(value), 0.0), RETRY_MAX_DELAY)
+    except (TypeError, ValueError):
+        return None
+
+class LLMBackend:
+    """
+    Base class of the backends. Subclasses implement stream(); complete() joins it.
+    """
+    name = None
+
+    def stream(self, messages, model, max_tokens, deadline=None):
+        """
+        Yields the response text piece by piece as it arrives.
+
+        Args:
+            messages (list): The chat messages.
+            model (str): The model name.
+            max_tokens (int): Maximum tokens of response.
+            deadline (float): time.monotonic() by which the response must be complete.
+                Defaults to LLM_TIMEOUT seconds from now.
+        """
+        raise NotImplementedError
+
+    def complete(self, messages, model, max_tokens, deadline=None):
+        return "".join(self.stream(messages, model, max_tokens, deadline))
+
+    def close(self):
+        pass
+
+class HTTPBackend(LLMBackend):
+    """
+    Any server speaking the OpenAI chat completions protocol, over a persistent httpx client.
+    """
+    def __init__(self, base_url, api_key=None):
+        import httpx
+        headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+        self.client = httpx.Client(
+            base_url=base_url.rstrip("/"),
+            headers=headers,
+            limits=httpx.Limits(max_keepalive_connections=MAX_KEEPALIVE_CONNECTIONS),
+        )
+        self.max_retries = get_max_retries()
+
+    def open_stream(self, body, deadline):
+        import httpx
+        attempt = 0
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise LLMError(f"{self.name}: no response before the deadline")
+            retry_after = None
+            try:
+                request = self.client.build_request("POST", "/chat/completions", json=body, timeout=remaining)
+                response = self.client.send(request, stream=True)
+            except httpx.TransportError as e:
+                error = LLMError(f"{self.name}: {e}")
+            else:
+                if response.status_code < 400:
+                    return response
+                response.read()
+                response.close()
+                error = LLMError(f"{self.name}: HTTP {response.status_code}: {response.text[:200]}", response.status_code)
+                if not is_retryable(response.status_code):
+                    raise error
+                retry_after = parse_retry_after(response.headers.get("retry-after"))
+
+            attempt += 1
+            if attempt > self.max_retries:
+                raise error
+            delay = retry_after if retry_after is not None else backoff_delay(attempt)
+            if time.monotonic() + delay >= deadline:
+                raise error
+            time.sleep(delay)
+
+    def stream(self, messages, model, max_tokens, deadline=None):
+        deadline = deadline or time.monotonic() + get_deadline_seconds()
+        body = {"model": model, "messages": messages, "max_tokens": max_tokens, "stream": True}
+        response = self.open_stream(body, deadline)
+        try:
+            for line in response.iter_lines():
+                if time.monotonic() > deadline:
+                    raise LLMError(f"{self.name}: response not finished before the deadline")
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
+                choices = json.loads(data).get("choices") or []
+                text = (choices[0].get("delta") or {}).get("content") if choices else None
+                if text:
+                    yield text
+        finally:
+            response.close()
+
+    def close(self):
+        self.client.close()
+
+class OpenAIBackend(HTTPBackend):
+    name = "openai"
+
+    def __init__(self):
+        api_key = os.getenv("OPENAI_API_KEY")
+        if not api_key:
+            raise LLMError("OpenAI API Key not found. Please configure it using 'mug start'.")
+        super().__init__(os.getenv("OPENAI_BASE_URL", DEFAULT_OPENAI_BASE_URL), api_key)
+
+class LocalBackend(HTTPBackend):
+    name = "local"
+
+    def __init__(self):
+        super().__init__(os.getenv("LLM_LOCAL_URL", DEFAULT_LOCAL_BASE_URL), os.getenv("LLM_LOCAL_API_KEY"))
+
+class StubBackend(LLMBackend):
+    """
+    Answers LLM_STUB_RESPONSE (or an echo of the question) after LLM_STUB_DELAY seconds,
+    without any network access.
+    """
+    name = "stub"
+
+    def stream(self, messages, model, max_tokens, deadline=None):
+        delay = float(os.getenv("LLM_STUB_DELAY", "0"))
+        if delay:
+            time.sleep(delay)
+        response = os.getenv("LLM_STUB_RESPONSE") or f"stub answer to: {messages[-1]['content'][-200:]}"
+        for piece in response.split(" "):
+            yield piece + " "
+
+class HedgedBackend(LLMBackend):
+    """
+    Sends each request to `primary`, and also to `secondary` if the primary has not
+    produced a first token within the `percentile` latency of its recent requests.
+    The first backend to produce a token is streamed; the other one is abandoned.
+    """
+    name = "hedged"
+
+    def __init__(self, primary, secondary, percentile=DEFAULT_HEDGE_PERCENTILE):
+        self.primary = primary
+        self.secondary = secondary
+        self.percentile = percentile
+        self.latencies = deque(load_latency_samples(primary.name), maxlen=HEDGE_WINDOW)
+
+    def hedge_delay(self):
+        if len(self.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        ordered = sorted(self.latencies)
+        return ordered[min(int(len(ordered) * self.percentile / 100), len(ordered) - 1)]
+
+    def stream(self, messages, model, max_tokens, deadline=None):
+        deadline = deadline or time.monotonic() + get_deadline_seconds()
+        results = queue.Queue()
+        abandoned = {self.primary: threading.Event(), self.secondary: threading.Event()}
+
+        def run(backend):
+            first = True
+            try:
+                for text in backend.stream(messages, model, max_tokens, deadline):
+                    if first and backend is self.primary:
+                        # Recorded even when the hedge won, or slow primaries would never
+                        # count and the hedge delay would keep shrinking.
+                        self.latencies.append(time.monotonic() - started)
+                    first = False
+                    if abandoned[backend].is_set():
+                        return
+                    results.put((backend, text))
+                results.put((backend, None))
+            except Exception as e:
+                results.put((backend, e))
+
+        def launch(backend):
+            threading.Thread(target=run, args=(backend,), daemon=True).start()
+
+        started = time.monotonic()
+        hedge_at = started + self.hedge_delay()
+        winner = None
+        hedged = False
+        failures = 0
+        launch(self.primary)
+        try:
+            while True:
+                now = time.monotonic()
+                if now >= deadline:
+                    raise LLMError("hedged: no response before the deadline")
+                wait = deadline - now
+                if winner is None and not hedged:
+                    wait = min(wait, max(hedge_at - now, 0))
+                try:
+                    backend, item = results.get(timeout=wait)
+                except queue.Empty:
+                    if winner is None and not hedged and time.monotonic() >= hedge_at:
+                        hedged = True
+                        launch(self.secondary)
+                    continue
+
+                if winner is None:
+                    if isinstance(item, Exception):
+                        failures += 1
+                        if not hedged:
+                            # The primary failed outright; no point waiting for the hedge delay.
+                            hedged = True
+                            launch(self.secondary)
+                        elif failures == 2:
+                            raise item
+                        continue
+                    winner = backend
+                    for other in abandoned:
+                        if other is not winner:
+                            abandoned[other].set()
+
+                if backend is not winner:
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                if item is None:
+                    return
+                yield item
+        finally:
+            for event in abandoned.values():
+                event.set()
+
+    def close(self):
+        self.primary.close()
+        self.secondary.close()
+
+def load_latency_samples(backend_name):
+    """
+    Reads recent time-to-first-token samples of a backend from ~/.mug/llm_latency.jsonl,
+    so a fresh process starts with a realistic hedging delay.
+    """
+    from .chatgpt import LATENCY_LOG_PATH
+    samples = deque(maxlen=HEDGE_WINDOW)
+    try:
+        with open(LATENCY_LOG_PATH, 'r') as latency_log:
+            for line in latency_log:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("backend") == backend_name and not entry.get("cached") and entry.get("ttft"):
+                    samples.append(entry["ttft"])
+    except OSError:
+        pass
+    return list(samples)
+
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "local": LocalBackend,
+    "stub": StubBackend,
+}
+
+def create_backend(name):
+    if name not in BACKENDS:
+        raise LLMError(f"Unknown LLM backend: {name}. Choose one of {', '.join(BACKENDS)}.")
+    return BACKENDS[name]()
+
+def get_backend(name=None):
+    """
+    Returns the configured backend, creating it on first use and reusing it afterwards.
+
+    Args:
+        name (str): The backend name. Defaults to LLM_BACKEND.
+
+    Returns:
+        LLMBackend: The backend, wrapped in a HedgedBackend when LLM_HEDGE_BACKEND is set.
+    """
+    name = name or os.getenv("LLM_BACKEND", DEFAULT_BACKEND)
+    hedge = os.getenv("LLM_HEDGE_BACKEND")
+    key = f"{name}+{hedge}" if hedge else name
+    with _backends_lock:
+        if key not in _backends:
+            if hedge:
+                try:
+                    percentile = float(os.getenv("LLM_HEDGE_PERCENTILE", DEFAULT_HEDGE_PERCENTILE))
+                except ValueError:
+                    percentile = DEFAULT_HEDGE_PERCENTILE
+                _backends[key] = HedgedBackend(create_backend(name), create_backend(hedge), percentile)
+            else:
+                _backends[key] = create_backend(name)
+        return _backends[key]
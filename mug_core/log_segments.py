@@ -0,0 +1,345 @@
+import io
+import os
+import gzip
+import json
+import mmap
+import zlib
+import fcntl
+import argparse
+import threading
+from collections import OrderedDict
+
+# Session logs are rotated into fixed-size segments. The log file itself stays the live,
+# uncompressed tail that the hook appends to; once it grows past LOG_SEGMENT_MB, everything
+# but the entry still being written is compressed into `<log>.segments/NNNNNN.zst` (or `.gz`
+# when the zstandard module is not installed) and listed in `<log>.segments/manifest.json`.
+#
+# Readers see one continuous log: offsets count the uncompressed bytes of every closed segment
+# followed by the live file, so the offset index, retrieval index and digests stay valid across
+# rotations. Segments only ever hold whole entries, so no entry spans two of them.
+SEGMENTS_SUFFIX = ".segments"
+MANIFEST_NAME = "manifest.json"
+DEFAULT_SEGMENT_MB = 8
+# Decompressed segments kept in memory per process.
+SEGMENT_CACHE_SIZE = 2
+TEXT_ENTRY_MARKER = b"\nInput:\n"
+# Marks a directory of session logs shared by several hosts (see storage.py). Shared logs are
+# not rotated: writers on other hosts append to the file by path, and replacing it under them
+# would lose their entries.
+SHARED_MARKER = ".mug-shared"
+
+_segment_cache = OrderedDict()
+# fcntl locks do not exclude threads of one process (the agent's), so rotation and the live
+# file's mappings also take this lock.
+_live_file_lock = threading.RLock()
+
+def get_segments_dir(log_path):
+    return f"{log_path}{SEGMENTS_SUFFIX}"
+
+def is_shared_log(log_path):
+    return os.path.exists(os.path.join(os.path.dirname(os.path.abspath(log_path)), SHARED_MARKER))
+
+def get_manifest_path(log_path):
+    return os.path.join(get_segments_dir(log_path), MANIFEST_NAME)
+
+def get_segment_bytes():
+    try:
+        return int(float(os.getenv("LOG_SEGMENT_MB", DEFAULT_SEGMENT_MB)) * 1024 * 1024)
+    except ValueError:
+        return DEFAULT_SEGMENT_MB * 1024 * 1024
+
+def get_zstd():
+    try:
+        import zstandard
+    except ImportError:
+        return None
+    return zstandard
+
+def get_compression():
+    compression = os.getenv("LOG_COMPRESSION")
+    if compression in ("zstd", "gzip"):
+        return compression
+    return "zstd" if get_zstd() else "gzip"
+
+def compress(data, compression):
+    if compression == "zstd":
+        return get_zstd().ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6)
+
+def decompress(data, name):
+    if name.endswith(".zst"):
+        zstd = get_zstd()
+        if zstd is None:
+            raise RuntimeError(f"Segment {name} is zstd-compressed. Install the 'zstandard' package to read it.")
+        return zstd.ZstdDecompressor().decompressobj().decompress(data)
+    return gzip.decompress(data)
+
+def new_manifest():
+    """
+    `segments` lists the closed segments in order as {name, size, stored, crc}, with `size`
+    the uncompressed length. `uploaded` holds the names already in S3, `etag` the ETag of
+    the remote manifest when it was last read.
+    """
+    return {"format": None, "segments": [], "uploaded": [], "etag": None}
+
+def load_manifest(log_path):
+    try:
+        with open(get_manifest_path(log_path), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+        return dict(new_manifest(), **manifest)
+    except (OSError, ValueError):
+        return new_manifest()
+
+def save_manifest(log_path, manifest):
+    directory = get_segments_dir(log_path)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    path = get_manifest_path(log_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(tmp_path, path)
+
+def get_base_offset(manifest):
+    return sum(segment["size"] for segment in manifest["segments"])
+
+def get_log_size(log_path):
+    """
+    Returns the length of the whole log: closed segments plus the live file.
+    """
+    size = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+    return get_base_offset(load_manifest(log_path)) + size
+
+def read_segment(log_path, segment):
+    """
+    Returns the uncompressed bytes of a closed segment.
+    """
+    path = os.path.join(get_segments_dir(log_path), segment["name"])
+    key = (path, segment["crc"])
+    if key in _segment_cache:
+        _segment_cache.move_to_end(key)
+        return _segment_cache[key]
+    with open(path, 'rb') as segment_file:
+        data = decompress(segment_file.read(), segment["name"])
+    _segment_cache[key] = data
+    while len(_segment_cache) > SEGMENT_CACHE_SIZE:
+        _segment_cache.popitem(last=False)
+    return data
+
+class SegmentedLogReader(io.RawIOBase):
+    """
+    A read-only, seekable file over the closed segments and the live file of a session log.
+    Segments are decompressed only when a read reaches them.
+    """
+    def __init__(self, log_path, manifest):
+        self.log_path = log_path
+        self.spans = []
+        start = 0
+        for segment in manifest["segments"]:
+            self.spans.append((start, segment))
+            start += segment["size"]
+        self.base = start
+        self.live = open(log_path, 'rb') if os.path.exists(log_path) else None
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def size(self):
+        return self.base + (os.fstat(self.live.fileno()).st_size if self.live else 0)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        self.position = max(offset, 0)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def readinto(self, buffer):
+        if self.position >= self.base:
+            if self.live is None:
+                return 0
+            self.live.seek(self.position - self.base)
+            count = self.live.readinto(buffer)
+        else:
+            count = 0
+            for start, segment in self.spans:
+                if start <= self.position < start + segment["size"]:
+                    data = read_segment(self.log_path, segment)
+                    chunk = data[self.position - start:self.position - start + len(buffer)]
+                    count = len(chunk)
+                    buffer[:count] = chunk
+                    break
+        self.position += count
+        return count
+
+    def close(self):
+        if self.live is not None:
+            self.live.close()
+        super().close()
+
+def open_session_log(log_path):
+    """
+    Opens a session log for reading in binary mode, closed segments included.
+    Logs that were never rotated are opened as plain files.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        file: A seekable binary file object.
+    """
+    manifest = load_manifest(log_path)
+    if not manifest["segments"]:
+        return open(log_path, 'rb')
+    return io.BufferedReader(SegmentedLogReader(log_path, manifest))
+
+def iter_log_views(log_path, reverse=False):
+    """
+    Yields (offset, data, closed) for each closed segment and then the live file, whose data
+    is a read-only mmap. Every view holds whole entries, so text readers can search them for
+    entry markers independently; only the live file can end in an unfinished entry.
+    With `reverse`, the live file comes first.
+    """
+    manifest = load_manifest(log_path)
+    views = []
+    start = 0
+    for segment in manifest["segments"]:
+        views.append((start, segment))
+        start += segment["size"]
+    views.append((start, None))
+    for offset, segment in (reversed(views) if reverse else views):
+        if segment is not None:
+            yield offset, read_segment(log_path, segment), True
+            continue
+        if not os.path.exists(log_path):
+            continue
+        with _live_file_lock, open(log_path, 'rb') as log_file:
+            # Rotation truncates the live file in place; the shared lock keeps it from doing
+            # so under the mapping.
+            fcntl.lockf(log_file, fcntl.LOCK_SH)
+            if os.fstat(log_file.fileno()).st_size == 0:
+                continue
+            with mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+                yield offset, log_map, False
+
+def find_rotation_point(data, log_format):
+    """
+    Returns how many leading bytes of the live file form whole, finished entries.
+    The last text entry may still be receiving output, so it always stays live.
+    """
+    if log_format == "structured":
+        return data.rfind(b"\n") + 1
+    return data.rfind(TEXT_ENTRY_MARKER) + 1
+
+def rotate_session_log(log_path, log_format, max_bytes=None):
+    """
+    Moves the finished entries of the live file into a new compressed segment once the
+    file is larger than `max_bytes`.
+
+    Everything happens under the fcntl lock every appender takes (see
+    session_log.append_to_log), and the live file is cut in place: the remaining bytes are
+    copied to its start and it is truncated, so a command still teeing into it through an
+    O_APPEND descriptor keeps writing to the log and not to an unlinked file. The manifest
+    is written before the cut, so a crash in between can only leave the moved entries
+    visible twice, never lose them.
+
+    Args:
+        log_path (str): The session log file.
+        log_format (str): "text" or "structured".
+        max_bytes (int): The rotation size. Defaults to LOG_SEGMENT_MB.
+
+    Returns:
+        bool: True if a segment was closed.
+    """
+    max_bytes = max_bytes if max_bytes is not None else get_segment_bytes()
+    if max_bytes <= 0 or not os.path.exists(log_path) or os.path.getsize(log_path) < max_bytes:
+        return False
+    with _live_file_lock, open(log_path, 'r+b') as log_file:
+        fcntl.lockf(log_file, fcntl.LOCK_EX)
+        data = log_file.read()
+        cut = find_rotation_point(data, log_format)
+        if len(data) < max_bytes or cut <= 0:
+            return False
+
+        closed = data[:cut]
+        manifest = load_manifest(log_path)
+        compression = get_compression()
+        name = f"{len(manifest['segments']) + 1:06d}.{'zst' if compression == 'zstd' else 'gz'}"
+        stored = compress(closed, compression)
+        directory = get_segments_dir(log_path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        segment_path = os.path.join(directory, name)
+        with open(f"{segment_path}.tmp", 'wb') as segment_file:
+            segment_file.write(stored)
+        os.replace(f"{segment_path}.tmp", segment_path)
+
+        manifest["format"] = log_format
+        manifest["segments"].append({"name": name, "size": len(closed), "stored": len(stored), "crc": zlib.crc32(closed)})
+        save_manifest(log_path, manifest)
+
+        # Writers that do not lock (the hook's tee, in another terminal of the session) may
+        # have appended since the read, and may go on while the tail is copied down. Their
+        # bytes land past the old end; they are carried over until the size stops changing,
+        # which leaves only the instant between the last check and the truncate uncovered.
+        log_file.seek(len(data))
+        live = data[cut:] + log_file.read()
+        log_file.seek(0)
+        log_file.write(live)
+        log_file.flush()
+        live_size = len(live)
+        end = cut + live_size
+        while True:
+            size = os.fstat(log_file.fileno()).st_size
+            if size <= end:
+                break
+            log_file.seek(end)
+            extra = log_file.read(size - end)
+            log_file.seek(live_size)
+            log_file.write(extra)
+            log_file.flush()
+            live_size += len(extra)
+            end += len(extra)
+        log_file.truncate(live_size)
+    return True
+
+def rotation_due(log_path):
+    if os.getenv("SYNC_MODE") == "incremental" or is_shared_log(log_path):
+        return False
+    return os.path.exists(log_path) and os.path.getsize(log_path) >= get_segment_bytes() > 0
+
+def maybe_rotate_session_log(log_path):
+    """
+    Rotates the log if it is over size. It is called by the log writers, between commands.
+    Logs synced incrementally are left alone: that mode already moves only new bytes, and
+    its sync state tracks offsets in the live file. So are logs in a shared directory.
+    While an upload is reading the log it is not rotated either; the next command does it.
+    """
+    if not rotation_due(log_path):
+        return False
+    from .aws_s3 import locked_session
+    from .session_log import detect_log_format
+    try:
+        with locked_session(log_path, blocking=False) as locked:
+            return locked and rotate_session_log(log_path, detect_log_format(log_path))
+    except Exception as e:
+        print(f"Error rotating the session log: {e}")
+        return False
+
+def rotate_command(args):
+    """
+    Entry point of `mug_core rotate --log <session log>`, run by the hook between commands
+    for text logs written with tee.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core rotate")
+    parser.add_argument("--log", required=True, help="The session log file.")
+    options = parser.parse_args(args)
+    maybe_rotate_session_log(options.log)
@@ -1,24 +1,76 @@
 import sys
-from .api import set_api_keys, load_session_log
-from .chatgpt import ask_chatgpt
 
 def main():
     """
-    Main function to handle different commands: start, end, and questions.
+    Main function to handle different commands: start, end, manifest, agent, stats, usage, search, follow, speculate, explain, and questions.
 
     Returns:
         None
     """
     if len(sys.argv) > 1:
         if sys.argv[1] == "start":
+            from .api import set_api_keys
             set_api_keys()
+        elif sys.argv[1] == "manifest":
+            from .api import write_session_manifest
+            write_session_manifest()
         elif sys.argv[1] == "end":
             print("Ending session.")
+        elif sys.argv[1] == "capture":
+            from .capture import capture_main
+            capture_main(sys.argv[2:])
+        elif sys.argv[1] == "record":
+            from .session_log import record_command
+            record_command(sys.argv[2:])
+        elif sys.argv[1] == "rotate":
+            from .log_segments import rotate_command
+            rotate_command(sys.argv[2:])
+        elif sys.argv[1] == "convert":
+            from .session_log import convert_command
+            convert_command(sys.argv[2:])
+        elif sys.argv[1] == "batch":
+            from .batch import batch_command
+            batch_command(sys.argv[2:])
+        elif sys.argv[1] == "upload":
+            from .upload_queue import upload_command
+            upload_command(sys.argv[2:])
+        elif sys.argv[1] == "summarize":
+            from .summarize import summarize_command
+            summarize_command(sys.argv[2:])
+        elif sys.argv[1] == "agent":
+            from .agent import agent_command
+            agent_command(sys.argv[2:])
+        elif sys.argv[1] == "stats":
+            from .tracing import stats_command
+            stats_command(sys.argv[2:])
+        elif sys.argv[1] == "usage":
+            from .usage import usage_command
+            usage_command(sys.argv[2:])
+        elif sys.argv[1] == "search":
+            from .search import search_command
+            search_command(sys.argv[2:])
+        elif sys.argv[1] == "follow":
+            from .follow import follow_command
+            follow_command(sys.argv[2:])
+        elif sys.argv[1] == "speculate":
+            from .speculate import speculate_command
+            speculate_command(sys.argv[2:])
+        elif sys.argv[1] == "explain":
+            from .speculate import explain_command
+            explain_command(sys.argv[2:])
         else:
-            question = " ".join(sys.argv[1:])
-            context = load_session_log()
-            response = ask_chatgpt(question, context)
-            print(f"ChatGPT response: {response}")
+            from .api import load_session_log, load_session_log_file
+            from .chatgpt import print_chatgpt_response
+            from .speculate import find_prepared_analysis
+            from .tracing import span
+            with span("cli.ask"):
+                question = " ".join(sys.argv[1:])
+                prepared = find_prepared_analysis(question, load_session_log_file())
+                if prepared is not None:
+                    print(f"ChatGPT response: {prepared}")
+                    return
+                context = load_session_log(question=question)
+                print_chatgpt_response(question, context)
 
 if __name__ == "__main__":
     main()
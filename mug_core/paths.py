@@ -0,0 +1,6 @@
+import os
+
+# Where mug keeps its config, session logs and state. Kept free of imports beyond the standard
+# library, so modules on the question path can use it without pulling in the AWS SDK.
+LOG_DIR = os.path.expanduser("~/.mug")
+LOCAL_COUNTER_PATH = os.path.join(LOG_DIR, "session_counter.json")
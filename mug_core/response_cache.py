@@ -0,0 +1,232 @@
+import os
+import re
+import json
+import time
+import hashlib
+
+from .paths import LOG_DIR
+
+# Answers are cached under ~/.mug/cache, one JSON file per (model, question, context) key.
+# Files are touched on every hit, so evicting the oldest mtime first is LRU.
+# In an S3 or shared-directory session the entries are also stored next to the session log,
+# through its storage backend (`<session key>.cache/` in the bucket, `<log>.cache/` in the
+# shared directory), so an answer one participant paid for serves everyone else. The shared
+# cache is bounded by the same CACHE_TTL and CACHE_MAX_BYTES, checked on every write.
+CACHE_DIR = os.path.join(LOG_DIR, "cache")
+DEFAULT_CACHE_TTL = 24 * 60 * 60
+DEFAULT_CACHE_MAX_BYTES = 16 * 1024 * 1024
+SHARED_CACHE_SUFFIX = ".cache/"
+
+def cache_enabled():
+    return os.getenv("RESPONSE_CACHE", "true") == "true"
+
+def get_cache_ttl():
+    try:
+        return float(os.getenv("CACHE_TTL", DEFAULT_CACHE_TTL))
+    except ValueError:
+        return DEFAULT_CACHE_TTL
+
+def get_cache_max_bytes():
+    try:
+        return int(os.getenv("CACHE_MAX_BYTES", DEFAULT_CACHE_MAX_BYTES))
+    except ValueError:
+        return DEFAULT_CACHE_MAX_BYTES
+
+def normalize_question(question):
+    """
+    Lowercases the question, collapses whitespace and drops trailing punctuation,
+    so trivially different phrasings of the same question share an entry.
+    """
+    question = re.sub(r'\s+', ' ', question.strip().lower())
+    return question.rstrip('?!. ')
+
+def get_cache_key(model, question, context):
+    """
+    Builds the cache key from the model, the normalized question and a hash of the exact context.
+
+    Args:
+        model (str): The model name.
+        question (str): The question.
+        context (str): The context sent with it.
+
+    Returns:
+        str: A hex digest.
+    """
+    context_hash = hashlib.sha256(context.encode()).hexdigest()
+    material = "\0".join([model, normalize_question(question), context_hash])
+    return hashlib.sha256(material.encode()).hexdigest()
+
+def get_shared_location():
+    """
+    Returns (storage backend, session log, session key) of the session's shared cache,
+    or None for sessions on this machine only.
+    """
+    from .api import load_existing_config
+    from .storage import STORAGE_LOCAL, STORAGE_S3, get_session_file, get_storage_backend
+    config = load_existing_config() or {}
+    storage = get_storage_backend(config)
+    session_log_name = config.get("SESSION_LOG_NAME")
+    if storage.name == STORAGE_LOCAL or not session_log_name:
+        return None
+    if storage.name == STORAGE_S3 and not storage.bucket_name:
+        return None
+    return storage, get_session_file(config), config.get("S3_KEY") or session_log_name
+
+def is_fresh(entry):
+    return time.time() - entry.get("created", 0) <= get_cache_ttl()
+
+def read_local(key):
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    try:
+        with open(path, 'r') as cache_file:
+            entry = json.load(cache_file)
+    except (OSError, ValueError):
+        return None
+    if not is_fresh(entry):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    os.utime(path)
+    return entry
+
+def write_local(key, entry):
+    if not os.path.exists(CACHE_DIR):
+        os.makedirs(CACHE_DIR)
+    path = os.path.join(CACHE_DIR, f"{key}.json")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as cache_file:
+        json.dump(entry, cache_file)
+    os.replace(tmp_path, path)
+    evict()
+
+def read_shared(key):
+    location = get_shared_location()
+    if location is None:
+        return None
+    storage, local_file, s3_key = location
+    data = storage.read_session_object(local_file, s3_key, f"{SHARED_CACHE_SUFFIX}{key}.json")
+    if data is None:
+        return None
+    entry = json.loads(data)
+    if not is_fresh(entry):
+        storage.delete_session_objects(local_file, s3_key, [f"{SHARED_CACHE_SUFFIX}{key}.json"])
+        return None
+    return entry
+
+def write_shared(key, entry):
+    location = get_shared_location()
+    if location is None:
+        return
+    storage, local_file, s3_key = location
+    storage.write_session_object(local_file, s3_key, f"{SHARED_CACHE_SUFFIX}{key}.json", json.dumps(entry).encode())
+    evict_shared(storage, local_file, s3_key)
+
+def evict_shared(storage, local_file, s3_key):
+    """
+    Bounds the shared cache like the local one: expired entries are deleted, then the
+    oldest until it fits in CACHE_MAX_BYTES. Shared entries are not touched on a hit,
+    so they age by when they were written.
+    """
+    entries = []
+    stale = []
+    total = 0
+    now = time.time()
+    ttl = get_cache_ttl()
+    for name, size, mtime in storage.list_session_objects(local_file, s3_key, SHARED_CACHE_SUFFIX):
+        if not name.endswith(".json"):
+            continue
+        if now - mtime > ttl:
+            stale.append(name)
+            continue
+        entries.append((mtime, size, name))
+        total += size
+
+    limit = get_cache_max_bytes()
+    for mtime, size, name in sorted(entries):
+        if total <= limit:
+            break
+        stale.append(name)
+        total -= size
+    if stale:
+        storage.delete_session_objects(local_file, s3_key, stale)
+
+def evict():
+    """
+    Drops expired entries, then the least recently used ones until the cache fits
+    in CACHE_MAX_BYTES.
+    """
+    entries = []
+    total = 0
+    now = time.time()
+    ttl = get_cache_ttl()
+    for name in os.listdir(CACHE_DIR):
+        if not name.endswith(".json"):
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        if now - stat.st_mtime > ttl:
+            # Not even read within the TTL, so it is certainly stale.
+            os.unlink(path)
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+        total += stat.st_size
+
+    limit = get_cache_max_bytes()
+    for mtime, size, path in sorted(entries):
+        if total <= limit:
+            break
+        os.unlink(path)
+        total -= size
+
+def get_cached_response(model, question, context):
+    """
+    Looks an answer up in the local cache, then in the session's shared cache.
+
+    Args:
+        model (str): The model name.
+        question (str): The question.
+        context (str): The context sent with it.
+
+    Returns:
+        str: The cached response, or None on a miss.
+    """
+    if not cache_enabled():
+        return None
+    key = get_cache_key(model, question, context)
+    entry = read_local(key)
+    if entry is None:
+        try:
+            entry = read_shared(key)
+        except Exception as e:
+            print(f"Error reading the shared response cache: {e}")
+        if entry is not None:
+            write_local(key, entry)
+    return entry["response"] if entry else None
+
+def put_cached_response(model, question, context, response):
+    """
+    Stores an answer in the local cache and the session's shared cache.
+
+    Args:
+        model (str): The model name.
+        question (str): The question.
+        context (str): The context sent with it.
+        response (str): The answer.
+
+    Returns:
+        None
+    """
+    if not cache_enabled():
+        return
+    key = get_cache_key(model, question, context)
+    entry = {"model": model, "question": question, "response": response, "created": time.time()}
+    try:
+        write_local(key, entry)
+        write_shared(key, entry)
+    except Exception as e:
+        print(f"Error writing the response cache: {e}")
@@ -0,0 +1,390 @@
+import os
+import re
+import json
+import math
+import zlib
+import sqlite3
+import hashlib
+from collections import Counter
+
+from .context import ENTRY_MARKER, count_tokens, build_context, get_context_token_budget
+from .log_segments import get_log_size, is_shared_log, iter_log_views, open_session_log
+from .paths import LOG_DIR
+from .session_log import (
+    INDEX_ENTRY,
+    LOG_FORMAT_STRUCTURED,
+    detect_log_format,
+    format_record,
+    get_index_path,
+    update_index,
+)
+
+# Per-session BM25 index over command entries, in SQLite next to the log as `<log>.bm25.sqlite3`.
+# An update tokenizes and inserts only the entries appended since the last one, and a query
+# reads only the postings of its terms, so neither costs more as the session grows.
+# SQLite's locking is not reliable over NFS, so the index of a log in a shared directory is
+# kept on this machine, in ~/.mug/retrieval/.
+RETRIEVAL_SUFFIX = ".bm25.sqlite3"
+SHARED_RETRIEVAL_DIR = os.path.join(LOG_DIR, "retrieval")
+EMBEDDINGS_SUFFIX = ".embeddings.json"
+BM25_K1 = 1.2
+BM25_B = 0.75
+DEFAULT_TOP_K = 5
+DEFAULT_RECENT_ENTRIES = 3
+EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+TOKEN_PATTERN = re.compile(r'[a-z0-9_]{2,}')
+# Bytes hashed just before the indexed position to notice a log rewritten under the index.
+CHECK_BYTES = 64
+
+_embedder = None
+
+RETRIEVAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (id INTEGER PRIMARY KEY, first INTEGER, second INTEGER, length INTEGER);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT, doc_id INTEGER, frequency INTEGER, length INTEGER, PRIMARY KEY (term, doc_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def get_retrieval_index_path(log_path):
+    if is_shared_log(log_path):
+        log_path = os.path.abspath(log_path)
+        name = f"{hashlib.sha256(log_path.encode()).hexdigest()[:16]}-{os.path.basename(log_path)}"
+        return os.path.join(SHARED_RETRIEVAL_DIR, f"{name}{RETRIEVAL_SUFFIX}")
+    return f"{log_path}{RETRIEVAL_SUFFIX}"
+
+def tokenize(text):
+    return TOKEN_PATTERN.findall(text.lower())
+
+def new_retrieval_state(log_format):
+    return {"format": log_format, "position": 0, "check": 0, "doc_count": 0, "total_length": 0}
+
+class RetrievalIndex:
+    """
+    A session's BM25 index as of its last update: how far into the log it reaches, its
+    document count and total length, and lookups of documents and postings. It holds the
+    index's database connection open until it is closed, or its `with` block ends.
+    """
+    def __init__(self, db, state):
+        self.db = db
+        self.format = state["format"]
+        self.position = state["position"]
+        self.doc_count = state["doc_count"]
+        self.total_length = state["total_length"]
+
+    def get_doc(self, doc_id):
+        """
+        Returns the (first, second, length) of a document: its locator and its term count.
+        """
+        return self.db.execute("SELECT first, second, length FROM docs WHERE id = ?", (doc_id,)).fetchone()
+
+    def get_postings(self, term):
+        """
+        Returns the (doc_id, frequency, doc length) of every document holding `term`.
+        """
+        return self.db.execute("SELECT doc_id, frequency, length FROM postings WHERE term = ?", (term,)).fetchall()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def position_check(log_path, log_format, position):
+    """
+    Fingerprints the log just before `position` so a rewritten log is detected.
+    """
+    if position == 0:
+        return 0
+    if log_format == LOG_FORMAT_STRUCTURED:
+        path = get_index_path(log_path)
+        start, end = (position - 1) * INDEX_ENTRY.size, position * INDEX_ENTRY.size
+        if not os.path.exists(path) or os.path.getsize(path) < end:
+            return None
+        opener = open(path, 'rb')
+    else:
+        start, end = max(position - CHECK_BYTES, 0), position
+        if not os.path.exists(log_path) or get_log_size(log_path) < end:
+            return None
+        opener = open_session_log(log_path)
+    with opener as file:
+        file.seek(start)
+        return zlib.crc32(file.read(end - start))
+
+def iter_new_entries(log_path, log_format, position):
+    """
+    Yields (locator, text, next_position) for each complete entry after `position`.
+    Text logs locate entries by byte range, structured logs by their offset index entry.
+    Both count offsets across the closed segments of a rotated log.
+    The last text entry may still be growing, so it is left for the next update.
+    """
+    if log_format == LOG_FORMAT_STRUCTURED:
+        update_index(log_path)
+        index_path = get_index_path(log_path)
+        if not os.path.exists(index_path):
+            return
+        with open(index_path, 'rb') as index_file, open_session_log(log_path) as log_file:
+            index_file.seek(position * INDEX_ENTRY.size)
+            data = index_file.read()
+            for offset, length, ts, host in INDEX_ENTRY.iter_unpack(data[:len(data) - len(data) % INDEX_ENTRY.size]):
+                log_file.seek(offset)
+                position += 1
+                yield [offset, length], format_record(json.loads(log_file.read(length))), position
+        return
+
+    for offset, log_map, closed in iter_log_views(log_path):
+        if offset + len(log_map) <= position:
+            continue
+        start = max(position - offset, 0)
+        while True:
+            marker = log_map.find(ENTRY_MARKER, start + 1)
+            if marker == -1:
+                if not closed or start >= len(log_map):
+                    break
+                # A closed segment ends with a finished entry.
+                marker = len(log_map) - 1
+            end = marker + 1
+            yield [offset + start, offset + end], log_map[start:end].decode(errors='replace'), offset + end
+            start = end
+        if not closed:
+            return
+
+def open_retrieval_index(log_path):
+    path = get_retrieval_index_path(log_path)
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, timeout=30, isolation_level=None)
+    db.executescript(RETRIEVAL_SCHEMA)
+    return db
+
+def load_retrieval_state(db, log_path, log_format):
+    """
+    Returns the index's state, or a new one (with the index emptied) if it was built for
+    another format or the log was rewritten underneath it.
+    """
+    row = db.execute("SELECT value FROM meta WHERE key = 'state'").fetchone()
+    if row is not None:
+        try:
+            state = json.loads(row[0])
+            if state.get("format") == log_format and state["check"] == position_check(log_path, log_format, state["position"]):
+                return state
+        except (OSError, ValueError, KeyError):
+            pass
+        db.execute("DELETE FROM postings")
+        db.execute("DELETE FROM docs")
+    return new_retrieval_state(log_format)
+
+def update_retrieval_index(log_path):
+    """
+    Adds the entries appended since the last update to the session's BM25 index
+    (and to its embeddings, when RETRIEVAL_EMBEDDINGS=true). Only the new entries are
+    written. The index is rebuilt from scratch only if the log was rewritten underneath it.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        RetrievalIndex: The up-to-date index, to be closed by the caller.
+    """
+    log_format = detect_log_format(log_path)
+    db = open_retrieval_index(log_path)
+    try:
+        state = write_new_entries(db, log_path, log_format)
+    except BaseException:
+        db.close()
+        raise
+    return RetrievalIndex(db, state)
+
+def write_new_entries(db, log_path, log_format):
+    """
+    Indexes the entries appended since the last update in one write transaction, and
+    returns the index's new state.
+    """
+    # The write lock is taken up front, so concurrent updates never number docs alike.
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        state = load_retrieval_state(db, log_path, log_format)
+        new_texts = []
+        position = state["position"]
+        if os.path.exists(log_path):
+            for locator, text, position in iter_new_entries(log_path, log_format, position):
+                terms = Counter(tokenize(text))
+                length = sum(terms.values())
+                doc_id = state["doc_count"]
+                db.execute("INSERT INTO docs (id, first, second, length) VALUES (?, ?, ?, ?)", (doc_id, locator[0], locator[1], length))
+                # The doc length is repeated in its postings so that ranking reads the postings alone.
+                db.executemany("INSERT INTO postings (term, doc_id, frequency, length) VALUES (?, ?, ?, ?)",
+                               [(term, doc_id, frequency, length) for term, frequency in terms.items()])
+                state["doc_count"] += 1
+                state["total_length"] += length
+                new_texts.append(text)
+
+        if position != state["position"]:
+            state["position"] = position
+            state["check"] = position_check(log_path, log_format, position)
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('state', ?)", (json.dumps(state),))
+        db.execute("COMMIT")
+    except BaseException:
+        db.execute("ROLLBACK")
+        raise
+    if new_texts and embeddings_enabled():
+        update_embeddings(log_path, new_texts, state["doc_count"] - len(new_texts))
+    return state
+
+def bm25_scores(index, query):
+    """
+    Scores every document of the index that shares a term with `query`.
+
+    Returns:
+        dict: doc_id -> BM25 score.
+    """
+    if not index.doc_count:
+        return {}
+    average_length = index.total_length / index.doc_count or 1.0
+    scores = {}
+    for term in set(tokenize(query)):
+        postings = index.get_postings(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (index.doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        for doc_id, frequency, length in postings:
+            norm = frequency + BM25_K1 * (1 - BM25_B + BM25_B * length / average_length)
+            scores[doc_id] = scores.get(doc_id, 0.0) + idf * frequency * (BM25_K1 + 1) / norm
+    return scores
+
+def embeddings_enabled():
+    return os.getenv("RETRIEVAL_EMBEDDINGS", "false") == "true"
+
+def get_embedder():
+    """
+    Returns a local sentence-transformers model, or None if it is not installed.
+    """
+    global _embedder
+    if _embedder is None:
+        try:
+            from sentence_transformers import SentenceTransformer
+        except ImportError:
+            _embedder = False
+            return None
+        _embedder = SentenceTransformer(os.getenv("RETRIEVAL_EMBEDDING_MODEL", EMBEDDING_MODEL))
+    return _embedder or None
+
+def update_embeddings(log_path, texts, first_doc_id):
+    embedder = get_embedder()
+    if embedder is None:
+        return
+    path = f"{log_path}{EMBEDDINGS_SUFFIX}"
+    vectors = []
+    if os.path.exists(path):
+        with open(path, 'r') as vectors_file:
+            vectors = json.load(vectors_file)
+    if len(vectors) != first_doc_id:
+        # Out of step with the BM25 index; only embed what lines up.
+        vectors = vectors[:first_doc_id]
+        if len(vectors) != first_doc_id:
+            return
+    vectors.extend(vector.tolist() for vector in embedder.encode(texts, normalize_embeddings=True))
+    with open(path, 'w') as vectors_file:
+        json.dump(vectors, vectors_file)
+
+def embedding_scores(log_path, query, doc_count):
+    embedder = get_embedder()
+    path = f"{log_path}{EMBEDDINGS_SUFFIX}"
+    if embedder is None or not os.path.exists(path):
+        return {}
+    with open(path, 'r') as vectors_file:
+        vectors = json.load(vectors_file)
+    if len(vectors) != doc_count:
+        return {}
+    query_vector = embedder.encode([query], normalize_embeddings=True)[0].tolist()
+    return {doc_id: sum(a * b for a, b in zip(vector, query_vector)) for doc_id, vector in enumerate(vectors)}
+
+def search_entries(log_path, query, top_k=DEFAULT_TOP_K):
+    """
+    Finds the entries of a session most relevant to `query`.
+
+    Args:
+        log_path (str): The session log file.
+        query (str): The question.
+        top_k (int): How many entries to return.
+
+    Returns:
+        tuple: The (doc_id, score) pairs, best first, and the up-to-date index, to be closed
+        by the caller.
+    """
+    index = update_retrieval_index(log_path)
+    try:
+        scores = bm25_scores(index, query)
+        if embeddings_enabled():
+            dense = embedding_scores(log_path, query, index.doc_count)
+            if dense:
+                # Scale BM25 into [0, 1] so both signals count about equally.
+                top = max(scores.values(), default=0.0) or 1.0
+                scores = {doc_id: scores.get(doc_id, 0.0) / top + dense.get(doc_id, 0.0)
+                          for doc_id in set(scores) | set(dense)}
+    except BaseException:
+        index.close()
+        raise
+    ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [(doc_id, score) for doc_id, score in ranked[:top_k] if score > 0], index
+
+def read_entry(log_path, index, doc_id):
+    first, second, terms = index.get_doc(doc_id)
+    return read_locator(log_path, index.format, first, second)
+
+def read_locator(log_path, log_format, first, second):
+    # Structured entries are located by (offset, length), text entries by (start, end).
+    with open_session_log(log_path) as log_file:
+        log_file.seek(first)
+        if log_format == LOG_FORMAT_STRUCTURED:
+            return format_record(json.loads(log_file.read(second)))
+        return log_file.read(second - first).decode(errors='replace')
+
+def build_retrieval_context(log_path, question, token_budget=None, top_k=DEFAULT_TOP_K, recent_entries=DEFAULT_RECENT_ENTRIES, model=None):
+    """
+    Builds the prompt context from the entries most relevant to `question` plus the
+    most recent entries. Half of the budget is reserved for the recent entries.
+
+    Args:
+        log_path (str): The session log file.
+        question (str): The user's question.
+        token_budget (int): Maximum tokens of context. Defaults to CONTEXT_TOKEN_BUDGET.
+        top_k (int): How many relevant entries to include at most.
+        recent_entries (int): How many of the latest entries to include at most.
+        model (str): The model whose tokenizer to count with.
+
+    Returns:
+        str: The context, relevant entries first, then the recent ones.
+    """
+    if not os.path.exists(log_path):
+        return ""
+    budget = token_budget if token_budget is not None else get_context_token_budget()
+    ranked, index = search_entries(log_path, question, top_k)
+    with index:
+        # The newest entries are not in the index yet, or only just; take them from the tail.
+        recent = build_context(log_path, budget // 2, model)
+        recent_parts = recent.split(ENTRY_MARKER.decode())
+        if len(recent_parts) > recent_entries + 1:
+            recent = "Input:\n" + "\nInput:\n".join(recent_parts[-recent_entries:])
+        used = count_tokens(recent, model)
+
+        chosen = []
+        for doc_id, score in ranked:
+            entry = read_entry(log_path, index, doc_id)
+            if entry.strip() and entry.strip() in recent:
+                continue
+            tokens = count_tokens(entry, model)
+            if used + tokens > budget:
+                continue
+            chosen.append((doc_id, entry))
+            used += tokens
+
+    if not chosen:
+        return recent
+    chosen.sort()
+    relevant = "".join(entry for doc_id, entry in chosen)
+    return f"Relevant earlier commands:\n{relevant}\nMost recent commands:\n{recent}"
@@ -0,0 +1,74 @@
+# Minimal client for the mug agent, called from command_hook.sh.
+# It deliberately imports nothing from mug_core (run it with `python3 -S`) so that
+# talking to a warm agent costs one bare interpreter start instead of a boto3 import.
+#
+# Usage: agent_client.py <op> [key=value ...]
+# A key given more than once is sent as a list.
+# Exit status: 0 on success, 1 if the agent reported an error or went away, 2 if no agent is reachable.
+# An agent that does not take the request within MUG_AGENT_TIMEOUT seconds (2 by default) counts
+# as unreachable, so the hook runs the request itself instead of hanging the prompt.
+import os
+import sys
+import json
+import socket
+
+DEFAULT_TIMEOUT = 2.0
+
+def get_timeout():
+    try:
+        return float(os.getenv("MUG_AGENT_TIMEOUT", DEFAULT_TIMEOUT))
+    except ValueError:
+        return DEFAULT_TIMEOUT
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: agent_client.py <op> [key=value ...]")
+        return 1
+
+    socket_path = os.getenv("MUG_AGENT_SOCKET", os.path.expanduser("~/.mug/agent.sock"))
+    request = {"op": sys.argv[1]}
+    for arg in sys.argv[2:]:
+        key, _, value = arg.partition("=")
+        if key in request:
+            previous = request[key]
+            request[key] = (previous if isinstance(previous, list) else [previous]) + [value]
+        else:
+            request[key] = value
+
+    # The agent answers {"accepted": true} as soon as it takes the request. Until then,
+    # giving up is safe: the agent does not run a request whose client has closed the socket.
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(get_timeout())
+        sock.connect(socket_path)
+        sock.sendall((json.dumps(request) + "\n").encode())
+        response_file = sock.makefile('rb')
+        if "accepted" not in json.loads(response_file.readline() or "{}"):
+            raise ValueError("no acceptance")
+        # Once taken, the request runs as long as it needs to, like a streaming LLM answer.
+        sock.settimeout(None)
+    except (OSError, ValueError):
+        sock.close()
+        return 2
+
+    # Output is streamed back as {"chunk": ...} lines and ends with {"ok": ...}.
+    # Closing the socket on Ctrl-C tells the agent to stop, e.g. a streaming LLM answer.
+    try:
+        with sock, response_file:
+            for line in response_file:
+                message = json.loads(line)
+                if "chunk" in message:
+                    sys.stdout.write(message["chunk"])
+                    sys.stdout.flush()
+                else:
+                    return 0 if message.get("ok") else 1
+    except KeyboardInterrupt:
+        sys.stdout.write("\n[cancelled]\n")
+        return 130
+    except (OSError, ValueError):
+        pass
+    sys.stdout.write("The mug agent stopped before finishing the request.\n")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
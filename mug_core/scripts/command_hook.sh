@@ -1,100 +1,189 @@
-# Use Python to read the SESSION_LOG_NAME from ~/.mug/config.json
-SESSION_FILE=$(python3 -c '
-import json
-import os
-
-config_path = os.path.expanduser("~/.mug/config.json")
-if os.path.exists(config_path):
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
-        session_log_name = config.get("SESSION_LOG_NAME", None)
-        if session_log_name:
-            print(os.path.expanduser("~/.mug/") + session_log_name)
-')
+# $EPOCHREALTIME, for command timings in structured logs and trace spans
+zmodload zsh/datetime
+# `zsystem flock`, for locked appends to logs in a shared directory
+zmodload zsh/system
+# `zstat`, so checking whether the log is due for rotation starts no process
+zmodload -F zsh/stat b:zstat
+
+# Latency spans for `mug --stats` (see mug_core/tracing.py), appended with printf so tracing
+# starts no process. Usage: trace_span <phase> <start $EPOCHREALTIME>. MUG_TRACE=false turns it off.
+MUG_TRACE_FILE="$HOME/.mug/trace.jsonl"
+function trace_span() {
+    [ "$MUG_TRACE" = "false" ] && return
+    printf '{"t":%.3f,"p":"%s","d":%.2f,"h":"%s"}\n' "$2" "$1" "$(( (EPOCHREALTIME - $2) * 1000 ))" "${HOST:-$(hostname)}" >> "$MUG_TRACE_FILE"
+}
+
+# Session settings (SESSION_FILE, STORAGE_BACKEND, BUCKET_NAME, S3_KEY, NO_AWS, SYNC_MODE, LOG_FORMAT) come from
+# ~/.mug/session.env, which `mug_core start` compiles from ~/.mug/config.json.
+# It is only recompiled, with a single python3 start, if the config changed since.
+mug_config_start=$EPOCHREALTIME
+MUG_MANIFEST="$HOME/.mug/session.env"
+if [ ! -f "$MUG_MANIFEST" ] || [ "$HOME/.mug/config.json" -nt "$MUG_MANIFEST" ]; then
+    mug_core manifest
+fi
+source "$MUG_MANIFEST"
+trace_span hook.load_config "$mug_config_start"
+unset mug_config_start
 
 if [ -z "$SESSION_FILE" ]; then
     echo "Session log file not found in config.json."
     exit 1
 fi
 
-BUCKET_NAME=$(python3 -c '
-import json
-import os
-
-config_path = os.path.expanduser("~/.mug/config.json")
-if os.path.exists(config_path):
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
-        bucket_name = config.get("BUCKET_NAME", None)
-        if bucket_name:
-            print(bucket_name)
-')
-
-S3_KEY=$(python3 -c '
-import json
-import os
-
-config_path = os.path.expanduser("~/.mug/config.json")
-if os.path.exists(config_path):
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
-        session_log_name = config.get("SESSION_LOG_NAME", None)
-        if session_log_name:
-            print(session_log_name)
-')
-
-NO_AWS=$(python3 -c '
-import json
-import os
-
-config_path = os.path.expanduser("~/.mug/config.json")
-if os.path.exists(config_path):
-    with open(config_path, "r") as config_file:
-        config = json.load(config_file)
-        no_aws = config.get("NO_AWS", False)
-        print(no_aws)
-')
+# Optional long-lived agent (see mug_core/agent.py). When its socket exists the hook
+# talks to it through the small client instead of starting a full python3 per sync.
+export MUG_AGENT_SOCKET="${MUG_AGENT_SOCKET:-$HOME/.mug/agent.sock}"
+export MUG_AGENT_CLIENT="${${(%):-%x}:A:h}/agent_client.py"
 
 if [ -f "$SESSION_FILE" ]; then
     function execute_with_redirection() {
+        local hook_start=$EPOCHREALTIME phase_start
         {
-            if [ -z "$HOST" ]; then
-                export HOST=$(hostname)
-                echo "---------------------------- host: $(hostname) ----------------------------" >> "$SESSION_FILE"
-            elif [ "$HOST" != "$(hostname)" ]; then
-                export HOST=$(hostname)
-                echo "------------- host: $(hostname) -------------" >> "$SESSION_FILE"
+            # Supersedes the background analysis of the previous command, if one is still
+            # running for this session (see mug_core/speculate.py). A builtin write, so no
+            # process is started.
+            if [ "$MUG_SPECULATE" = "true" ]; then
+                print -r -- "$hook_start" >| "$SESSION_FILE.speculation.mark"
+            fi
+
+            # Structured records carry their host, so only text logs need banners.
+            # Entries of shared logs carry their own.
+            if [ "$LOG_FORMAT" != "structured" ] && [ "$STORAGE_BACKEND" != "shared" ]; then
+                if [ -z "$HOST" ]; then
+                    export HOST=$(hostname)
+                    echo "---------------------------- host: $(hostname) ----------------------------" >> "$SESSION_FILE"
+                elif [ "$HOST" != "$(hostname)" ]; then
+                    export HOST=$(hostname)
+                    echo "------------- host: $(hostname) -------------" >> "$SESSION_FILE"
+                fi
             fi
 
             if [ "$NO_AWS" = "false" ]; then
+                phase_start=$EPOCHREALTIME
                 sync_from_s3 "$BUCKET_NAME" "$S3_KEY" "$SESSION_FILE"
+                trace_span hook.sync_from "$phase_start"
             fi
 
-            echo "Input:" >> "$SESSION_FILE"
-            echo "- $@" >> "$SESSION_FILE"
-            echo "" >> "$SESSION_FILE"
-
-            {
-                echo "Output:" >> "$SESSION_FILE"
-                { "$@" |& tee -a "$SESSION_FILE"; } >> "$SESSION_FILE"
+            phase_start=$EPOCHREALTIME
+
+            if can_capture "$@"; then
+                mug_core capture --log "$SESSION_FILE" -- "$@"
+            elif [ "$LOG_FORMAT" = "structured" ]; then
+                execute_structured "$@"
+            elif [ "$STORAGE_BACKEND" = "shared" ]; then
+                execute_shared_text "$@"
+            else
+                echo "Input:" >> "$SESSION_FILE"
+                echo "- $@" >> "$SESSION_FILE"
                 echo "" >> "$SESSION_FILE"
-            }
+
+                {
+                    echo "Output:" >> "$SESSION_FILE"
+                    "$@" |& tee -a "$SESSION_FILE"
+                    echo "" >> "$SESSION_FILE"
+                }
+                rotate_if_due
+            fi
+            trace_span hook.command "$phase_start"
 
             if [ "$NO_AWS" = "false" ]; then
+                phase_start=$EPOCHREALTIME
                 sync_to_s3 "$BUCKET_NAME" "$SESSION_FILE" "$S3_KEY"
+                trace_span hook.sync_to "$phase_start"
             fi
+            trace_span hook.total "$hook_start"
 
         } || {
             echo "An error occurred during the execution of: $@"
         }
     }
 
+    # External commands run in a terminal go through the pty capture engine (mug_core/capture.py),
+    # which writes their output to the log once, with bounded size. Shell functions, builtins and
+    # aliases cannot run outside this shell, and piped input or output needs no pty, so those
+    # keep the tee path. MUG_CAPTURE=tee turns the engine off.
+    function can_capture() {
+        [ "$MUG_CAPTURE" != "tee" ] && [ -t 0 ] && [ -t 1 ] && [ "$(whence -w "$1")" = "$1: command" ]
+    }
+
+    function execute_structured() {
+        local output_file=$(mktemp)
+        local start_time=$EPOCHREALTIME
+        "$@" |& tee "$output_file"
+        local exit_status=${pipestatus[1]}
+        local end_time=$EPOCHREALTIME
+        record_command "$output_file" "$exit_status" "$start_time" "$end_time" "$@"
+        rm -f "$output_file"
+    }
+
+    # Logs in a shared directory get each entry, host banner included, in one append under an
+    # fcntl lock on the log (the lock session_log.append_to_log takes), so commands run on other
+    # hosts at the same time never interleave with it.
+    function execute_shared_text() {
+        local staged=$(mktemp)
+        {
+            echo "------------- host: $(hostname) -------------"
+            echo "Input:"
+            echo "- $@"
+            echo ""
+            echo "Output:"
+        } > "$staged"
+        "$@" |& tee -a "$staged"
+        echo "" >> "$staged"
+        append_locked "$SESSION_FILE" "$staged"
+        rm -f "$staged"
+    }
+
+    function append_locked() {
+        local lock_fd
+        if zsystem flock -t 10 -f lock_fd "$1"; then
+            cat "$2" >> "$1"
+            zsystem flock -u "$lock_fd"
+        else
+            cat "$2" >> "$1"
+        fi
+    }
+
+    # The capture and record paths rotate the log after appending to it (see
+    # mug_core/log_segments.py). Entries teed straight into a text log are rotated here,
+    # between commands, once the log is over LOG_SEGMENT_MB.
+    function rotate_if_due() {
+        local -a log_size
+        [ "$SYNC_MODE" = "incremental" ] && return
+        zstat -A log_size +size -- "$SESSION_FILE" 2>/dev/null || return
+        if (( log_size[1] >= ${LOG_SEGMENT_MB:-8} * 1048576 )); then
+            mug_core rotate --log "$SESSION_FILE"
+        fi
+    }
+
+    function record_command() {
+        local output_file=$1 exit_status=$2 start_time=$3 end_time=$4
+        shift 4
+        if [ -S "$MUG_AGENT_SOCKET" ]; then
+            python3 -S "$MUG_AGENT_CLIENT" record "local_file=$SESSION_FILE" "output_file=$output_file" \
+                "status=$exit_status" "start=$start_time" "end=$end_time" "${@/#/arg=}"
+            [ $? -ne 2 ] && return
+        fi
+        mug_core record --log "$SESSION_FILE" --output-file "$output_file" \
+            --status "$exit_status" --start "$start_time" --end "$end_time" -- "$@"
+    }
+
+    # Uploads are only queued here; a background uploader (mug_core/upload_queue.py)
+    # coalesces them, so the prompt never waits for S3.
     function sync_to_s3() {
-        python3 -c "import mug_core; mug_core.sync_local_to_s3('$1', '$2', '$3')"
+        if [ -S "$MUG_AGENT_SOCKET" ]; then
+            python3 -S "$MUG_AGENT_CLIENT" sync_to "bucket=$1" "local_file=$2" "key=$3" "mode=$SYNC_MODE"
+            [ $? -ne 2 ] && return
+        fi
+        python3 -c "import mug_core; mug_core.enqueue_upload('$1', '$2', '$3', '$SYNC_MODE')"
     }
 
     function sync_from_s3() {
-        python3 -c "import mug_core; mug_core.sync_s3_to_local('$1', '$2', '$3')"
+        if [ -S "$MUG_AGENT_SOCKET" ]; then
+            python3 -S "$MUG_AGENT_CLIENT" sync_from "bucket=$1" "key=$2" "local_file=$3" "mode=$SYNC_MODE"
+            [ $? -ne 2 ] && return
+        fi
+        python3 -c "import mug_core; mug_core.sync_session_from_s3('$1', '$2', '$3', '$SYNC_MODE')"
     }
 else
     echo "Session file not found."
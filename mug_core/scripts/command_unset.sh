@@ -2,13 +2,29 @@
 unset SESSION_FILE
 unset BUCKET_NAME
 unset NO_AWS
+unset STORAGE_BACKEND
 unset S3_KEY
+unset SYNC_MODE
+unset LOG_FORMAT
 unset SESSION_LOG_NAME
 unset AWS_ACCESS_KEY_ID
 unset AWS_SECRET_ACCESS_KEY
+unset MUG_AGENT_SOCKET
+unset MUG_AGENT_CLIENT
+unset MUG_MANIFEST
+unset MUG_COMMAND_HOOK
+unset MUG_COMMAND_UNSET
+unset MUG_TRACE_FILE
 
 unset -f execute_with_redirection
+unset -f execute_structured
+unset -f can_capture
+unset -f record_command
 unset -f sync_to_s3
 unset -f sync_from_s3
+unset -f trace_span
+unset -f execute_shared_text
+unset -f append_locked
+unset -f rotate_if_due
 
 echo "Session ended and hooks removed."
@@ -0,0 +1,384 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import zlib
+import sqlite3
+import argparse
+from collections import Counter
+
+from .log_segments import get_log_size, open_session_log
+from .paths import LOG_DIR
+from .retrieval import BM25_B, BM25_K1, iter_new_entries, position_check, read_locator, tokenize
+from .session_log import HOST_BANNER, LOG_FORMAT_STRUCTURED, detect_log_format
+
+# Cross-session search: one inverted index over every session log in ~/.mug and in the
+# session bucket or shared directory, in SQLite (~/.mug/search/index.sqlite3), ranked with the same BM25 as the
+# per-session retrieval index.
+# Each log is a source that remembers how far it was indexed; an update only tokenizes the
+# entries appended since, and reindexes a log from scratch only if it was rewritten.
+# Unchanged local logs are recognized by size and mtime without being opened. Bucket logs are
+# recognized by the ETag in the bucket listing, plus the newest pending entry for incremental
+# sessions; a changed one is downloaded, with only its new closed segments and with its pending
+# entries, into ~/.mug/search/s3/ and then indexed like a local log.
+SEARCH_DIR = os.path.join(LOG_DIR, "search")
+INDEX_PATH = os.path.join(SEARCH_DIR, "index.sqlite3")
+MIRROR_DIR = os.path.join(SEARCH_DIR, "s3")
+LOCAL_LOG_PATTERN = re.compile(r'session_log_(\d+)\.txt$')
+COMMAND_PATTERN = re.compile(r'^Input:\n- (.*)$', re.MULTILINE)
+DEFAULT_LIMIT = 10
+# Bucket listings are refreshed at most this often, unless --refresh is given.
+DEFAULT_S3_REFRESH = 300
+SNIPPET_BEFORE = 80
+SNIPPET_AFTER = 160
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    id INTEGER PRIMARY KEY, name TEXT UNIQUE, path TEXT, stamp TEXT,
+    format TEXT, position INTEGER, position_check INTEGER, host TEXT
+);
+CREATE TABLE IF NOT EXISTS docs (
+    id INTEGER PRIMARY KEY, source_id INTEGER, first INTEGER, second INTEGER,
+    length INTEGER, host TEXT, command TEXT, tail INTEGER
+);
+CREATE INDEX IF NOT EXISTS docs_source ON docs (source_id, tail);
+CREATE TABLE IF NOT EXISTS postings (
+    term TEXT, doc_id INTEGER, frequency INTEGER, length INTEGER, PRIMARY KEY (term, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS postings_doc ON postings (doc_id);
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+"""
+
+def get_s3_refresh_seconds():
+    try:
+        return float(os.getenv("SEARCH_S3_REFRESH", DEFAULT_S3_REFRESH))
+    except ValueError:
+        return DEFAULT_S3_REFRESH
+
+def open_index():
+    if not os.path.exists(SEARCH_DIR):
+        os.makedirs(SEARCH_DIR)
+    db = sqlite3.connect(INDEX_PATH, timeout=30)
+    db.executescript(SCHEMA)
+    return db
+
+def get_stamp(log_path):
+    stat = os.stat(log_path)
+    return f"{get_log_size(log_path)}:{stat.st_mtime_ns}"
+
+def split_entry_hosts(text, host):
+    """
+    Returns (host of the entry, host after it). A host banner before an entry's `Input:`
+    line names its host; text logs write the banner of the next command at the end of the
+    previous entry instead.
+    """
+    start = text.find("Input:\n")
+    for match in re.finditer(HOST_BANNER.pattern, text[:max(start, 0)], re.MULTILINE):
+        host = match.group(1)
+    entry_host = host
+    for match in re.finditer(HOST_BANNER.pattern, text[max(start, 0):], re.MULTILINE):
+        host = match.group(1)
+    return entry_host, host
+
+def drop_docs(db, condition, params):
+    db.execute(f"DELETE FROM postings WHERE doc_id IN (SELECT id FROM docs WHERE {condition})", params)
+    db.execute(f"DELETE FROM docs WHERE {condition}", params)
+
+def add_doc(db, source_id, locator, text, host, tail=False):
+    """
+    Indexes one entry. Text without an `Input:` line, like a log's preamble, is skipped.
+    """
+    match = COMMAND_PATTERN.search(text)
+    if not match:
+        return False
+    terms = Counter(tokenize(text))
+    length = sum(terms.values())
+    cursor = db.execute(
+        "INSERT INTO docs (source_id, first, second, length, host, command, tail) VALUES (?, ?, ?, ?, ?, ?, ?)",
+        (source_id, locator[0], locator[1], length, host, match.group(1), int(tail)))
+    # The doc length is repeated in its postings so that ranking reads the postings alone.
+    db.executemany("INSERT INTO postings (term, doc_id, frequency, length) VALUES (?, ?, ?, ?)",
+                   [(term, cursor.lastrowid, frequency, length) for term, frequency in terms.items()])
+    return True
+
+def index_log(db, name, log_path, stamp):
+    """
+    Brings one source up to date with its log: the entries appended since the last update
+    are added, and everything is reindexed if the log was rewritten. A text log's last
+    entry may still grow, so it is indexed as a tail doc that the next update replaces.
+
+    Args:
+        db (Connection): The search index.
+        name (str): The source name, e.g. "local:session_log_3.txt" or "s3://bucket/key".
+        log_path (str): The log file to read.
+        stamp (str): What identifies this version of the log (size and mtime, or ETag).
+
+    Returns:
+        int: The number of entries indexed.
+    """
+    row = db.execute("SELECT id, stamp, format, position, position_check, host FROM sources WHERE name = ?", (name,)).fetchone()
+    if row is None:
+        source_id = db.execute("INSERT INTO sources (name, path, position, position_check) VALUES (?, ?, 0, 0)",
+                               (name, log_path)).lastrowid
+        previous_stamp, previous_format, position, check, host = None, None, 0, 0, None
+    else:
+        source_id, previous_stamp, previous_format, position, check, host = row
+    if previous_stamp == stamp:
+        return 0
+
+    log_format = detect_log_format(log_path)
+    drop_docs(db, "source_id = ? AND tail = 1", (source_id,))
+    if previous_format != log_format or check != position_check(log_path, log_format, position):
+        drop_docs(db, "source_id = ?", (source_id,))
+        position, host = 0, None
+
+    indexed = 0
+    for locator, text, position in iter_new_entries(log_path, log_format, position):
+        entry_host, host = split_entry_hosts(text, host)
+        indexed += add_doc(db, source_id, locator, text, entry_host)
+    size = get_log_size(log_path)
+    if log_format != LOG_FORMAT_STRUCTURED and size > position:
+        with open_session_log(log_path) as log_file:
+            log_file.seek(position)
+            text = log_file.read(size - position).decode(errors='replace')
+        indexed += add_doc(db, source_id, [position, size], text, split_entry_hosts(text, host)[0], tail=True)
+    db.execute("UPDATE sources SET path = ?, stamp = ?, format = ?, position = ?, position_check = ?, host = ? WHERE id = ?",
+               (log_path, stamp, log_format, position, position_check(log_path, log_format, position), host, source_id))
+    db.commit()
+    return indexed
+
+def get_sources(db, prefix):
+    """
+    Returns {name: (id, stamp)} of the sources whose name starts with `prefix`.
+    """
+    return {name: (source_id, stamp) for source_id, name, stamp in db.execute("SELECT id, name, stamp FROM sources")
+            if name.startswith(prefix)}
+
+def drop_sources(db, prefix, keep):
+    """
+    Drops the sources under `prefix` that are not in `keep`, with their bucket copies.
+    """
+    for name, (source_id, _) in get_sources(db, prefix).items():
+        if name in keep:
+            continue
+        path = db.execute("SELECT path FROM sources WHERE id = ?", (source_id,)).fetchone()[0]
+        drop_docs(db, "source_id = ?", (source_id,))
+        db.execute("DELETE FROM sources WHERE id = ?", (source_id,))
+        if path and path.startswith(MIRROR_DIR + os.sep) and os.path.exists(path):
+            os.remove(path)
+    db.commit()
+
+def update_directory_sources(db, prefix, directory):
+    """
+    Indexes the session logs in a directory, as sources named `prefix` + file name.
+    Logs that are gone are dropped from the index.
+    """
+    names = set()
+    if os.path.exists(directory):
+        for file in os.listdir(directory):
+            if not LOCAL_LOG_PATTERN.match(file):
+                continue
+            name = f"{prefix}{file}"
+            names.add(name)
+            log_path = os.path.join(directory, file)
+            index_log(db, name, log_path, get_stamp(log_path))
+    drop_sources(db, prefix, names)
+
+def update_s3_sources(db, bucket_name):
+    """
+    Indexes the session logs of a bucket whose ETag changed since they were last indexed.
+    An incremental session keeps its newest commands in `.entries/` objects until they are
+    compacted, so its stamp also names its newest entry, and its copy includes the entries.
+    """
+    from .aws_s3 import download_session_log, iter_session_logs, list_entries
+
+    prefix = f"s3://{bucket_name}/"
+    stamps = {name: stamp for name, (_, stamp) in get_sources(db, prefix).items()}
+    names = set()
+    for s3_key, etag, has_entries in iter_session_logs(bucket_name):
+        name = f"{prefix}{s3_key}"
+        names.add(name)
+        stamp = etag
+        if has_entries:
+            entry_keys = list_entries(bucket_name, s3_key)
+            stamp = f"{etag}+{entry_keys[-1]}" if entry_keys else etag
+        if stamps.get(name) == stamp:
+            continue
+        mirror_path = os.path.join(MIRROR_DIR, bucket_name, s3_key)
+        if not os.path.exists(os.path.dirname(mirror_path)):
+            os.makedirs(os.path.dirname(mirror_path))
+        try:
+            download_session_log(bucket_name, s3_key, mirror_path, with_entries=has_entries)
+        except Exception as e:
+            print(f"Could not index {name}: {e}", file=sys.stderr)
+            continue
+        index_log(db, name, mirror_path, stamp)
+    drop_sources(db, prefix, names)
+    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (f"refreshed:{bucket_name}", str(time.time())))
+    db.commit()
+
+def get_session_storage():
+    """
+    Returns (bucket, shared sessions directory) of the configured session; either may be None.
+    """
+    from .api import load_existing_config
+    from .storage import S3Storage, SharedDirStorage, get_storage_backend
+    storage = get_storage_backend(load_existing_config() or {})
+    if isinstance(storage, S3Storage):
+        return storage.bucket_name, None
+    if isinstance(storage, SharedDirStorage):
+        return None, storage.sessions_dir
+    return None, None
+
+def update_search_index(db, bucket_name=None, refresh=False, shared_dir=None):
+    """
+    Brings the index up to date with the local logs, those of a shared directory, and,
+    at most every SEARCH_S3_REFRESH seconds (or now, with `refresh`), those of the bucket.
+
+    Args:
+        db (Connection): The search index.
+        bucket_name (str): The bucket to index, if any.
+        refresh (bool): List the bucket even if it was listed recently.
+        shared_dir (str): The shared sessions directory to index, if any.
+
+    Returns:
+        None
+    """
+    update_directory_sources(db, "local:", LOG_DIR)
+    if shared_dir:
+        update_directory_sources(db, f"shared:{shared_dir}/", shared_dir)
+    if not bucket_name:
+        return
+    row = db.execute("SELECT value FROM meta WHERE key = ?", (f"refreshed:{bucket_name}",)).fetchone()
+    if refresh or row is None or time.time() - float(row[0]) >= get_s3_refresh_seconds():
+        try:
+            update_s3_sources(db, bucket_name)
+        except Exception as e:
+            print(f"Could not list the sessions in '{bucket_name}': {e}", file=sys.stderr)
+
+def rank_docs(db, query, limit, host=None):
+    """
+    Ranks the docs that share a term with `query` by BM25. Document frequencies are
+    counted first, so the scores are summed and sorted by SQLite in one query.
+
+    Args:
+        db (Connection): The search index.
+        query (str): The search terms.
+        limit (int): How many docs to return.
+        host (str): Only docs of this host.
+
+    Returns:
+        list: (doc_id, score) pairs, best first.
+    """
+    doc_count, total_length = db.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM docs").fetchone()
+    if not doc_count:
+        return []
+    average_length = total_length / doc_count or 1.0
+    parts = []
+    params = []
+    for term in sorted(set(tokenize(query))):
+        frequency = db.execute("SELECT COUNT(*) FROM postings WHERE term = ?", (term,)).fetchone()[0]
+        if not frequency:
+            continue
+        idf = math.log(1 + (doc_count - frequency + 0.5) / (frequency + 0.5))
+        parts.append("SELECT doc_id, ? * frequency / (frequency + ? + ? * length) AS score FROM postings WHERE term = ?")
+        params += [idf * (BM25_K1 + 1), BM25_K1 * (1 - BM25_B), BM25_K1 * BM25_B / average_length, term]
+    if not parts:
+        return []
+    host_filter = ""
+    if host:
+        host_filter = "WHERE doc_id IN (SELECT id FROM docs WHERE host = ?)"
+        params.append(host)
+    statement = (f"SELECT doc_id, SUM(score) AS total FROM ({' UNION ALL '.join(parts)}) {host_filter} "
+                 "GROUP BY doc_id ORDER BY total DESC LIMIT ?")
+    return db.execute(statement, params + [limit]).fetchall()
+
+def make_snippet(text, query):
+    """
+    Cuts the part of an entry's output around the first query term, on one line.
+    """
+    output = text.split("\nOutput:\n", 1)[-1]
+    lowered = output.lower()
+    hits = [lowered.find(term) for term in tokenize(query)]
+    hit = min((position for position in hits if position != -1), default=0)
+    start = max(hit - SNIPPET_BEFORE, 0)
+    snippet = " ".join(output[start:hit + SNIPPET_AFTER].split())
+    return ("..." if start else "") + snippet + ("..." if hit + SNIPPET_AFTER < len(output) else "")
+
+def search_sessions(db, query, limit=DEFAULT_LIMIT, host=None):
+    """
+    Finds the entries of all indexed sessions most relevant to `query`. Entries that are
+    in the index twice, e.g. in a local log and in its bucket copy, are returned once.
+
+    Args:
+        db (Connection): The search index.
+        query (str): The search terms.
+        limit (int): How many results to return.
+        host (str): Only entries run on this host.
+
+    Returns:
+        list: {"session", "source", "host", "command", "snippet", "score"} dicts, best first.
+    """
+    results = []
+    seen = set()
+    # Extra candidates make up for the duplicates that are skipped.
+    for doc_id, score in rank_docs(db, query, limit * 3, host):
+        name, path, log_format, first, second, entry_host, command = db.execute(
+            "SELECT s.name, s.path, s.format, d.first, d.second, d.host, d.command "
+            "FROM docs d JOIN sources s ON s.id = d.source_id WHERE d.id = ?", (doc_id,)).fetchone()
+        try:
+            text = read_locator(path, log_format, first, second)
+        except (OSError, ValueError):
+            continue
+        fingerprint = zlib.crc32(text.encode())
+        if fingerprint in seen:
+            continue
+        seen.add(fingerprint)
+        results.append({
+            "session": os.path.basename(path),
+            "source": name,
+            "host": entry_host,
+            "command": command,
+            "snippet": make_snippet(text, query),
+            "score": round(score, 3),
+        })
+        if len(results) >= limit:
+            break
+    return results
+
+def search_command(args):
+    """
+    Entry point of `mug_core search`, run by `mug --search <query>`.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core search", description="Search every session log, local and in the bucket.")
+    parser.add_argument("query", nargs="+", help="The search terms.")
+    parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT, help="How many results to show.")
+    parser.add_argument("--host", default=None, help="Only commands run on this host.")
+    parser.add_argument("--bucket", default=None, help="The bucket to index. Defaults to the session's.")
+    parser.add_argument("--refresh", action="store_true", help="List the bucket again even if it was listed recently.")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+    options = parser.parse_args(args)
+
+    query = " ".join(options.query)
+    started = time.perf_counter()
+    db = open_index()
+    try:
+        bucket_name, shared_dir = get_session_storage()
+        update_search_index(db, options.bucket or bucket_name, options.refresh, shared_dir)
+        results = search_sessions(db, query, options.limit, options.host)
+        sessions = db.execute("SELECT COUNT(*) FROM sources").fetchone()[0]
+    finally:
+        db.close()
+    elapsed = (time.perf_counter() - started) * 1000
+    if options.json:
+        print(json.dumps(results, indent=2))
+        return
+    for number, result in enumerate(results, 1):
+        source = "" if result["source"].startswith("local:") else f"  ({result['source']})"
+        print(f"[{number}] {result['session']}  host: {result['host'] or 'unknown'}{source}")
+        print(f"    $ {result['command']}")
+        if result["snippet"]:
+            print(f"    {result['snippet']}")
+    print(f"{len(results)} result(s) from {sessions} session(s) in {elapsed:.0f} ms.")
@@ -0,0 +1,511 @@
+import io
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import socket
+import struct
+import getpass
+import zlib
+import fcntl
+import argparse
+
+from .log_segments import get_log_size, load_manifest, maybe_rotate_session_log, open_session_log
+
+# Session logs come in two formats:
+# - "text": the original free text with host banners and `Input:` / `Output:` markers.
+# - "structured": one JSON record per line (host, user, ts, argv, status, duration, output),
+#   with a sidecar `<log>.idx` of fixed-size entries so readers can seek straight to records.
+LOG_FORMAT_TEXT = "text"
+LOG_FORMAT_STRUCTURED = "structured"
+INDEX_SUFFIX = ".idx"
+# offset (u64), length (u32), start timestamp (f64), crc32 of the host name (u32)
+INDEX_ENTRY = struct.Struct("<QIdI")
+
+HOST_BANNER = re.compile(r'^-+ host: (.*?) -+$')
+
+def get_log_format():
+    log_format = os.getenv("LOG_FORMAT", LOG_FORMAT_TEXT)
+    if log_format not in (LOG_FORMAT_TEXT, LOG_FORMAT_STRUCTURED):
+        print(f"Unknown LOG_FORMAT '{log_format}', falling back to '{LOG_FORMAT_TEXT}'.")
+        return LOG_FORMAT_TEXT
+    return log_format
+
+def detect_log_format(log_path):
+    """
+    Detects the format of a session log from its first byte.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        str: LOG_FORMAT_STRUCTURED if the log holds JSON records, LOG_FORMAT_TEXT otherwise.
+            Empty or missing logs are reported in the format of their closed segments,
+            or else in the configured format.
+    """
+    if os.path.exists(log_path):
+        with open(log_path, 'rb') as log_file:
+            first = log_file.read(1)
+        if first:
+            return LOG_FORMAT_STRUCTURED if first == b"{" else LOG_FORMAT_TEXT
+    # The live file may be empty right after a rotation.
+    return load_manifest(log_path)["format"] or get_log_format()
+
+def get_index_path(log_path):
+    return f"{log_path}{INDEX_SUFFIX}"
+
+def host_hash(host):
+    return zlib.crc32((host or "").encode())
+
+def make_record(argv, output, status=None, start=None, duration=None, host=None, user=None):
+    """
+    Builds a structured record for one command.
+
+    Args:
+        argv (list): The command and its arguments.
+        output (str): Everything the command printed.
+        status (int): The exit status, if known.
+        start (float): Start time as a Unix timestamp, if known.
+        duration (float): Wall time in seconds, if known.
+        host (str): The host the command ran on. Defaults to this host.
+        user (str): The user who ran it. Defaults to the current user.
+
+    Returns:
+        dict: The record.
+    """
+    return {
+        "host": host or socket.gethostname(),
+        "user": user or getpass.getuser(),
+        "ts": start if start is not None else time.time(),
+        "argv": list(argv),
+        "status": status,
+        "duration": duration,
+        "output": output,
+    }
+
+def append_to_log(log_path, data):
+    """
+    Appends a whole entry to the log in one write, holding an fcntl lock on the log.
+    Every writer takes the lock, so entries from hosts sharing the log over NFS or Lustre,
+    where O_APPEND alone is not atomic, never interleave. The hook's shell appends take
+    the same lock with `zsystem flock`.
+
+    Args:
+        log_path (str): The session log file.
+        data (bytes): The entry.
+
+    Returns:
+        None
+    """
+    with open(log_path, 'ab') as log_file:
+        fcntl.lockf(log_file, fcntl.LOCK_EX)
+        log_file.write(data)
+        log_file.flush()
+
+def append_record(log_path, record):
+    """
+    Appends one record to a structured log and indexes it.
+
+    Args:
+        log_path (str): The session log file.
+        record (dict): The record, as built by make_record.
+
+    Returns:
+        None
+    """
+    line = json.dumps(record, ensure_ascii=False).encode()
+    append_to_log(log_path, line + b"\n")
+    update_index(log_path)
+
+def read_index(log_path):
+    """
+    Reads all index entries as (offset, length, ts, host_hash) tuples.
+    """
+    index_path = get_index_path(log_path)
+    if not os.path.exists(index_path):
+        return []
+    with open(index_path, 'rb') as index_file:
+        data = index_file.read()
+    usable = len(data) - len(data) % INDEX_ENTRY.size
+    return list(INDEX_ENTRY.iter_unpack(data[:usable]))
+
+def is_index_consistent(log_file, log_size, entry):
+    offset, length = entry[0], entry[1]
+    if offset + length + 1 > log_size:
+        return False
+    log_file.seek(offset)
+    if log_file.read(1) != b"{":
+        return False
+    log_file.seek(offset + length)
+    return log_file.read(1) == b"\n"
+
+def update_index(log_path):
+    """
+    Brings the sidecar index up to date with the log. Only the bytes after the last
+    indexed record are scanned, so this is cheap to call before every read. Records
+    appended by other participants through sync are picked up the same way. If the
+    log was rewritten underneath the index, the index is rebuilt.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        None
+    """
+    if not os.path.exists(log_path) or detect_log_format(log_path) != LOG_FORMAT_STRUCTURED:
+        return
+
+    index_path = get_index_path(log_path)
+    log_size = get_log_size(log_path)
+    with open_session_log(log_path) as log_file:
+        start = 0
+        mode = 'wb'
+        if os.path.exists(index_path):
+            index_size = os.path.getsize(index_path)
+            count = index_size // INDEX_ENTRY.size
+            if count:
+                with open(index_path, 'rb') as index_file:
+                    index_file.seek((count - 1) * INDEX_ENTRY.size)
+                    last = INDEX_ENTRY.unpack(index_file.read(INDEX_ENTRY.size))
+                if is_index_consistent(log_file, log_size, last):
+                    start = last[0] + last[1] + 1
+                    mode = 'r+b'
+        if mode == 'r+b' and start >= log_size:
+            return
+
+        entries = []
+        log_file.seek(start)
+        offset = start
+        for line in log_file:
+            if not line.endswith(b"\n"):
+                # A record that is still being written; index it next time.
+                break
+            length = len(line) - 1
+            try:
+                record = json.loads(line)
+            except ValueError:
+                record = None
+            if isinstance(record, dict) and "argv" in record:
+                entries.append(INDEX_ENTRY.pack(offset, length, record.get("ts") or 0.0, host_hash(record.get("host"))))
+            offset += len(line)
+
+    with open(index_path, mode) as index_file:
+        if mode == 'r+b':
+            index_file.seek(count * INDEX_ENTRY.size)
+            index_file.truncate()
+        index_file.write(b"".join(entries))
+
+def read_records_at(log_path, entries):
+    """
+    Reads the records the given index entries point to.
+    """
+    records = []
+    with open_session_log(log_path) as log_file:
+        for entry in entries:
+            log_file.seek(entry[0])
+            records.append(json.loads(log_file.read(entry[1])))
+    return records
+
+def read_last_records(log_path, count):
+    """
+    Returns the last `count` records of a session log, oldest first.
+    Structured logs seek straight to them through the index.
+
+    Args:
+        log_path (str): The session log file.
+        count (int): How many records to return.
+
+    Returns:
+        list: The records.
+    """
+    if count <= 0:
+        return []
+    if detect_log_format(log_path) != LOG_FORMAT_STRUCTURED:
+        return list(iter_records(log_path))[-count:]
+
+    update_index(log_path)
+    index_path = get_index_path(log_path)
+    if not os.path.exists(index_path):
+        return []
+    total = os.path.getsize(index_path) // INDEX_ENTRY.size
+    first = max(total - count, 0)
+    with open(index_path, 'rb') as index_file:
+        index_file.seek(first * INDEX_ENTRY.size)
+        data = index_file.read((total - first) * INDEX_ENTRY.size)
+    return read_records_at(log_path, list(INDEX_ENTRY.iter_unpack(data)))
+
+def iter_records_reversed(log_path, block_entries=256):
+    """
+    Iterates over the records of a session log from newest to oldest.
+    Structured logs walk the index backwards a block at a time, so only the records
+    actually consumed are read.
+
+    Args:
+        log_path (str): The session log file.
+        block_entries (int): How many index entries to read per block.
+
+    Returns:
+        generator: The records, newest first.
+    """
+    if detect_log_format(log_path) != LOG_FORMAT_STRUCTURED:
+        yield from reversed(list(iter_records(log_path)))
+        return
+
+    update_index(log_path)
+    index_path = get_index_path(log_path)
+    if not os.path.exists(index_path):
+        return
+    with open(index_path, 'rb') as index_file, open_session_log(log_path) as log_file:
+        remaining = os.path.getsize(index_path) // INDEX_ENTRY.size
+        while remaining > 0:
+            first = max(remaining - block_entries, 0)
+            index_file.seek(first * INDEX_ENTRY.size)
+            block = list(INDEX_ENTRY.iter_unpack(index_file.read((remaining - first) * INDEX_ENTRY.size)))
+            for offset, length, ts, host in reversed(block):
+                log_file.seek(offset)
+                yield json.loads(log_file.read(length))
+            remaining = first
+
+def read_records_between(log_path, start, end):
+    """
+    Returns the records whose start time falls in [start, end].
+
+    Args:
+        log_path (str): The session log file.
+        start (float): Unix timestamp, inclusive.
+        end (float): Unix timestamp, inclusive.
+
+    Returns:
+        list: The records, in log order.
+    """
+    if detect_log_format(log_path) != LOG_FORMAT_STRUCTURED:
+        return [record for record in iter_records(log_path)
+                if record["ts"] is not None and start <= record["ts"] <= end]
+    update_index(log_path)
+    entries = [entry for entry in read_index(log_path) if start <= entry[2] <= end]
+    return read_records_at(log_path, entries)
+
+def read_host_records(log_path, host):
+    """
+    Returns the records that ran on `host`.
+
+    Args:
+        log_path (str): The session log file.
+        host (str): The host name.
+
+    Returns:
+        list: The records, in log order.
+    """
+    if detect_log_format(log_path) != LOG_FORMAT_STRUCTURED:
+        return [record for record in iter_records(log_path) if record["host"] == host]
+    update_index(log_path)
+    wanted = host_hash(host)
+    entries = [entry for entry in read_index(log_path) if entry[3] == wanted]
+    return [record for record in read_records_at(log_path, entries) if record.get("host") == host]
+
+def parse_command(command):
+    try:
+        return shlex.split(command)
+    except ValueError:
+        return command.split()
+
+def parse_text_log(lines):
+    """
+    Parses a text session log into records. Text logs carry no user, timestamps,
+    exit status or duration, so those fields are None.
+
+    Args:
+        lines (iterable): The lines of the log, with line endings.
+
+    Returns:
+        generator: The records, in log order.
+    """
+    host = None
+    record = None
+    state = None
+    for line in lines:
+        text = line.rstrip("\n")
+        banner = HOST_BANNER.match(text)
+        if banner or text == "Input:":
+            if record is not None:
+                yield finish_text_record(record)
+                record = None
+            if banner:
+                host = banner.group(1)
+            else:
+                state = "input"
+            continue
+        if state == "input":
+            if text.startswith("- "):
+                record = {"host": host, "user": None, "ts": None, "argv": parse_command(text[2:]),
+                          "status": None, "duration": None, "output": []}
+                state = "between"
+            continue
+        if state == "between":
+            if text == "Output:":
+                state = "output"
+            continue
+        if state == "output" and record is not None:
+            record["output"].append(line)
+    if record is not None:
+        yield finish_text_record(record)
+
+def finish_text_record(record):
+    output = "".join(record["output"])
+    # The hook writes one blank line after every output block.
+    if output.endswith("\n\n"):
+        output = output[:-1]
+    elif output == "\n":
+        output = ""
+    record["output"] = output
+    return record
+
+def iter_records(log_path):
+    """
+    Iterates over the records of a session log in either format.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        generator: The records, in log order.
+    """
+    if not os.path.exists(log_path):
+        return
+    if detect_log_format(log_path) == LOG_FORMAT_STRUCTURED:
+        with open_session_log(log_path) as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+                if isinstance(record, dict) and "argv" in record:
+                    yield record
+    else:
+        with io.TextIOWrapper(open_session_log(log_path), errors='replace') as log_file:
+            yield from parse_text_log(log_file)
+
+def format_record(record, previous_host=None):
+    """
+    Renders a record in the familiar `Input:` / `Output:` text form, for prompts and display.
+    """
+    parts = []
+    if record.get("host") and record.get("host") != previous_host:
+        parts.append(f"------------- host: {record['host']} -------------\n")
+    parts.append("Input:\n")
+    parts.append(f"- {shlex.join(record['argv'])}\n")
+    if record.get("status") is not None:
+        parts.append(f"(exit status {record['status']}")
+        if record.get("duration") is not None:
+            parts.append(f", {record['duration']:.2f}s")
+        parts.append(")\n")
+    parts.append("\nOutput:\n")
+    output = record.get("output") or ""
+    parts.append(output if output.endswith("\n") or not output else output + "\n")
+    parts.append("\n")
+    return "".join(parts)
+
+def format_records(records):
+    previous_host = None
+    parts = []
+    for record in records:
+        parts.append(format_record(record, previous_host))
+        previous_host = record.get("host")
+    return "".join(parts)
+
+def read_session_text(log_path):
+    """
+    Returns the whole session log as text, whatever its format.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        str: The session log text.
+    """
+    if detect_log_format(log_path) == LOG_FORMAT_STRUCTURED:
+        return format_records(iter_records(log_path))
+    with io.TextIOWrapper(open_session_log(log_path), errors='replace') as log_file:
+        return log_file.read()
+
+def convert_text_log(source_path, target_path):
+    """
+    Converts a text session log into a structured log with an index.
+
+    Args:
+        source_path (str): The text log.
+        target_path (str): Where to write the structured log. It is overwritten.
+
+    Returns:
+        int: The number of records written.
+    """
+    count = 0
+    tmp_path = f"{target_path}.tmp"
+    with open(tmp_path, 'wb') as target:
+        for record in iter_records(source_path):
+            target.write(json.dumps(record, ensure_ascii=False).encode() + b"\n")
+            count += 1
+    os.replace(tmp_path, target_path)
+    index_path = get_index_path(target_path)
+    if os.path.exists(index_path):
+        os.unlink(index_path)
+    update_index(target_path)
+    return count
+
+def record_command(args):
+    """
+    Entry point for `mug_core record`, used by the hook to log one command in structured mode.
+
+    Args:
+        args (list): The arguments after `record`.
+
+    Returns:
+        None
+    """
+    parser = argparse.ArgumentParser(prog="mug_core record")
+    parser.add_argument("--log", required=True, help="The session log file.")
+    parser.add_argument("--output-file", required=True, help="A file holding the command output.")
+    parser.add_argument("--status", type=int)
+    parser.add_argument("--start", type=float)
+    parser.add_argument("--end", type=float)
+    parser.add_argument("argv", nargs=argparse.REMAINDER)
+    options = parser.parse_args(args)
+
+    argv = options.argv[1:] if options.argv[:1] == ["--"] else options.argv
+    with open(options.output_file, 'r', errors='replace') as output_file:
+        output = output_file.read()
+    duration = None
+    if options.start is not None and options.end is not None:
+        duration = options.end - options.start
+    from .dedup import dedupe_record
+    from .speculate import maybe_start_analysis
+    record = dedupe_record(options.log, make_record(argv, output, options.status, options.start, duration))
+    append_record(options.log, record)
+    maybe_rotate_session_log(options.log)
+    maybe_start_analysis(options.log, record)
+
+def convert_command(args):
+    """
+    Entry point for `mug_core convert <text log> [structured log]`.
+
+    Args:
+        args (list): The arguments after `convert`.
+
+    Returns:
+        None
+    """
+    if not args:
+        print("Usage: mug_core convert <text log> [structured log]")
+        return
+    source_path = args[0]
+    target_path = args[1] if len(args) > 1 else f"{source_path}.jsonl"
+    count = convert_text_log(source_path, target_path)
+    print(f"Converted {count} commands from '{source_path}' to '{target_path}'.")
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["record"]:
+        record_command(sys.argv[2:])
+    elif sys.argv[1:2] == ["convert"]:
+        convert_command(sys.argv[2:])
@@ -0,0 +1,353 @@
+import os
+import re
+import sys
+import json
+import time
+import shlex
+import fcntl
+import hashlib
+import argparse
+import subprocess
+from contextlib import contextmanager
+
+from .log_segments import TEXT_ENTRY_MARKER, iter_log_views
+from .paths import LOG_DIR
+from .session_log import LOG_FORMAT_STRUCTURED, detect_log_format, iter_records_reversed
+
+# Speculative analysis of failing commands, opt-in with MUG_SPECULATE=true.
+# When a logged command exits non-zero or prints a traceback, a detached `mug_core speculate`
+# asks the LLM why it failed, so that `mug --explain-last` answers at once. Analyses are kept
+# next to the log in `<log>.analyses.json`, keyed by a hash of the command and its output, so
+# syncs that add other hosts' entries do not lose them.
+# - Only `--explain-last`, or the very question it asks, is answered with the analysis itself.
+#   Other questions asked while the failed command is the newest are sent to the LLM as usual,
+#   with the analysis added to their context.
+# - At most SPECULATE_MAX_CONCURRENT analyses run at a time; each holds one of the slot locks
+#   in ~/.mug/speculation/, and a failure that finds none free is not analyzed ahead of time.
+# - The hook rewrites `<log>.speculation.mark` (with a builtin, so no process is started) when
+#   the next command of the session starts. An analysis whose mark changed is superseded: its
+#   stream is closed and nothing is kept.
+SPECULATION_DIR = os.path.join(LOG_DIR, "speculation")
+MARK_SUFFIX = ".speculation.mark"
+ANALYSES_SUFFIX = ".analyses.json"
+DEFAULT_MAX_CONCURRENT = 2
+ANALYSES_KEPT = 20
+RECENT_ENTRIES = 50
+# How long `--explain-last` waits for an analysis still being prepared, and how long a
+# follow-up question waits for it before it is asked without.
+PENDING_TIMEOUT = 120
+FOLLOW_UP_WAIT = 3
+EXPLAIN_QUESTION = "Why did `{}` fail, and how can it be fixed?"
+ANALYSIS_CONTEXT = "\nAnalysis of why `{}` failed, prepared when it ran:\n{}\n"
+STATUS_PATTERN = re.compile(r'^\(exit status (-?\d+)', re.MULTILINE)
+FAILURE_PATTERN = re.compile(
+    r'^Traceback \(most recent call last\):|^\w*(?:Error|Exception): |^error(?:\[\w+\])?: |^panic: |Segmentation fault',
+    re.MULTILINE)
+# Follow-up questions that wait for an analysis still being prepared; others only use a ready one.
+FOLLOW_UP_PATTERN = re.compile(r'\b(?:why|fail\w*|error\w*|wrong|broke\w*|crash\w*|fix\w*)\b', re.IGNORECASE)
+
+def speculation_enabled():
+    return os.getenv("MUG_SPECULATE", "false") == "true"
+
+def get_max_concurrent():
+    try:
+        return max(int(os.getenv("SPECULATE_MAX_CONCURRENT", DEFAULT_MAX_CONCURRENT)), 0)
+    except ValueError:
+        return DEFAULT_MAX_CONCURRENT
+
+def get_analyses_path(log_path):
+    return f"{log_path}{ANALYSES_SUFFIX}"
+
+def get_command(record):
+    return shlex.join(record["argv"])
+
+def is_failure(record):
+    if record.get("status") not in (None, 0):
+        return True
+    return FAILURE_PATTERN.search(record.get("output") or "") is not None
+
+def get_entry_key(record):
+    """
+    Identifies a logged command by its command line and output, as they read back from the log.
+    """
+    from .dedup import normalize_output
+    material = f"{get_command(record)}\0{normalize_output(record.get('output') or '')}"
+    return hashlib.sha256(material.encode(errors='replace')).hexdigest()[:32]
+
+def get_mark_path(log_path):
+    return f"{log_path}{MARK_SUFFIX}"
+
+def read_mark(log_path):
+    try:
+        with open(get_mark_path(log_path), 'r') as mark_file:
+            return mark_file.read().strip()
+    except OSError:
+        return ""
+
+def load_analyses(log_path):
+    try:
+        with open(get_analyses_path(log_path), 'r') as analyses_file:
+            analyses = json.load(analyses_file)
+        if isinstance(analyses, dict):
+            return analyses
+    except (OSError, ValueError):
+        pass
+    return {}
+
+@contextmanager
+def locked_analyses(log_path):
+    """
+    Yields the session's analyses under an exclusive lock, and writes them back when the
+    block ends, keeping the ANALYSES_KEPT newest.
+    """
+    path = get_analyses_path(log_path)
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        analyses = load_analyses(log_path)
+        yield analyses
+        newest = sorted(analyses.items(), key=lambda item: item[1].get("created", 0))[-ANALYSES_KEPT:]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as analyses_file:
+            json.dump(dict(newest), analyses_file)
+        os.replace(tmp_path, path)
+
+def save_analysis(log_path, key, command, analysis):
+    with locked_analyses(log_path) as analyses:
+        if analysis is None:
+            analyses.pop(key, None)
+        else:
+            analyses[key] = {"command": command, "analysis": analysis, "created": time.time()}
+
+def iter_recent_records(log_path, limit=RECENT_ENTRIES):
+    """
+    Yields the last `limit` commands of a session log, newest first. Text entries are parsed
+    from the end of the log, with the exit status `mug_core capture` writes, if any.
+    """
+    if detect_log_format(log_path) == LOG_FORMAT_STRUCTURED:
+        for count, record in enumerate(iter_records_reversed(log_path)):
+            if count >= limit:
+                return
+            yield record
+        return
+
+    from .dedup import entry_record
+    views = iter_log_views(log_path, reverse=True)
+    try:
+        for offset, log_map, closed in views:
+            end = len(log_map)
+            while end > 0 and limit > 0:
+                marker = log_map.rfind(TEXT_ENTRY_MARKER, 0, end)
+                start = marker + 1 if marker != -1 else 0
+                text = log_map[start:end].decode(errors='replace')
+                end = start
+                record = entry_record(text)
+                if record is None:
+                    continue
+                status = STATUS_PATTERN.search(text)
+                record["status"] = int(status.group(1)) if status else None
+                limit -= 1
+                yield record
+            if limit <= 0:
+                return
+    finally:
+        views.close()
+
+def find_last_failure(log_path):
+    for record in iter_recent_records(log_path):
+        if is_failure(record):
+            return record
+    return None
+
+def maybe_start_analysis(log_path, record):
+    """
+    Starts a background analysis of a command just logged, if speculation is on and the
+    command failed. Never gets in the way of logging.
+
+    Args:
+        log_path (str): The session log the record was appended to.
+        record (dict): The record, as appended.
+
+    Returns:
+        None
+    """
+    if not speculation_enabled() or not get_max_concurrent() or not is_failure(record):
+        return
+    try:
+        subprocess.Popen(
+            [sys.executable, "-m", "mug_core.main", "speculate", "--log", log_path,
+             "--key", get_entry_key(record), "--mark", read_mark(log_path), "--", *record["argv"]],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            start_new_session=True,
+        )
+    except OSError as e:
+        print(f"Error starting the background analysis: {e}", file=sys.stderr)
+
+@contextmanager
+def speculation_slot():
+    """
+    Yields whether one of the SPECULATE_MAX_CONCURRENT slots was free. The slot is held
+    until the block ends, or until the process dies.
+    """
+    if not os.path.exists(SPECULATION_DIR):
+        os.makedirs(SPECULATION_DIR, exist_ok=True)
+    for slot in range(get_max_concurrent()):
+        lock_file = open(os.path.join(SPECULATION_DIR, f"slot-{slot}.lock"), 'w')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            continue
+        try:
+            yield True
+        finally:
+            lock_file.close()
+        return
+    yield False
+
+def analyze(log_path, key, command, mark):
+    """
+    Asks why `command` failed and keeps the answer, unless the next command starts first.
+
+    Returns:
+        str: The analysis, or None if it was superseded or failed.
+    """
+    from .chatgpt import LLM_ERROR_PREFIX, ask_chatgpt
+    from .context import build_context
+    streamed = []
+
+    def superseded():
+        return read_mark(log_path) != mark
+
+    def on_token(text):
+        if superseded():
+            raise KeyboardInterrupt
+        streamed.append(text)
+
+    if superseded():
+        return None
+    with locked_analyses(log_path) as analyses:
+        if key in analyses:
+            return analyses[key].get("analysis")
+        analyses[key] = {"command": command, "pending": os.getpid(), "created": time.time()}
+    analysis = None
+    try:
+        response = ask_chatgpt(EXPLAIN_QUESTION.format(command), build_context(log_path), on_token)
+        # Errors come back as text too, but only answers are streamed without an error message.
+        if streamed and LLM_ERROR_PREFIX not in response and not response.endswith("[cancelled]") and not superseded():
+            analysis = response
+    except KeyboardInterrupt:
+        pass
+    finally:
+        save_analysis(log_path, key, command, analysis)
+    return analysis
+
+def speculate_command(args):
+    """
+    Entry point of `mug_core speculate`, started in the background by maybe_start_analysis.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core speculate")
+    parser.add_argument("--log", required=True, help="The session log file.")
+    parser.add_argument("--key", required=True, help="The entry key of the failed command.")
+    parser.add_argument("--mark", default="", help="The speculation mark when the command ran.")
+    parser.add_argument("argv", nargs=argparse.REMAINDER)
+    options = parser.parse_args(args)
+    argv = options.argv[1:] if options.argv[:1] == ["--"] else options.argv
+
+    with speculation_slot() as free:
+        if free:
+            analyze(options.log, options.key, shlex.join(argv), options.mark)
+
+def is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, TypeError):
+        pass
+    return True
+
+def wait_for_analysis(log_path, key, timeout=PENDING_TIMEOUT):
+    """
+    Returns the analysis of `key`, waiting up to `timeout` seconds for one still being
+    prepared, or None.
+    """
+    deadline = time.time() + timeout
+    while True:
+        entry = load_analyses(log_path).get(key)
+        if entry is None:
+            return None
+        if not entry.get("pending"):
+            return entry.get("analysis")
+        if time.time() > min(deadline, entry.get("created", 0) + PENDING_TIMEOUT) or not is_running(entry["pending"]):
+            return None
+        time.sleep(0.2)
+
+def get_newest_failure(log_path):
+    """
+    Returns the newest command of the session if it failed, else None.
+    """
+    if not speculation_enabled() or not log_path or not os.path.exists(log_path):
+        return None
+    newest = next(iter_recent_records(log_path, 1), None)
+    return newest if newest is not None and is_failure(newest) else None
+
+def normalize_question(question):
+    return " ".join(question.split()).lower()
+
+def find_prepared_analysis(question, log_path):
+    """
+    Returns the prepared analysis of the newest command if `question` is the one the
+    analysis answers (the question `--explain-last` asks), else None.
+    """
+    newest = get_newest_failure(log_path)
+    if newest is None or normalize_question(question) != normalize_question(EXPLAIN_QUESTION.format(get_command(newest))):
+        return None
+    return wait_for_analysis(log_path, get_entry_key(newest), FOLLOW_UP_WAIT)
+
+def get_analysis_context(question, log_path):
+    """
+    Returns the prepared analysis of the newest command, as context to add to any other
+    question, or "". Questions that look like follow-ups wait up to FOLLOW_UP_WAIT seconds
+    for an analysis still being prepared; others only use one that is ready.
+    """
+    newest = get_newest_failure(log_path)
+    if newest is None:
+        return ""
+    timeout = FOLLOW_UP_WAIT if FOLLOW_UP_PATTERN.search(question) else 0
+    analysis = wait_for_analysis(log_path, get_entry_key(newest), timeout)
+    return ANALYSIS_CONTEXT.format(get_command(newest), analysis) if analysis else ""
+
+def explain_command(args):
+    """
+    Entry point of `mug_core explain`, run by `mug --explain-last`: explains the last failed
+    command of the session, from the background analysis when there is one.
+    """
+    from .api import load_session_log_file
+    parser = argparse.ArgumentParser(prog="mug_core explain", description="Explain the last failed command.")
+    parser.add_argument("log", nargs="?", default=None, help="The session log. Defaults to the current session's.")
+    options = parser.parse_args(args)
+
+    log_path = options.log or load_session_log_file()
+    if not log_path or not os.path.exists(log_path):
+        print("No session log found.")
+        return
+    record = find_last_failure(log_path)
+    if record is None:
+        print(f"No failed command in the last {RECENT_ENTRIES} commands.")
+        return
+    command = get_command(record)
+    key = get_entry_key(record)
+    analysis = wait_for_analysis(log_path, key)
+    if analysis is not None:
+        print(f"(prepared in the background when `{command}` failed)", file=sys.stderr)
+        print(f"ChatGPT response: {analysis}")
+        return
+
+    from .chatgpt import print_chatgpt_response
+    from .context import build_context
+    from .chatgpt import LLM_ERROR_PREFIX
+    response = print_chatgpt_response(EXPLAIN_QUESTION.format(command), build_context(log_path))
+    if response and LLM_ERROR_PREFIX not in response and not response.endswith("[cancelled]"):
+        save_analysis(log_path, key, command, response)
@@ -0,0 +1,359 @@
+import os
+import json
+import fcntl
+
+from .log_segments import SHARED_MARKER
+from .paths import LOG_DIR
+
+# Where session logs live. A backend knows where a session's log is on this machine, how to
+# allocate and list sessions, and how to keep the log in step with everyone else's copy:
+# - "s3": the log is a local copy, pulled before and uploaded after each command.
+# - "local": the log is on this machine only; nothing is synced.
+# - "shared": the log itself is in a directory every participant mounts (NFS, Lustre, ...).
+#   There is nothing to sync; each entry is written with one locked append (see
+#   session_log.append_to_log), so an append costs a lock round trip instead of an S3 one.
+# The backend is STORAGE_BACKEND in ~/.mug/config.json. Configs from before it was added
+# have NO_AWS instead, which maps to "s3" or "local".
+STORAGE_S3 = "s3"
+STORAGE_LOCAL = "local"
+STORAGE_SHARED = "shared"
+SHARED_SESSIONS_DIR = "sessions"
+SHARED_CATALOG_NAME = "catalog.json"
+CATALOG_RECENT = 20
+
+class StorageBackend:
+    """
+    The interface of a storage backend. Syncing is a no-op unless the backend keeps a local copy.
+    """
+    name = None
+
+    def get_session_path(self, log_name):
+        """
+        Returns where the session log `log_name` (e.g. "session_log_3.txt") is on this machine.
+        """
+        return os.path.join(LOG_DIR, log_name)
+
+    def next_log_number(self):
+        raise NotImplementedError
+
+    def list_sessions(self):
+        """
+        Returns the names of the most recent sessions.
+        """
+        raise NotImplementedError
+
+    def sync_from(self, local_file, key, mode=None):
+        """
+        Brings the local log up to date with the other participants' commands.
+        """
+        return None
+
+    def sync_to(self, local_file, key, mode=None):
+        """
+        Publishes the local log's new commands. Returns True if they are published.
+        """
+        return True
+
+    def read_session_object(self, local_file, key, name):
+        """
+        Returns the bytes stored as `name` next to the session log for every participant
+        (an entry of its shared answer cache, say), or None. Backends that share nothing hold none.
+        """
+        return None
+
+    def write_session_object(self, local_file, key, name, data):
+        """
+        Stores `data` as `name` next to the session log for every participant.
+        """
+        return None
+
+    def list_session_objects(self, local_file, key, prefix):
+        """
+        Returns (name, size, mtime) for the objects stored next to the session log whose
+        name starts with `prefix`.
+        """
+        return []
+
+    def delete_session_objects(self, local_file, key, names):
+        """
+        Deletes objects stored next to the session log. Missing ones are ignored.
+        """
+        return None
+
+class LocalStorage(StorageBackend):
+    name = STORAGE_LOCAL
+
+    def next_log_number(self):
+        from .aws_s3 import get_next_log_number_local
+        return get_next_log_number_local()
+
+    def list_sessions(self):
+        from .aws_s3 import list_local_session_logs
+        return list_local_session_logs()
+
+class S3Storage(StorageBackend):
+    name = STORAGE_S3
+
+    def __init__(self, bucket_name):
+        self.bucket_name = bucket_name
+
+    def next_log_number(self):
+        from .aws_s3 import get_next_log_number
+        return get_next_log_number(self.bucket_name)
+
+    def list_sessions(self):
+        from .aws_s3 import list_session_logs
+        return list_session_logs(self.bucket_name)
+
+    def sync_from(self, local_file, key, mode=None):
+        from .aws_s3 import sync_session_from_s3
+        return sync_session_from_s3(self.bucket_name, key, local_file, mode)
+
+    def sync_to(self, local_file, key, mode=None):
+        from .aws_s3 import sync_session_to_s3
+        return sync_session_to_s3(self.bucket_name, local_file, key, mode)
+
+    def read_session_object(self, local_file, key, name):
+        from botocore.exceptions import ClientError
+        from .aws_s3 import is_missing, read_object
+        try:
+            data, _ = read_object(self.bucket_name, f"{key}{name}")
+        except ClientError as e:
+            if is_missing(e):
+                return None
+            raise
+        return data
+
+    def write_session_object(self, local_file, key, name, data):
+        from .aws_s3 import get_s3_client
+        get_s3_client().put_object(Bucket=self.bucket_name, Key=f"{key}{name}", Body=data)
+
+    def list_session_objects(self, local_file, key, prefix):
+        from .aws_s3 import get_s3_client
+        paginator = get_s3_client().get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=f"{key}{prefix}"):
+            for obj in page.get('Contents', []):
+                objects.append((obj['Key'][len(key):], obj['Size'], obj['LastModified'].timestamp()))
+        return objects
+
+    def delete_session_objects(self, local_file, key, names):
+        from .aws_s3 import get_s3_client
+        objects = [{"Key": f"{key}{name}"} for name in names]
+        s3_client = get_s3_client()
+        for i in range(0, len(objects), 1000):
+            s3_client.delete_objects(Bucket=self.bucket_name, Delete={"Objects": objects[i:i + 1000], "Quiet": True})
+
+class SharedDirStorage(StorageBackend):
+    """
+    Session logs in `<root>/sessions/`, with a catalog of session numbers next to them that
+    is updated under an fcntl lock, the lock NFS and Lustre honor across hosts.
+    """
+    name = STORAGE_SHARED
+
+    def __init__(self, root):
+        self.root = os.path.abspath(os.path.expanduser(root))
+        self.sessions_dir = os.path.join(self.root, SHARED_SESSIONS_DIR)
+        self.catalog_path = os.path.join(self.sessions_dir, SHARED_CATALOG_NAME)
+
+    def get_session_path(self, log_name):
+        return os.path.join(self.sessions_dir, log_name)
+
+    def ensure_directory(self):
+        if not os.path.exists(self.sessions_dir):
+            os.makedirs(self.sessions_dir)
+        marker = os.path.join(self.sessions_dir, SHARED_MARKER)
+        if not os.path.exists(marker):
+            with open(marker, 'a'):
+                pass
+
+    def read_catalog(self):
+        try:
+            with open(self.catalog_path, 'r') as catalog_file:
+                return json.load(catalog_file)
+        except (OSError, ValueError):
+            return None
+
+    def seed_catalog(self):
+        from .aws_s3 import SESSION_LOG_PATTERN
+        numbers = sorted(int(match.group(1)) for match in map(SESSION_LOG_PATTERN.match, os.listdir(self.sessions_dir)) if match)
+        return {"next": numbers[-1] + 1 if numbers else 1, "recent": numbers[-CATALOG_RECENT:]}
+
+    def next_log_number(self):
+        self.ensure_directory()
+        with open(self.catalog_path, 'a+') as catalog_file:
+            fcntl.lockf(catalog_file, fcntl.LOCK_EX)
+            catalog_file.seek(0)
+            try:
+                catalog = json.loads(catalog_file.read())
+            except ValueError:
+                catalog = self.seed_catalog()
+            log_number = catalog["next"]
+            updated = {"next": log_number + 1, "recent": (catalog.get("recent", []) + [log_number])[-CATALOG_RECENT:]}
+            # Rewritten in place: a renamed file would not carry the lock other hosts wait on.
+            catalog_file.seek(0)
+            catalog_file.truncate()
+            catalog_file.write(json.dumps(updated))
+            catalog_file.flush()
+            os.fsync(catalog_file.fileno())
+        return log_number
+
+    def list_sessions(self):
+        if not os.path.exists(self.sessions_dir):
+            return []
+        catalog = self.read_catalog() or self.seed_catalog()
+        return [f"session_log_{number}.txt" for number in catalog.get("recent", [])]
+
+    def read_session_object(self, local_file, key, name):
+        try:
+            with open(f"{local_file}{name}", 'rb') as object_file:
+                return object_file.read()
+        except FileNotFoundError:
+            return None
+
+    def write_session_object(self, local_file, key, name, data):
+        path = f"{local_file}{name}"
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory, exist_ok=True)
+        # Written under a name of its own and renamed, so readers on other hosts never see half of it.
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'wb') as object_file:
+            object_file.write(data)
+        os.replace(tmp_path, path)
+
+    def list_session_objects(self, local_file, key, prefix):
+        directory = os.path.dirname(f"{local_file}{prefix}")
+        if not os.path.isdir(directory):
+            return []
+        objects = []
+        for file in os.listdir(directory):
+            path = os.path.join(directory, file)
+            name = path[len(local_file):]
+            if not name.startswith(prefix) or file.endswith(".tmp"):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            objects.append((name, stat.st_size, stat.st_mtime))
+        return objects
+
+    def delete_session_objects(self, local_file, key, names):
+        for name in names:
+            try:
+                os.unlink(f"{local_file}{name}")
+            except FileNotFoundError:
+                pass
+
+def get_storage_name(config):
+    name = config.get("STORAGE_BACKEND")
+    if name in (STORAGE_S3, STORAGE_LOCAL, STORAGE_SHARED):
+        return name
+    return STORAGE_S3 if config.get("NO_AWS") == "false" else STORAGE_LOCAL
+
+def get_storage_backend(config):
+    """
+    Returns the storage backend a config describes.
+
+    Args:
+        config (dict): The configuration, as in ~/.mug/config.json.
+
+    Returns:
+        StorageBackend: The backend.
+    """
+    name = get_storage_name(config)
+    if name == STORAGE_S3:
+        return S3Storage(config.get("BUCKET_NAME"))
+    if name == STORAGE_SHARED and config.get("SHARED_DIR"):
+        return SharedDirStorage(config["SHARED_DIR"])
+    return LocalStorage()
+
+def get_session_file(config):
+    """
+    Returns the path of the config's session log on this machine, or "" if it has none.
+    """
+    log_name = config.get("SESSION_LOG_NAME")
+    return get_storage_backend(config).get_session_path(log_name) if log_name else ""
+
+def create_session_log(local_file):
+    with open(local_file, 'a') as file:
+        # Structured logs start empty; their format is detected from the first record.
+        if os.path.getsize(local_file) == 0 and os.getenv("LOG_FORMAT", "text") != "structured":
+            file.write("This is a session log.\n")
+
+def use_local_storage():
+    """
+    Starts a new session on this machine only.
+    """
+    os.environ["STORAGE_BACKEND"] = STORAGE_LOCAL
+    os.environ["NO_AWS"] = "true"
+    os.environ["AWS_ACCESS_KEY_ID"] = ""
+    os.environ["AWS_SECRET_ACCESS_KEY"] = ""
+    storage = LocalStorage()
+    log_name = f"session_log_{storage.next_log_number()}.txt"
+    create_session_log(storage.get_session_path(log_name))
+    os.environ["SESSION_LOG_NAME"] = log_name
+
+def use_shared_directory(root):
+    """
+    Joins or starts a session in a shared directory.
+    """
+    storage = SharedDirStorage(root)
+    storage.ensure_directory()
+    session_logs = storage.list_sessions()
+    log_number = None
+    if session_logs:
+        print(f"Recent session logs: {', '.join(session_logs)}")
+        choice = input("Enter the log number (`session_log_{number}.txt`) to continue or 'n' for a new log: ")
+        if choice.isdigit() and os.path.exists(storage.get_session_path(f"session_log_{choice}.txt")):
+            log_number = int(choice)
+        elif choice.lower() != 'n':
+            print("Invalid choice. Creating a new session log.")
+    if log_number is None:
+        log_number = storage.next_log_number()
+        print(f"`session_log_{log_number}.txt` has been created.")
+    log_name = f"session_log_{log_number}.txt"
+    create_session_log(storage.get_session_path(log_name))
+    os.environ["STORAGE_BACKEND"] = STORAGE_SHARED
+    os.environ["SHARED_DIR"] = storage.root
+    os.environ["SESSION_LOG_NAME"] = log_name
+    os.environ["NO_AWS"] = "true"
+    print(f"Session log: {storage.get_session_path(log_name)}")
+
+def storage_menu():
+    """
+    Asks where the session log should live and sets the session up there:
+    an S3 bucket, a directory shared with the other participants, or this machine only.
+
+    Returns:
+        None
+    """
+    while True:
+        choice = input('"s" for an S3 bucket, "d" for a shared directory (NFS, Lustre), "l" for this machine only: ').lower()
+        if choice == 's':
+            from .aws_s3 import aws_menu, get_aws_credentials
+            if get_aws_credentials():
+                os.environ["STORAGE_BACKEND"] = STORAGE_S3
+                aws_menu()
+                if os.getenv("NO_AWS") != "false":
+                    os.environ["STORAGE_BACKEND"] = STORAGE_LOCAL
+            else:
+                use_local_storage()
+            return
+        elif choice == 'd':
+            default = os.getenv("MUG_SHARED_DIR", "")
+            root = input(f"Enter the shared directory{f' [{default}]' if default else ''}: ").strip() or default
+            if not root:
+                print("No directory given.")
+                continue
+            try:
+                use_shared_directory(root)
+                return
+            except OSError as e:
+                print(f"Cannot use '{root}': {e}")
+        elif choice == 'l':
+            use_local_storage()
+            return
+        else:
+            print("Invalid choice. Please try again.")
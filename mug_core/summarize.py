@@ -0,0 +1,229 @@
+import os
+import sys
+import json
+import fcntl
+import hashlib
+import subprocess
+import threading
+
+from .context import count_tokens, get_context_token_budget
+from .retrieval import read_entry, update_retrieval_index
+
+# Old history is sent to the model as digests instead of raw entries.
+# The log is cut into segments of SEGMENT_ENTRIES commands; a segment is closed once another
+# full segment of newer commands follows it, and only closed segments are summarized.
+# Digests live next to the log in `<log>.digests.json`, keyed by a hash of the segment's
+# text, so an unchanged segment is summarized exactly once, even after the indexes are rebuilt.
+# Digests cost LLM calls made in the background, so they are off unless SUMMARIES=true.
+DIGESTS_SUFFIX = ".digests.json"
+DEFAULT_SEGMENT_ENTRIES = 40
+# Share of the context budget that digests may take; the rest is left for raw entries.
+DIGEST_BUDGET_SHARE = 0.25
+# Each entry of a segment is cut to this many characters before it is summarized.
+MAX_SUMMARY_ENTRY_CHARS = 2000
+
+_summarizing = threading.Lock()
+
+def summaries_enabled():
+    return os.getenv("SUMMARIES", "false") == "true"
+
+def get_segment_entries():
+    try:
+        return max(int(os.getenv("SUMMARY_SEGMENT_ENTRIES", DEFAULT_SEGMENT_ENTRIES)), 1)
+    except ValueError:
+        return DEFAULT_SEGMENT_ENTRIES
+
+def get_digests_path(log_path):
+    return f"{log_path}{DIGESTS_SUFFIX}"
+
+def load_digests(log_path):
+    """
+    Returns the digest store: {"digests": {segment hash: digest}, "segments": [segment hash, ...],
+    "spans": [[first locator, last locator], ...]}. Spans let an unchanged segment be
+    recognized without reading it again.
+    """
+    try:
+        with open(get_digests_path(log_path), 'r') as digests_file:
+            store = json.load(digests_file)
+        if (isinstance(store.get("digests"), dict) and isinstance(store.get("segments"), list)
+                and len(store.get("spans", [])) == len(store["segments"])):
+            return store
+    except (OSError, ValueError):
+        pass
+    return {"digests": {}, "segments": [], "spans": []}
+
+def save_digests(log_path, store):
+    path = get_digests_path(log_path)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as digests_file:
+        json.dump(store, digests_file)
+    os.replace(tmp_path, path)
+
+def count_closed_segments(doc_count, segment_entries):
+    return max(doc_count - segment_entries, 0) // segment_entries
+
+def shorten_entry(entry):
+    if len(entry) <= MAX_SUMMARY_ENTRY_CHARS:
+        return entry
+    half = MAX_SUMMARY_ENTRY_CHARS // 2
+    return f"{entry[:half]}\n[... {len(entry) - 2 * half} characters omitted ...]\n{entry[-half:]}"
+
+def get_segment_span(index, segment, segment_entries):
+    first = segment * segment_entries
+    return [list(index.get_doc(first)[:2]), list(index.get_doc(first + segment_entries - 1)[:2])]
+
+def read_segment(log_path, index, segment, segment_entries):
+    first = segment * segment_entries
+    return "".join(shorten_entry(read_entry(log_path, index, doc_id))
+                   for doc_id in range(first, first + segment_entries))
+
+def summarize_session_log(log_path):
+    """
+    Summarizes every closed segment of the log that has no digest yet.
+    Digests are saved one at a time, so an interrupted run loses at most one segment.
+
+    Args:
+        log_path (str): The session log file.
+
+    Returns:
+        int: The number of segments summarized.
+    """
+    from .chatgpt import summarize_text
+
+    segment_entries = get_segment_entries()
+    with update_retrieval_index(log_path) as index:
+        closed = count_closed_segments(index.doc_count, segment_entries)
+        store = load_digests(log_path)
+        known = store["digests"]
+        segments = []
+        spans = []
+        summarized = 0
+        for segment in range(closed):
+            span = get_segment_span(index, segment, segment_entries)
+            if segment < len(store["spans"]) and store["spans"][segment] == span and store["segments"][segment] in known:
+                segment_hash = store["segments"][segment]
+            else:
+                text = read_segment(log_path, index, segment, segment_entries)
+                segment_hash = hashlib.sha256(text.encode()).hexdigest()
+                if segment_hash not in known:
+                    digest = summarize_text(text, log_path)
+                    if digest is None:
+                        # No backend to summarize with; keep what is there for the next run.
+                        return summarized
+                    known[segment_hash] = digest
+                    summarized += 1
+                    save_digests(log_path, {"digests": known, "segments": segments + [segment_hash], "spans": spans + [span]})
+            segments.append(segment_hash)
+            spans.append(span)
+
+    if segments != store["segments"] or spans != store["spans"] or set(known) != set(segments):
+        # Digests of segments that are no longer part of the log are dropped.
+        save_digests(log_path, {"digests": {h: known[h] for h in segments}, "segments": segments, "spans": spans})
+    return summarized
+
+def has_pending_segments(log_path, index=None):
+    """
+    Tells whether the log has closed segments that are not summarized yet.
+    """
+    if index is None:
+        with update_retrieval_index(log_path) as index:
+            return has_pending_segments(log_path, index)
+    closed = count_closed_segments(index.doc_count, get_segment_entries())
+    return closed > len(load_digests(log_path)["segments"])
+
+def run_summarizer(log_path):
+    """
+    Summarizes pending segments unless another process is already doing it for this log.
+    """
+    with open(f"{get_digests_path(log_path)}.lock", 'w') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return 0
+        return summarize_session_log(log_path)
+
+def start_background_summary(log_path, in_thread=False):
+    """
+    Summarizes pending segments off the critical path: in a thread when called from a
+    long-lived process such as the agent, otherwise in a detached `mug_core summarize` process.
+
+    Args:
+        log_path (str): The session log file.
+        in_thread (bool): Whether to summarize in a thread of this process.
+
+    Returns:
+        None
+    """
+    if not summaries_enabled() or not os.path.exists(log_path):
+        return
+    try:
+        if not has_pending_segments(log_path):
+            return
+    except Exception as e:
+        print(f"Error checking the session digests: {e}")
+        return
+
+    if in_thread:
+        def summarize():
+            if not _summarizing.acquire(blocking=False):
+                return
+            try:
+                run_summarizer(log_path)
+            except Exception as e:
+                # To the agent log: this thread serves no client.
+                print(f"Error summarizing the session log: {e}", file=sys.__stdout__)
+            finally:
+                _summarizing.release()
+        threading.Thread(target=summarize, daemon=True).start()
+        return
+
+    subprocess.Popen(
+        [sys.executable, "-m", "mug_core.main", "summarize", log_path],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+
+def build_digest_context(log_path, token_budget=None, model=None):
+    """
+    Returns the digests of the log's closed segments, oldest first, as much of the most
+    recent history as fits in the digest share of the budget. Segments not summarized yet
+    are simply missing; the raw tail and retrieval still cover them.
+
+    Args:
+        log_path (str): The session log file.
+        token_budget (int): The whole context budget. Defaults to CONTEXT_TOKEN_BUDGET.
+        model (str): The model whose tokenizer to count with.
+
+    Returns:
+        str: The digests, or an empty string if there are none.
+    """
+    if not summaries_enabled():
+        return ""
+    budget = token_budget if token_budget is not None else get_context_token_budget()
+    budget = int(budget * DIGEST_BUDGET_SHARE)
+    store = load_digests(log_path)
+    pieces = []
+    used = 0
+    for segment_hash in reversed(store["segments"]):
+        digest = store["digests"].get(segment_hash)
+        if not digest:
+            continue
+        tokens = count_tokens(digest, model)
+        if used + tokens > budget:
+            break
+        pieces.append(digest)
+        used += tokens
+    if not pieces:
+        return ""
+    return "Summary of earlier session history:\n" + "\n".join(reversed(pieces)) + "\n"
+
+def summarize_command(args):
+    """
+    Entry point of `mug_core summarize <log>`, run detached by start_background_summary.
+    """
+    if len(args) != 1:
+        print("Usage: mug_core summarize <session log>")
+        return
+    run_summarizer(args[0])
@@ -0,0 +1,187 @@
+import os
+import sys
+import json
+import math
+import time
+import socket
+import argparse
+from contextlib import contextmanager
+
+from .paths import LOG_DIR
+
+# Per-phase latency spans, one compact JSON line each in ~/.mug/trace.jsonl:
+#   {"t": start (unix time), "p": phase, "d": duration in ms, "h": host}
+# The shell hook writes its own spans (hook.*) with printf, so tracing a command costs no
+# extra process; Python code uses span() or record_span(). MUG_TRACE=false turns it off.
+# The file is rotated to trace.jsonl.1 at TRACE_MAX_BYTES, so at most two files are kept.
+TRACE_PATH = os.path.join(LOG_DIR, "trace.jsonl")
+TRACE_MAX_BYTES = 4 * 1024 * 1024
+QUANTILES = (0.5, 0.95, 0.99)
+ALL_HOSTS = "*"
+
+_host = None
+
+def tracing_enabled():
+    return os.getenv("MUG_TRACE", "true") != "false"
+
+def get_host():
+    global _host
+    if _host is None:
+        _host = socket.gethostname()
+    return _host
+
+def record_span(phase, seconds, start=None):
+    """
+    Appends one span. Tracing never gets in the way: write errors are ignored.
+
+    Args:
+        phase (str): The phase name, e.g. "s3.upload".
+        seconds (float): How long the phase took.
+        start (float): When it started, as a Unix timestamp. Defaults to now minus `seconds`.
+
+    Returns:
+        None
+    """
+    if not tracing_enabled() or seconds is None:
+        return
+    span = {
+        "t": round(start if start is not None else time.time() - seconds, 3),
+        "p": phase,
+        "d": round(seconds * 1000, 2),
+        "h": get_host(),
+    }
+    try:
+        directory = os.path.dirname(TRACE_PATH)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        if os.path.exists(TRACE_PATH) and os.path.getsize(TRACE_PATH) > TRACE_MAX_BYTES:
+            os.replace(TRACE_PATH, f"{TRACE_PATH}.1")
+        # One short write in append mode, so concurrent writers do not interleave lines.
+        with open(TRACE_PATH, 'a') as trace_file:
+            trace_file.write(json.dumps(span, separators=(",", ":")) + "\n")
+    except OSError:
+        pass
+
+@contextmanager
+def span(phase):
+    """
+    Records how long the block takes as a span of `phase`, even if it raises.
+    """
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(phase, time.perf_counter() - started, start)
+
+def load_spans(since=None):
+    """
+    Reads the spans of both trace files, skipping malformed lines.
+
+    Args:
+        since (float): Only spans starting at or after this Unix timestamp.
+
+    Returns:
+        list: The spans.
+    """
+    spans = []
+    for path in (f"{TRACE_PATH}.1", TRACE_PATH):
+        try:
+            with open(path, 'r') as trace_file:
+                for line in trace_file:
+                    try:
+                        entry = json.loads(line)
+                        if since is None or entry["t"] >= since:
+                            spans.append(entry)
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except OSError:
+            continue
+    return spans
+
+def quantile(ordered, q):
+    """
+    Nearest-rank quantile of an ascending list.
+    """
+    return ordered[min(max(math.ceil(q * len(ordered)) - 1, 0), len(ordered) - 1)]
+
+def summarize_spans(spans):
+    """
+    Groups durations by (phase, host), with an extra ALL_HOSTS group per phase.
+
+    Returns:
+        dict: {(phase, host): {"count", "sum", "p50", "p95", "p99"}}, durations in ms.
+    """
+    groups = {}
+    for entry in spans:
+        for host in (entry.get("h") or "unknown", ALL_HOSTS):
+            groups.setdefault((entry["p"], host), []).append(float(entry["d"]))
+    summary = {}
+    for key, durations in groups.items():
+        durations.sort()
+        summary[key] = {"count": len(durations), "sum": sum(durations)}
+        for q in QUANTILES:
+            summary[key][f"p{int(q * 100)}"] = quantile(durations, q)
+    return summary
+
+def format_stats(summary):
+    lines = [f"{'phase':<22} {'host':<20} {'count':>7} {'p50 ms':>10} {'p95 ms':>10} {'p99 ms':>10}"]
+    for (phase, host) in sorted(summary, key=lambda key: (key[0], key[1] != ALL_HOSTS, key[1])):
+        stats = summary[(phase, host)]
+        lines.append(f"{phase:<22} {host:<20} {stats['count']:>7} {stats['p50']:>10.1f} {stats['p95']:>10.1f} {stats['p99']:>10.1f}")
+    return "\n".join(lines)
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def write_prometheus_textfile(summary, path):
+    """
+    Writes the per-host quantiles as a Prometheus summary, for node_exporter's textfile
+    collector. The file is replaced atomically, as the collector requires.
+    """
+    lines = [
+        "# HELP mug_phase_duration_seconds Duration of mug phases, from ~/.mug/trace.jsonl.",
+        "# TYPE mug_phase_duration_seconds summary",
+    ]
+    for (phase, host), stats in sorted(summary.items()):
+        if host == ALL_HOSTS:
+            continue
+        labels = f"phase=\"{escape_label(phase)}\",host=\"{escape_label(host)}\""
+        for q in QUANTILES:
+            lines.append(f"mug_phase_duration_seconds{{{labels},quantile=\"{q}\"}} {stats[f'p{int(q * 100)}'] / 1000:.6f}")
+        lines.append(f"mug_phase_duration_seconds_sum{{{labels}}} {stats['sum'] / 1000:.6f}")
+        lines.append(f"mug_phase_duration_seconds_count{{{labels}}} {stats['count']}")
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as textfile:
+        textfile.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, path)
+
+def stats_command(args):
+    """
+    Entry point of `mug_core stats`, run by `mug --stats`: prints p50/p95/p99 per phase and
+    host, and optionally writes them as a Prometheus textfile (MUG_PROMETHEUS_TEXTFILE).
+    """
+    parser = argparse.ArgumentParser(prog="mug_core stats", description="Summarize mug latency traces.")
+    parser.add_argument("--since", type=float, default=None, help="Only the last N hours.")
+    parser.add_argument("--phase", default=None, help="Only phases starting with this prefix.")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON.")
+    parser.add_argument("--prometheus", default=os.getenv("MUG_PROMETHEUS_TEXTFILE"),
+                        help="Also write a Prometheus textfile here.")
+    options = parser.parse_args(args)
+
+    since = time.time() - options.since * 3600 if options.since else None
+    spans = [entry for entry in load_spans(since) if not options.phase or entry["p"].startswith(options.phase)]
+    if not spans:
+        print(f"No matching spans in {TRACE_PATH}.")
+        return
+    summary = summarize_spans(spans)
+    if options.json:
+        print(json.dumps([dict(phase=phase, host=host, **stats) for (phase, host), stats in sorted(summary.items())], indent=2))
+    else:
+        print(format_stats(summary))
+    if options.prometheus:
+        try:
+            write_prometheus_textfile(summary, options.prometheus)
+            print(f"Wrote {options.prometheus}", file=sys.stderr)
+        except OSError as e:
+            print(f"Error writing the Prometheus textfile: {e}", file=sys.stderr)
@@ -0,0 +1,242 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import argparse
+import subprocess
+from contextlib import contextmanager, redirect_stdout
+
+from .paths import LOG_DIR
+
+# Session log uploads happen off the shell's critical path. After a command, the hook only
+# records the log in a small journal (~/.mug/upload_queue.json) and returns; one detached
+# uploader waits UPLOAD_COALESCE_MS for the rest of a burst of commands, uploads each queued
+# log once, and drops it from the journal only when the upload succeeded. A log queued again
+# while its upload runs is uploaded again afterwards. Pending uploads survive the shell
+# exiting, and `mug --end` flushes whatever is left.
+#
+# This module is imported by the hook on every command, so it avoids importing the SDKs;
+# aws_s3 is only imported by the uploader itself.
+QUEUE_PATH = os.path.join(LOG_DIR, "upload_queue.json")
+UPLOADER_LOCK_PATH = os.path.join(LOG_DIR, "uploader.lock")
+UPLOADER_LOG_PATH = os.path.join(LOG_DIR, "uploader.log")
+DEFAULT_COALESCE_MS = 750
+DEFAULT_FLUSH_TIMEOUT = 300.0
+# Consecutive failures of one log before the uploader leaves it for the next run.
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+
+def get_coalesce_seconds():
+    try:
+        return max(int(os.getenv("UPLOAD_COALESCE_MS", DEFAULT_COALESCE_MS)), 0) / 1000.0
+    except ValueError:
+        return DEFAULT_COALESCE_MS / 1000.0
+
+@contextmanager
+def locked_journal():
+    """
+    Yields the journal, {local_file: {bucket, local_file, key, mode, version, queued}},
+    under an exclusive lock, and writes it back when the block ends.
+    """
+    if not os.path.exists(LOG_DIR):
+        os.makedirs(LOG_DIR)
+    with open(f"{QUEUE_PATH}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        uploads = load_journal()
+        yield uploads
+        tmp_path = f"{QUEUE_PATH}.tmp"
+        with open(tmp_path, 'w') as queue_file:
+            json.dump(uploads, queue_file)
+        os.replace(tmp_path, QUEUE_PATH)
+
+def load_journal():
+    try:
+        with open(QUEUE_PATH, 'r') as queue_file:
+            return json.load(queue_file)
+    except (OSError, ValueError):
+        return {}
+
+def has_pending_upload(local_file):
+    return local_file in load_journal()
+
+def enqueue_upload(bucket_name, local_file, s3_key, mode=None):
+    """
+    Queues an upload of the session log and makes sure the uploader is running.
+    Queuing a log that is already queued coalesces the two into one upload.
+
+    Args:
+        bucket_name (str): The bucket.
+        local_file (str): The session log file.
+        s3_key (str): The key to upload it as.
+        mode (str): The sync mode. Defaults to SYNC_MODE.
+
+    Returns:
+        None
+    """
+    with locked_journal() as uploads:
+        previous = uploads.get(local_file, {})
+        uploads[local_file] = {
+            "bucket": bucket_name,
+            "local_file": local_file,
+            "key": s3_key,
+            "mode": mode or None,
+            "version": previous.get("version", 0) + 1,
+            "queued": previous.get("queued", time.time()),
+        }
+    start_uploader()
+
+def complete_upload(entry):
+    """
+    Drops an uploaded log from the journal, unless it was queued again during the upload.
+    """
+    with locked_journal() as uploads:
+        current = uploads.get(entry["local_file"])
+        if current and current["version"] == entry["version"]:
+            del uploads[entry["local_file"]]
+
+def upload_entry(entry):
+    from .storage import S3Storage
+    return S3Storage(entry["bucket"]).sync_to(entry["local_file"], entry["key"], entry["mode"])
+
+def drain_queue(coalesce=0.0, on_progress=None, deadline=None):
+    """
+    Uploads queued logs until the journal is empty, or every log left has failed
+    MAX_ATTEMPTS times in a row.
+
+    Args:
+        coalesce (float): Seconds to wait before each round, for more commands to arrive.
+        on_progress (callable): Called with (done, total, entry) after each upload.
+        deadline (float): time.monotonic() after which no new upload is started.
+
+    Returns:
+        dict: The version of each log still pending, by file.
+    """
+    failures = {}
+    done = 0
+    while True:
+        if coalesce:
+            time.sleep(coalesce)
+        uploads = [entry for entry in load_journal().values() if failures.get(entry["local_file"], 0) < MAX_ATTEMPTS]
+        if not uploads or (deadline is not None and time.monotonic() >= deadline):
+            return {entry["local_file"]: entry["version"] for entry in load_journal().values()}
+        for entry in uploads:
+            if deadline is not None and time.monotonic() >= deadline:
+                break
+            if not os.path.exists(entry["local_file"]):
+                complete_upload(entry)
+                continue
+            if upload_entry(entry):
+                failures.pop(entry["local_file"], None)
+                complete_upload(entry)
+                done += 1
+            else:
+                failures[entry["local_file"]] = failures.get(entry["local_file"], 0) + 1
+                time.sleep(RETRY_BASE_DELAY * 2 ** (failures[entry["local_file"]] - 1))
+            if on_progress:
+                on_progress(done, done + len(load_journal()), entry)
+
+def run_uploader():
+    """
+    Drains the queue unless another uploader already is. An upload queued just before the
+    lock is released found the uploader still running and relied on it, so the journal is
+    checked again afterwards for entries newer than those given up on.
+    """
+    while True:
+        with open(UPLOADER_LOCK_PATH, 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+            given_up = drain_queue(get_coalesce_seconds())
+        pending = {entry["local_file"]: entry["version"] for entry in load_journal().values()}
+        if pending == given_up or not pending:
+            return
+
+def start_uploader():
+    """
+    Starts a detached `mug_core upload drain` process, unless an uploader is already
+    running. Its output goes to ~/.mug/uploader.log.
+    """
+    with open(UPLOADER_LOCK_PATH, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # The running uploader picks the new entry up in its next round.
+            return
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    with open(UPLOADER_LOG_PATH, 'a') as log_file:
+        subprocess.Popen(
+            [sys.executable, "-m", "mug_core.main", "upload", "drain"],
+            stdin=subprocess.DEVNULL,
+            stdout=log_file,
+            stderr=log_file,
+            start_new_session=True,
+        )
+
+def flush_uploads(timeout=DEFAULT_FLUSH_TIMEOUT):
+    """
+    Uploads everything still queued, in the foreground, with a progress line.
+    Waits for a running background uploader to finish first.
+
+    Args:
+        timeout (float): Seconds to wait before giving up.
+
+    Returns:
+        bool: True if nothing is left pending.
+    """
+    total = len(load_journal())
+    if not total:
+        return True
+    deadline = time.monotonic() + timeout
+    terminal = sys.stdout
+
+    def show_progress(done, pending_total, entry):
+        name = os.path.basename(entry["local_file"])
+        terminal.write(f"\rUploading session logs: {done}/{pending_total} {name}\033[K")
+        terminal.flush()
+
+    terminal.write(f"Uploading session logs: 0/{total}")
+    terminal.flush()
+    with open(UPLOADER_LOCK_PATH, 'w') as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    terminal.write("\n")
+                    print("Timed out waiting for the background uploader.")
+                    return False
+                time.sleep(0.2)
+        # Per-upload messages go to the uploader log; the terminal only gets the progress line.
+        with open(UPLOADER_LOG_PATH, 'a') as log_file, redirect_stdout(log_file):
+            pending = drain_queue(on_progress=show_progress, deadline=deadline)
+    terminal.write("\n")
+    if pending:
+        print(f"{len(pending)} session log upload(s) still pending. They are retried after the next command; see {UPLOADER_LOG_PATH}.")
+        return False
+    print("Session logs uploaded.")
+    return True
+
+def upload_command(args):
+    """
+    Entry point of `mug_core upload drain|flush|status`.
+    `drain` is what the detached uploader runs; `flush` is run by `mug --end`.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core upload")
+    parser.add_argument("action", choices=["drain", "flush", "status"])
+    parser.add_argument("--timeout", type=float, default=DEFAULT_FLUSH_TIMEOUT, help="Seconds `flush` waits at most.")
+    options = parser.parse_args(args)
+    if options.action == "drain":
+        run_uploader()
+    elif options.action == "flush":
+        if not flush_uploads(options.timeout):
+            sys.exit(1)
+    else:
+        uploads = load_journal()
+        if not uploads:
+            print("No pending uploads.")
+        for entry in uploads.values():
+            waited = time.time() - entry["queued"]
+            print(f"{entry['local_file']} -> s3://{entry['bucket']}/{entry['key']} (queued {waited:.0f}s ago)")
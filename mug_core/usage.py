@@ -0,0 +1,154 @@
+import os
+import json
+import fcntl
+import argparse
+from contextlib import contextmanager
+
+# Per-session token and latency totals, kept next to the log in `<log>.usage.json`:
+#   {"requests", "cached", "prompt_tokens", "completion_tokens", "seconds",
+#    "models": {model: {"requests", "prompt_tokens", "completion_tokens", "seconds"}}}
+# Every answered question and every digest adds to it, so a shared session has a spend figure.
+# Cached answers count as requests but cost no tokens.
+USAGE_SUFFIX = ".usage.json"
+
+# USD per million (prompt, completion) tokens, for the spend estimate of `mug --usage`.
+# LLM_PRICES="model:prompt:completion,..." overrides or adds models.
+DEFAULT_PRICES = {
+    "gpt-4.1-nano": (0.10, 0.40),
+    "gpt-4o-mini": (0.15, 0.60),
+    "gpt-4.1-mini": (0.40, 1.60),
+    "gpt-4.1": (2.00, 8.00),
+    "gpt-4o": (2.50, 10.00),
+}
+
+def get_usage_path(log_path):
+    return f"{log_path}{USAGE_SUFFIX}"
+
+def new_usage():
+    return {"requests": 0, "cached": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0, "models": {}}
+
+def load_usage(log_path):
+    try:
+        with open(get_usage_path(log_path), 'r') as usage_file:
+            usage = json.load(usage_file)
+        if isinstance(usage.get("models"), dict):
+            return usage
+    except (OSError, ValueError):
+        pass
+    return new_usage()
+
+@contextmanager
+def locked_usage(log_path):
+    """
+    Yields the session's totals under an exclusive lock, and writes them back when the block ends.
+    """
+    path = get_usage_path(log_path)
+    with open(f"{path}.lock", 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        usage = load_usage(log_path)
+        yield usage
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as usage_file:
+            json.dump(usage, usage_file)
+        os.replace(tmp_path, path)
+
+def get_session_log_path():
+    from .api import load_session_log_file
+    return load_session_log_file()
+
+def record_session_usage(model, prompt_tokens, completion_tokens, seconds, cached=False, log_path=None):
+    """
+    Adds one request to the session's totals. Accounting never gets in the way of an
+    answer: without a session, or on a write error, nothing is recorded.
+
+    Args:
+        model (str): The model that answered.
+        prompt_tokens (int): Tokens sent.
+        completion_tokens (int): Tokens received.
+        seconds (float): How long the request took.
+        cached (bool): Whether the answer came from the response cache.
+        log_path (str): The session log. Defaults to the current session's.
+
+    Returns:
+        None
+    """
+    log_path = log_path or get_session_log_path()
+    if not log_path or not os.path.exists(log_path):
+        return
+    prompt_tokens = 0 if cached else prompt_tokens or 0
+    completion_tokens = 0 if cached else completion_tokens or 0
+    try:
+        with locked_usage(log_path) as usage:
+            usage["requests"] += 1
+            usage["cached"] += 1 if cached else 0
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["seconds"] += seconds or 0.0
+            totals = usage["models"].setdefault(model, {"requests": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0})
+            totals["requests"] += 1
+            totals["prompt_tokens"] += prompt_tokens
+            totals["completion_tokens"] += completion_tokens
+            totals["seconds"] += seconds or 0.0
+    except OSError as e:
+        print(f"Error recording token usage: {e}")
+
+def get_prices():
+    prices = dict(DEFAULT_PRICES)
+    for item in os.getenv("LLM_PRICES", "").split(","):
+        parts = item.strip().rsplit(":", 2)
+        if len(parts) != 3:
+            continue
+        try:
+            prices[parts[0]] = (float(parts[1]), float(parts[2]))
+        except ValueError:
+            continue
+    return prices
+
+def estimate_cost(usage, prices=None):
+    """
+    Returns the estimated spend in USD, or None if a model that used tokens has no price.
+    """
+    prices = prices if prices is not None else get_prices()
+    cost = 0.0
+    for model, totals in usage["models"].items():
+        if not totals["prompt_tokens"] and not totals["completion_tokens"]:
+            continue
+        if model not in prices:
+            return None
+        prompt_price, completion_price = prices[model]
+        cost += (totals["prompt_tokens"] * prompt_price + totals["completion_tokens"] * completion_price) / 1_000_000
+    return cost
+
+def format_usage(usage):
+    lines = [f"{'model':<22} {'requests':>9} {'prompt':>10} {'completion':>11} {'avg s':>7}"]
+    for model, totals in sorted(usage["models"].items()):
+        average = totals["seconds"] / totals["requests"] if totals["requests"] else 0.0
+        lines.append(f"{model:<22} {totals['requests']:>9} {totals['prompt_tokens']:>10} {totals['completion_tokens']:>11} {average:>7.2f}")
+    average = usage["seconds"] / usage["requests"] if usage["requests"] else 0.0
+    lines.append(f"{'total':<22} {usage['requests']:>9} {usage['prompt_tokens']:>10} {usage['completion_tokens']:>11} {average:>7.2f}")
+    cost = estimate_cost(usage)
+    lines.append(f"{usage['cached']} answered from the cache. Estimated spend: "
+                 + (f"${cost:.4f}" if cost is not None else "unknown (set LLM_PRICES for the models used)"))
+    return "\n".join(lines)
+
+def usage_command(args):
+    """
+    Entry point of `mug_core usage`, run by `mug --usage`: prints the session's token and
+    latency totals per model, with an estimated spend.
+    """
+    parser = argparse.ArgumentParser(prog="mug_core usage", description="Show the token usage of a session.")
+    parser.add_argument("log", nargs="?", default=None, help="The session log. Defaults to the current session's.")
+    parser.add_argument("--json", action="store_true", help="Print the totals as JSON.")
+    options = parser.parse_args(args)
+
+    log_path = options.log or get_session_log_path()
+    if not log_path:
+        print("No session log found.")
+        return
+    usage = load_usage(log_path)
+    if options.json:
+        print(json.dumps(dict(usage, estimated_cost=estimate_cost(usage)), indent=2))
+    elif not usage["requests"]:
+        print(f"No LLM requests recorded for {log_path}.")
+    else:
+        print(format_usage(usage))
@@ -19,19 +19,29 @@ function mug() {
         {
             mug_core start
             echo "You are now in a mug session. Type 'mug end' to end the session."
-            source $(python3 -c "import mug_core; print(mug_core.get_command_hook_path())")
+            source "$HOME/.mug/session.env"
+            source "$MUG_COMMAND_HOOK"
+            if [ "$MUG_AGENT" = "true" ]; then
+                mug_core agent start
+            fi
         } || {
             echo "An error occurred while starting the mug session."
         }
     elif [ "$1" = "--end" ]; then
         {
-            source $(python3 -c "import mug_core; print(mug_core.get_command_unset_path())")
+            if [ -s "$HOME/.mug/upload_queue.json" ] && [ "$(<"$HOME/.mug/upload_queue.json")" != "{}" ]; then
+                mug_core upload flush
+            fi
+            if [ -S "$MUG_AGENT_SOCKET" ]; then
+                python3 -S "$MUG_AGENT_CLIENT" shutdown
+            fi
+            source "${MUG_COMMAND_UNSET:-$(python3 -c "import mug_core; print(mug_core.get_command_unset_path())")}"
             echo "Ending session."
         } || {
             echo "An error occurred while ending the mug session."
         }
     elif [ "$1" = "--help" ]; then
-        echo "Usage: mug [--start | --end | --help | --version | --session | --llm]"
+        echo "Usage: mug [--start | --end | --help | --version | --session | --llm | --llm-batch | --stats | --usage | --search | --follow | --explain-last]"
     elif [ "$1" = "--version" ]; then
         version=$(python3 -c "import mug_core; print(mug_core.__version__)")
         echo "mug version $version"
@@ -40,10 +50,32 @@ function mug() {
     elif [ "$1" = "--llm" ]; then
         question="${@:2}"
         {
-            mug_core "$question"
+            mug_agent_status=2
+            if [ -S "$MUG_AGENT_SOCKET" ]; then
+                python3 -S "$MUG_AGENT_CLIENT" ask "question=$question"
+                mug_agent_status=$?
+            fi
+            # 2: no agent took the question in time, so it is asked directly.
+            if [ $mug_agent_status -eq 2 ]; then
+                mug_core "$question"
+            fi
         } || {
             echo "An error occurred while asking the question: $question"
         }
+    elif [ "$1" = "--llm-batch" ]; then
+        mug_core batch "${@:2}" || {
+            echo "An error occurred while running the batch: $2"
+        }
+    elif [ "$1" = "--stats" ]; then
+        mug_core stats "${@:2}"
+    elif [ "$1" = "--usage" ]; then
+        mug_core usage "${@:2}"
+    elif [ "$1" = "--search" ]; then
+        mug_core search "${@:2}"
+    elif [ "$1" = "--follow" ]; then
+        mug_core follow "${@:2}"
+    elif [ "$1" = "--explain-last" ]; then
+        mug_core explain "${@:2}"
     else
         execute_with_redirection "$@"
     fi
@@ -69,6 +101,8 @@ setup(
     install_requires=[
         'openai',
         'boto3',
+        'tiktoken',
+        'httpx',
     ],
     entry_points={
         'console_scripts': [
@@ -76,7 +110,7 @@ setup(
         ],
     },
     package_data={
-        'mug_core': ['scripts/command_hook.sh', 'scripts/command_unset.sh'],
+        'mug_core': ['scripts/command_hook.sh', 'scripts/command_unset.sh', 'scripts/agent_client.py'],
     },
     include_package_data=True,
     long_description="Mug Core: A command line tool to interact with OpenAI's GPT models and AWS S3.",
@@ -0,0 +1,54 @@
+import sys
+import types
+import unittest
+from unittest import mock
+
+from mug_core import chatgpt, context
+
+
+class OfflineTokenizerTest(unittest.TestCase):
+    """
+    Requests are routed and sent when tiktoken cannot load its BPE file, as on a host
+    without network access.
+    """
+    def setUp(self):
+        def fail(*args, **kwargs):
+            raise ConnectionError("cannot download the BPE file")
+        tiktoken = types.ModuleType("tiktoken")
+        tiktoken.get_encoding = fail
+        tiktoken.encoding_for_model = fail
+        patches = [
+            mock.patch.dict(sys.modules, {"tiktoken": tiktoken}),
+            mock.patch.dict(context._encodings, clear=True),
+            mock.patch.dict("os.environ", {"LLM_BACKEND": "stub", "LLM_STUB_RESPONSE": "digest"}),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_count_tokens_estimates(self):
+        self.assertEqual(context.count_tokens("x" * 40), 10)
+        self.assertIsNone(context._encodings[context.DEFAULT_ENCODING])
+
+    def test_route_request(self):
+        messages = chatgpt.build_messages("why did it fail", "x" * 400)
+        model, max_tokens, prompt_tokens = chatgpt.route_request(messages)
+        self.assertEqual(model, chatgpt.get_routes()[0][0])
+        self.assertGreater(prompt_tokens, 100)
+
+    def test_route_request_pinned_model(self):
+        with mock.patch.dict("os.environ", {"OPENAI_MODEL": "gpt-4o"}):
+            self.assertEqual(chatgpt.route_request(chatgpt.build_messages("q", "c"))[0], "gpt-4o")
+
+    def test_route_request_survives_tokenizer_errors(self):
+        with mock.patch.object(chatgpt, "count_tokens", side_effect=ValueError("bad encoding")):
+            self.assertGreater(chatgpt.route_request(chatgpt.build_messages("q", "c" * 40))[2], 10)
+
+    def test_summarize_text(self):
+        with mock.patch.object(chatgpt, "record_session_usage") as record:
+            self.assertEqual(chatgpt.summarize_text("Input:\n- make\n\nOutput:\nerror\n"), "digest")
+        record.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()